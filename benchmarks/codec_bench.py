@@ -0,0 +1,126 @@
+"""
+Checks and benchmarks the compact chat data codec against pickle.
+
+Usage (from the repository root):
+
+    python -m benchmarks.codec_bench --players 3 5 10 20
+
+Random legal games are played through main's Game class and captured before
+they start, right after the start, halfway through and at the end. Every
+capture is round-tripped through codec (the command fails if anything comes
+back different) and its encoded size and encode/decode times are reported
+next to pickle's. "codec B" includes the game's event log; "row B" is the
+size of the chat data row when events are stored separately, as the bot does
+(see game_log.GameEvents).
+"""
+
+import argparse
+import pickle
+import random
+import sys
+import time
+
+import codec
+from benchmarks.game_state_bench import random_game
+from game import Game, GameStatus, Player
+
+def _state_fields(state):
+    return ([ [ int(x) for x in row ] for row in state.player_minimums ],
+            [ [ int(x) for x in row ] for row in state.player_maximums ],
+            [ int(x) for x in state.hand_sizes ], state.last_actor, state.version)
+
+def game_fields(game):
+    """
+    Everything about 'game' that is visible to the bot, for comparing a game
+    with its decoded copy.
+    """
+    fields = { key: value for key, value in game.__getstate__().items() if key != "state" }
+    fields["players"] = [ (player.id, player.name) for player in game.players ]
+    for key in ("asking_player", "target_player"):
+        if fields.get(key) is not None:
+            fields[key] = (fields[key].id, fields[key].name)
+    if hasattr(game, "state"):
+        fields["state"] = _state_fields(game.state)
+    if game.log is not None:
+        fields["log"] = (game.log.game_id, game.log.snapshots[0], game.log.events)
+    return fields
+
+def snapshots(num_players, rng, max_turns):
+    """
+    Plays a random game of 'num_players' through a Game and returns copies of
+    it at four points.
+    """
+    game = Game()
+    for i in range(num_players):
+        game.player_join(Player(100000 + i, "player{}".format(i)))
+    res = [ pickle.loads(pickle.dumps(game)) ]
+
+    # random_game numbers players and suits like Game's indices
+    game.suit_names = [ "suit{}".format(suit) for suit in range(num_players) ]
+    random.seed(rng.random())
+    game.game_start()
+    res.append(pickle.loads(pickle.dumps(game)))
+
+    moves = random_game(num_players, rng, max_turns)
+    for turn, (asker, target, suit, n) in enumerate(moves):
+        if turn == len(moves) // 2:
+            res.append(pickle.loads(pickle.dumps(game)))
+        if game.asking_player_idx != asker or \
+                game.ask_for(game.players[asker], str(target), game.suit_names[suit]) or \
+                game.status == GameStatus.GAME_OVER or \
+                game.respond_to_request(game.players[target], str(n)) or \
+                game.status == GameStatus.GAME_OVER:
+            break
+    res.append(game)
+    return res
+
+def timed(fn, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        res = fn(arg)
+    return res, (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, nargs="+", default=[3, 5, 10, 20])
+    parser.add_argument("--games", type=int, default=5, help="games per player count")
+    parser.add_argument("--max-turns", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200, help="encodes/decodes timed per capture")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failures = 0
+    print("{:>3} {:>10} {:>10} {:>10} {:>14} {:>14} {:>14} {:>14}".format("n", "pickle B", "codec B",
+        "row B", "pickle enc us", "codec enc us", "pickle dec us", "codec dec us"))
+    for num_players in args.players:
+        totals = [ 0.0 ] * 7
+        captures = 0
+        for game_id in range(args.games):
+            rng = random.Random("{}-{}-{}".format(args.seed, num_players, game_id))
+            for game in snapshots(num_players, rng, args.max_turns):
+                chat_data = { "game_obj": game }
+                pickled, pickle_enc = timed(pickle.dumps, chat_data, args.repeat)
+                encoded, codec_enc = timed(codec.encode_chat_data, chat_data, args.repeat)
+                _, pickle_dec = timed(pickle.loads, pickled, args.repeat)
+                decoded, codec_dec = timed(codec.decode_chat_data, encoded, args.repeat)
+
+                if game_fields(decoded["game_obj"]) != game_fields(game) or \
+                        codec.encode_chat_data(decoded) != encoded or \
+                        game_fields(codec.decode_chat_data(pickled)["game_obj"]) != game_fields(game):
+                    print("round trip mismatch: n={} game {}".format(num_players, game_id), file=sys.stderr)
+                    failures += 1
+
+                row = codec.encode_chat_data(chat_data, external_events=True)
+                for i, value in enumerate((len(pickled), len(encoded), len(row),
+                        pickle_enc, codec_enc, pickle_dec, codec_dec)):
+                    totals[i] += value
+                captures += 1
+        means = [ total / captures for total in totals ]
+        print("{:>3} {:>10.0f} {:>10.0f} {:>10.0f} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.1f}".format(num_players,
+            means[0], means[1], means[2], means[3] * 1e6, means[4] * 1e6, means[5] * 1e6, means[6] * 1e6))
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
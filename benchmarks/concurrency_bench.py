@@ -0,0 +1,191 @@
+"""
+Measures how update throughput scales with the dispatcher's workers when
+many chats play at once.
+
+Usage (from the repository root):
+
+    python -m benchmarks.concurrency_bench --chats 200 --workers 1 4 16 --latency 20
+
+Every chat creates a game, is joined by --players users and plays --moves
+moves through main.py's handlers on a real Dispatcher. Telegram is replaced
+by a Request that answers every call after --latency milliseconds, standing
+in for the round trip of a reply. The joins of a chat are sent all at once,
+right behind its /newgame, so they only all succeed if the chat's updates
+are handled in order; after that, each chat sends its next move as soon as
+the reply to the previous one arrives, choosing it from its game's bounds.
+
+Runs once with the handlers on the dispatcher thread, as before, and once
+per --workers with them in per-chat queues (concurrency.ChatQueues), and
+reports updates per second, the number of out-of-order joins and of
+handlers that raised (which end their chat's game).
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+from queue import Queue
+
+# main.py reads these when imported; nothing is sent anywhere
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("BOT_USERNAME", "@benchmark_bot")
+
+import telegram
+from telegram.ext import Dispatcher
+from telegram.utils.request import Request
+
+import main as bot_main
+from concurrency import ChatQueues
+from game import GameStatus
+
+class SlowRequest(Request):
+    """
+    Answers the Bot API calls the handlers make after 'latency' seconds, and
+    passes every message sent to 'on_message(chat_id, text)'.
+    """
+
+    # PTB warns about attributes its classes don't declare
+    __slots__ = ("latency", "on_message", "message_ids")
+
+    def __init__(self, latency, on_message):
+        super().__init__()
+        self.latency = latency
+        self.on_message = on_message
+        self.message_ids = iter(range(1, 1 << 62))
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+        if method == "getMe":
+            return { "id": 1, "is_bot": True, "first_name": "benchmark", "username": "benchmark_bot" }
+        time.sleep(self.latency)
+        chat_id = int(data["chat_id"])
+        self.on_message(chat_id, data["text"])
+        return { "message_id": next(self.message_ids), "date": int(time.time()),
+                 "chat": { "id": chat_id, "type": "group" }, "text": data["text"] }
+
+class Chats:
+    """
+    The simulated chats: sends each one's updates and picks its next move
+    whenever a reply arrives.
+    """
+
+    def __init__(self, num_chats, num_players, num_moves, seed):
+        self.num_chats = num_chats
+        self.num_players = num_players
+        self.num_moves = num_moves
+        self.rng = random.Random(seed)
+        self.update_ids = iter(range(1, 1 << 62))
+        self.replies = {}
+        self.moves = {}
+        self.out_of_order = 0
+        self.errors = 0
+        self.updates = 0
+        self.done = threading.Event()
+        self.finished = 0
+        self.lock = threading.Lock()
+        self.dispatcher = None
+
+    def user_id(self, chat_id, i):
+        return chat_id * 100 + i
+
+    def send(self, chat_id, user_id, text):
+        command = text.split()[0]
+        message = { "message_id": next(self.update_ids), "date": int(time.time()), "text": text,
+                    "chat": { "id": -chat_id, "type": "group" },
+                    "from": { "id": user_id, "is_bot": False, "first_name": "user{}".format(user_id) },
+                    "entities": [ { "type": "bot_command", "offset": 0, "length": len(command) } ] }
+        with self.lock:
+            self.updates += 1
+        self.dispatcher.update_queue.put(telegram.Update.de_json(
+            { "update_id": message["message_id"], "message": message }, self.dispatcher.bot))
+
+    def start(self):
+        for chat_id in range(1, self.num_chats + 1):
+            self.replies[chat_id] = 0
+            self.moves[chat_id] = 0
+            self.send(chat_id, self.user_id(chat_id, 0), "/newgame")
+            for i in range(self.num_players):
+                self.send(chat_id, self.user_id(chat_id, i), "/joingame")
+
+    def finish(self):
+        with self.lock:
+            self.finished += 1
+            if self.finished == self.num_chats:
+                self.done.set()
+
+    def on_error(self, update, context):
+        # a handler that raised sends no reply, so its chat stops here
+        with self.lock:
+            self.errors += 1
+        self.finish()
+
+    def on_message(self, chat_id, text):
+        chat_id = -chat_id
+        with self.lock:
+            self.replies[chat_id] += 1
+            replies = self.replies[chat_id]
+            if text == "No game exists in this chat" or text.startswith("You're already"):
+                self.out_of_order += 1
+        if replies < self.num_players + 1:
+            return
+        if replies == self.num_players + 1:
+            self.send(chat_id, self.user_id(chat_id, 0), "/startgame")
+            return
+        # the reply is the last thing a handler does, so the game is settled
+        game = self.dispatcher.chat_data[-chat_id]["game_obj"]
+        self.moves[chat_id] += 1
+        if self.moves[chat_id] > self.num_moves or game.status not in (GameStatus.AWAITING_ASK,
+                                                                         GameStatus.AWAITING_RESPONSE):
+            self.finish()
+            return
+        with self.lock:
+            rng = random.Random(self.rng.random())
+        state = game.state
+        if game.status == GameStatus.AWAITING_ASK:
+            asker = game.asking_player_idx
+            suits = [ s for s in range(game.num_players) if state.player_maximums[asker][s] > 0 ] or [ 0 ]
+            target = rng.choice([ p for p in range(game.num_players) if p != asker ])
+            suit = rng.choice(suits)
+            name = game.suit_names[suit] if suit < len(game.suit_names) else "suit{}".format(len(game.suit_names))
+            self.send(chat_id, game.players[asker].id, "/ask {} {}".format(target, name))
+        else:
+            target = game.target_player_idx
+            suit = game.requested_suit_idx
+            count = rng.randint(state.player_minimums[target][suit], state.player_maximums[target][suit])
+            self.send(chat_id, game.players[target].id, "/ihave {}".format(count))
+
+def run(args, workers):
+    chats = Chats(args.chats, args.players, args.moves, args.seed)
+    bot = telegram.Bot("123456:benchmark", request=SlowRequest(args.latency / 1000, chats.on_message))
+    dispatcher = Dispatcher(bot, Queue(), workers=max(workers, 1))
+    bot_main.add_handlers(dispatcher, ChatQueues(dispatcher) if workers else None)
+    dispatcher.add_error_handler(chats.on_error)
+    chats.dispatcher = dispatcher
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+    start = time.perf_counter()
+    chats.start()
+    chats.done.wait()
+    elapsed = time.perf_counter() - start
+    dispatcher.stop()
+    return chats.updates / elapsed, chats.out_of_order, chats.errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--moves", type=int, default=10, help="moves per chat after the game starts")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--latency", type=float, default=20.0, help="milliseconds per Bot API call")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("{:>18} {:>12} {:>14} {:>8}".format("handlers", "updates/s", "out of order", "errors"))
+    for workers in [ 0 ] + args.workers:
+        rate, out_of_order, errors = run(args, workers)
+        label = "{} workers".format(workers) if workers else "dispatcher thread"
+        print("{:>18} {:>12.1f} {:>14} {:>8}".format(label, rate, out_of_order, errors))
+
+if __name__ == "__main__":
+    main()
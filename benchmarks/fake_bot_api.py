@@ -0,0 +1,190 @@
+"""
+A local stand-in for the Telegram Bot API, for load tests.
+
+Point the bot at it with TELEGRAM_API_URL=http://host:port/bot. It answers
+getMe, setWebhook, deleteWebhook and sendMessage (which is also what
+reply_text calls) after an optional delay standing in for Telegram's round
+trip, records when and for how long every call was served, and passes every
+message sent (with its inline keyboard) and every answerCallbackQuery to
+callbacks. Any other method gets an "ok" with an empty result. With a flood limit, messages to a chat beyond that many a second get
+a 429 with a retry_after, as Telegram answers them.
+
+Run on its own it just serves and prints a summary every few seconds:
+
+    python -m benchmarks.fake_bot_api --port 8081 --latency 20 --flood-limit 1
+"""
+
+import argparse
+import itertools
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+class Flood(Exception):
+    """
+    A call refused for exceeding the flood limit, to retry after 'retry_after'
+    seconds.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class FakeBotAPI:
+    """
+    The fake server's state. 'on_message(chat_id, text, received,
+    reply_markup)' is called for every sendMessage, on the request's thread,
+    with the time.monotonic() the call arrived at and the message's
+    reply_markup decoded (or None); 'on_answer(callback_query_id, text,
+    received)' likewise for every answerCallbackQuery.
+    """
+
+    def __init__(self, latency=0.0, on_message=None, username="fake_bot", flood_limit=0, on_answer=None):
+        self.latency = latency
+        self.flood_limit = flood_limit
+        self.flooded = 0
+        # chat id -> arrival times of its messages in the last second
+        self._recent = {}
+        self.on_message = on_message
+        self.on_answer = on_answer
+        self.username = username
+        self.webhook_url = None
+        # (method, arrival, seconds to serve) of every call
+        self.calls = []
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.server = None
+
+    def call(self, method, params):
+        """
+        Serves one Bot API call and returns its result, or raises Flood.
+        """
+        received = time.monotonic()
+        if method == "getMe":
+            result = { "id": 1, "is_bot": True, "first_name": "Fake", "username": self.username }
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url")
+            result = True
+        elif method == "deleteWebhook":
+            self.webhook_url = None
+            result = True
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            if self.flood_limit:
+                self._check_flood(chat_id, received)
+            if self.latency:
+                time.sleep(self.latency)
+            reply_markup = params.get("reply_markup")
+            if isinstance(reply_markup, str):
+                # as the Bot API takes it, JSON within the parameters
+                reply_markup = json.loads(reply_markup)
+            if self.on_message is not None:
+                self.on_message(chat_id, params.get("text", ""), received, reply_markup)
+            result = { "message_id": next(self._message_ids), "date": int(time.time()),
+                       "chat": { "id": chat_id, "type": "group" }, "text": params.get("text", "") }
+        elif method == "answerCallbackQuery":
+            if self.on_answer is not None:
+                self.on_answer(params["callback_query_id"], params.get("text"), received)
+            result = True
+        else:
+            result = True
+        with self._lock:
+            self.calls.append((method, received, time.monotonic() - received))
+        return result
+
+    def _check_flood(self, chat_id, received):
+        with self._lock:
+            recent = self._recent.setdefault(chat_id, [])
+            recent[:] = [ stamp for stamp in recent if stamp > received - 1 ]
+            if len(recent) >= self.flood_limit:
+                self.flooded += 1
+                raise Flood(max(1, math.ceil(recent[0] + 1 - received)))
+            recent.append(received)
+
+    def serve(self, port=0, host="127.0.0.1"):
+        """
+        Serves from a daemon thread and returns the base URL to give the bot
+        (http://host:port/bot).
+        """
+        handler = type("Handler", (_Handler,), { "api": self })
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake Bot API", daemon=True).start()
+        return "http://{}:{}/bot".format(host, self.server.server_address[1])
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def summary(self):
+        """
+        Returns { method: (calls, mean seconds to serve) }.
+        """
+        with self._lock:
+            calls = list(self.calls)
+        res = {}
+        for method, _, seconds in calls:
+            count, total = res.get(method, (0, 0.0))
+            res[method] = (count + 1, total + seconds)
+        return { method: (count, total / count) for method, (count, total) in res.items() }
+
+class _Handler(BaseHTTPRequestHandler):
+    # keeps the bot's connections open between calls
+    protocol_version = "HTTP/1.1"
+    # or the body, written after the headers, waits for the bot's delayed ACK
+    disable_nagle_algorithm = True
+    api = None
+
+    def _answer(self, params):
+        # the path is /bot<token>/<method>
+        method = self.path.split("?")[0].rsplit("/", 1)[-1]
+        try:
+            status, res = 200, { "ok": True, "result": self.api.call(method, params) }
+        except Flood as flood:
+            status, res = 429, { "ok": False, "error_code": 429, "parameters": { "retry_after": flood.retry_after },
+                "description": "Too Many Requests: retry after {}".format(flood.retry_after) }
+        body = json.dumps(res).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(data or b"{}")
+        else:
+            # form encoded, as some clients send it
+            params = dict(parse_qsl(data.decode("utf-8")))
+        self._answer(params)
+
+    def do_GET(self):
+        self._answer(dict(parse_qsl(urlsplit(self.path).query)))
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds before answering sendMessage")
+    parser.add_argument("--flood-limit", type=int, default=0, help="messages a second to a chat before a 429")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.latency / 1000, flood_limit=args.flood_limit)
+    print("TELEGRAM_API_URL={}".format(api.serve(args.port, args.host)))
+    while True:
+        time.sleep(5)
+        for method, (count, seconds) in sorted(api.summary().items()):
+            print("{:>16} {:>8} calls {:>8.2f} ms".format(method, count, seconds * 1e3))
+        if api.flooded:
+            print("{:>16} {:>8}".format("429s", api.flooded))
+
+if __name__ == "__main__":
+    main()
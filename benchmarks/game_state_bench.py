@@ -0,0 +1,314 @@
+"""
+Benchmarks the GameState hot paths on random legal games.
+
+Usage (from the repository root):
+
+    python -m benchmarks.game_state_bench --output bench.json
+    python -m benchmarks.game_state_bench --baseline bench.json
+    python -m benchmarks.game_state_bench --verify 200
+
+For each player count, random games are generated by dealing a hidden hand
+to every player and playing truthful moves, so every move is legal. Each of
+asked_for, gave_away, received, check_win_conditions and legal_asks (for the
+next keyboard) is timed separately, and "move" is their sum: what the bot
+spends per move. deduce_extrema, the exact pass over every cell, is timed
+after every move on a second copy of the game, so that the timed one keeps
+the bounds the bot works with. The number of deduction steps (rows and
+columns examined, in total and per move) and the peak memory of a game are
+recorded too. Results are written as JSON, and can be compared against an
+earlier run to catch regressions.
+
+--verify plays that many random games per player count instead, with moves
+picked at random among those the state accepts, and checks after every
+action that check_win_conditions agrees with a scan of the whole table.
+"""
+
+import argparse
+import copy
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from game_state import NUM_PER_SUIT, WinType, new_game_state
+
+MOVE_OPERATIONS = ["asked_for", "gave_away", "received", "check_win_conditions", "legal_asks"]
+OPERATIONS = MOVE_OPERATIONS + ["move", "deduce_extrema"]
+
+def random_game(num_players, rng, max_turns):
+    """
+    Returns a list of (asker, target, suit, n) moves of a random game that is
+    legal for 'num_players' players: cards are dealt at random, and every
+    turn the next player with cards asks a random other player for a random
+    suit they hold, and is answered truthfully.
+    """
+    deck = [ suit for suit in range(num_players) for _ in range(NUM_PER_SUIT) ]
+    rng.shuffle(deck)
+    hands = [ [ 0 ] * num_players for _ in range(num_players) ]
+    for i, suit in enumerate(deck):
+        hands[i // NUM_PER_SUIT][suit] += 1
+
+    moves = []
+    asker = 0
+    for _ in range(max_turns):
+        while not any(hands[asker]):
+            asker = (asker + 1) % num_players
+        suit = rng.choice([ s for s in range(num_players) if hands[asker][s] ])
+        target = rng.choice([ p for p in range(num_players) if p != asker ])
+        n = hands[target][suit]
+        hands[target][suit] = 0
+        hands[asker][suit] += n
+        moves.append((asker, target, suit, n))
+        asker = (asker + 1) % num_players
+    return moves
+
+def count_steps(state):
+    """
+    Wraps the per-row and per-column deduction steps of a (pure Python)
+    GameState so they can be counted. Returns a one-element list holding the
+    running count, or None for backends without those steps.
+    """
+    if not hasattr(state, "_deduce_suit"):
+        return None
+    count = [ 0 ]
+    base = type(state)
+
+    # GameState has __slots__, so the steps are wrapped in a subclass with
+    # the same layout rather than on the instance
+    class Counted(base):
+        __slots__ = ()
+
+        def _deduce_suit(self, suit):
+            count[0] += 1
+            return base._deduce_suit(self, suit)
+
+        def _deduce_player(self, player):
+            count[0] += 1
+            return base._deduce_player(self, player)
+
+    state.__class__ = Counted
+    return count
+
+def play(num_players, moves, timings, exact=True):
+    """
+    Plays 'moves' on a fresh game state until the game is won, appending the
+    duration of every call to timings[operation]. Returns (turns played,
+    deduction steps or None). Without 'exact', deduce_extrema isn't timed.
+    """
+    state = new_game_state(num_players)
+    exact = new_game_state(num_players) if exact else None
+    steps = count_steps(state)
+    clock = time.perf_counter
+    turns = 0
+    for asker, target, suit, n in moves:
+        turns += 1
+        first = len(timings["asked_for"])
+        start = clock()
+        ok = state.asked_for(asker, suit)
+        timings["asked_for"].append(clock() - start)
+
+        start = clock()
+        ok = ok and state.gave_away(target, suit, n)
+        timings["gave_away"].append(clock() - start)
+
+        start = clock()
+        ok = ok and state.received(asker, suit, n)
+        timings["received"].append(clock() - start)
+        if not ok:
+            raise RuntimeError("legal move rejected: {}".format((asker, target, suit, n)))
+
+        start = clock()
+        won = state.check_win_conditions()
+        timings["check_win_conditions"].append(clock() - start)
+
+        start = clock()
+        state.legal_asks((asker + 1) % num_players)
+        timings["legal_asks"].append(clock() - start)
+        timings["move"].append(sum( timings[op][first] for op in MOVE_OPERATIONS ))
+
+        if exact is not None:
+            exact.asked_for(asker, suit)
+            exact.gave_away(target, suit, n)
+            exact.received(asker, suit, n)
+            start = clock()
+            exact.deduce_extrema()
+            timings["deduce_extrema"].append(clock() - start)
+        if won:
+            break
+    return turns, steps[0] if steps is not None else None
+
+def full_scan_win(state):
+    """
+    check_win_conditions as it was before GameState kept counts for it: every
+    bound compared, then the first whole suit in player, suit order. Deduces
+    on a copy, so that 'state' itself goes on without the exact bounds.
+    """
+    state = copy.deepcopy(state)
+    state.deduce_extrema()
+    mins = [ list(row) for row in state.player_minimums ]
+    maxs = [ list(row) for row in state.player_maximums ]
+    if mins == maxs:
+        return WinType.CONVERGED_STATE, state.last_actor
+    for player in range(state.num_players):
+        for suit in range(state.num_players):
+            if mins[player][suit] == NUM_PER_SUIT:
+                return WinType.ALL_SUIT, player, suit
+
+def verify(player_counts, games, seed):
+    """
+    Plays random games that only make moves the state accepts, comparing
+    check_win_conditions with full_scan_win after every action. Returns the
+    number of (players, game, turn, result, expected) mismatches, printing
+    them.
+    """
+    mismatches = 0
+    for num_players in player_counts:
+        outcomes = { "converged": 0, "all suit": 0, "unfinished": 0 }
+        for game in range(games):
+            rng = random.Random("verify-{}-{}-{}".format(seed, num_players, game))
+            state = new_game_state(num_players)
+            asker = 0
+            outcome = "unfinished"
+            for turn in range(20 * num_players):
+                while not state.hand_sizes[asker]:
+                    asker = (asker + 1) % num_players
+                target = rng.choice([ p for p in range(num_players) if p != asker ])
+                suits = list(range(num_players))
+                rng.shuffle(suits)
+                suit = next(( s for s in suits if state.asked_for(asker, s) ), None)
+                if suit is None:
+                    break
+                counts = list(range(NUM_PER_SUIT + 1))
+                rng.shuffle(counts)
+                n = next(( n for n in counts if state.gave_away(target, suit, n) ), None)
+                if n is None:
+                    break
+                state.received(asker, suit, n)
+                won, expected = state.check_win_conditions(), full_scan_win(state)
+                if won != expected:
+                    mismatches += 1
+                    print("n={} game={} turn={}: {} instead of {}".format(num_players, game, turn, won, expected),
+                        file=sys.stderr)
+                if won:
+                    outcome = "converged" if won[0] == WinType.CONVERGED_STATE else "all suit"
+                    break
+                asker = (asker + 1) % num_players
+            outcomes[outcome] += 1
+        print("n={:<3} {}".format(num_players, "  ".join( "{}={}".format(k, v) for k, v in outcomes.items() )),
+            file=sys.stderr)
+    return mismatches
+
+def peak_memory(num_players, moves):
+    tracemalloc.start()
+    try:
+        play(num_players, moves, { op: [] for op in OPERATIONS }, exact=False)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "calls": len(samples),
+        "total_s": sum(samples),
+        "mean_us": statistics.mean(samples) * 1e6,
+        "p50_us": samples[len(samples) // 2] * 1e6,
+        "p99_us": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6,
+        "max_us": samples[-1] * 1e6,
+    }
+
+def run(player_counts, games, max_turns, seed):
+    results = {}
+    for num_players in player_counts:
+        timings = { op: [] for op in OPERATIONS }
+        turns = []
+        steps = []
+        peaks = []
+        for game in range(games):
+            rng = random.Random("{}-{}-{}".format(seed, num_players, game))
+            moves = random_game(num_players, rng, max_turns)
+            game_turns, game_steps = play(num_players, moves, timings)
+            turns.append(game_turns)
+            if game_steps is not None:
+                steps.append(game_steps)
+            peaks.append(peak_memory(num_players, moves[:game_turns]))
+        results[str(num_players)] = {
+            "operations": { op: summarize(timings[op]) for op in OPERATIONS },
+            "mean_turns": statistics.mean(turns),
+            "mean_deduction_steps": statistics.mean(steps) if steps else None,
+            "deduction_steps_per_move": sum(steps) / sum(turns) if steps else None,
+            "peak_memory_bytes": max(peaks),
+        }
+        print("n={:<3} turns={:<7.1f} steps/move={:<6.1f} move p50={:>9.1f}us  exact deduce p50={:>9.1f}us  "
+              "peak={:>8} B".format(
+            num_players, results[str(num_players)]["mean_turns"],
+            results[str(num_players)]["deduction_steps_per_move"] or 0,
+            results[str(num_players)]["operations"]["move"]["p50_us"],
+            results[str(num_players)]["operations"]["deduce_extrema"]["p50_us"],
+            results[str(num_players)]["peak_memory_bytes"]), file=sys.stderr)
+    return results
+
+def compare(results, baseline, max_ratio):
+    """
+    Prints the mean time of every operation relative to 'baseline' and
+    returns the list of (players, operation, ratio) that exceed 'max_ratio'.
+    """
+    regressions = []
+    for num_players, result in results.items():
+        if num_players not in baseline:
+            continue
+        for op in OPERATIONS:
+            # baselines written before an operation was timed lack it
+            if op not in baseline[num_players]["operations"]:
+                continue
+            old = baseline[num_players]["operations"][op]["mean_us"]
+            new = result["operations"][op]["mean_us"]
+            ratio = new / old if old else float("inf")
+            print("n={:<3} {:<22} {:>10.1f}us -> {:>10.1f}us  x{:.2f}".format(num_players, op, old, new, ratio))
+            if ratio > max_ratio:
+                regressions.append((num_players, op, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, nargs="+", default=[3, 5, 10, 20, 30, 50])
+    parser.add_argument("--games", type=int, default=3, help="games per player count")
+    parser.add_argument("--max-turns", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results in this JSON file")
+    parser.add_argument("--max-ratio", type=float, default=1.25,
+        help="fail if any operation is this many times slower than the baseline")
+    parser.add_argument("--verify", type=int, metavar="GAMES",
+        help="check the win detection on this many random games per player count instead")
+    args = parser.parse_args()
+
+    if args.verify:
+        mismatches = verify(args.players, args.verify, args.seed)
+        print("{} mismatches".format(mismatches))
+        sys.exit(1 if mismatches else 0)
+
+    results = {
+        "python": platform.python_version(),
+        "games": args.games,
+        "max_turns": args.max_turns,
+        "seed": args.seed,
+        "results": run(args.players, args.games, args.max_turns, args.seed),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results["results"], baseline["results"], args.max_ratio)
+        if regressions:
+            print("regressions:", regressions, file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Measures the memory a game keeps resident while its chat is idle.
+
+Usage (from the repository root):
+
+    python -m benchmarks.memory_bench --players 3 5 10 20
+
+Random games are played through Game up to the middle of the game, then
+decoded from their stored rows many times over, as after a restart, and
+given the win check and legal asks of a move, so that everything a move
+leaves behind is built. The memory retained per copy, as counted by
+tracemalloc, is reported for the whole game and separately for its GameState
+and its GameLog. The defaults finish in well under a minute.
+"""
+
+import argparse
+import gc
+import random
+import statistics
+import tracemalloc
+
+import codec
+from benchmarks.codec_bench import snapshots
+
+def retained(make, copies):
+    """
+    Returns the memory retained per object for 'copies' objects from 'make'.
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [ make() for _ in range(copies) ]
+    gc.collect()
+    res = (tracemalloc.get_traced_memory()[0] - before) / copies
+    tracemalloc.stop()
+    del kept
+    return res
+
+def loaded(encoded):
+    game = codec.decode_chat_data(encoded)["game_obj"]
+    game.state.check_win_conditions()
+    game.state.legal_asks(game.asking_player_idx)
+    return game
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, nargs="+", default=[3, 5, 10, 20])
+    parser.add_argument("--games", type=int, default=3, help="games per player count")
+    parser.add_argument("--copies", type=int, default=50, help="copies of each game kept at once")
+    parser.add_argument("--max-turns", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("{:>3} {:>10} {:>10} {:>10}".format("n", "game B", "state B", "log B"))
+    for num_players in args.players:
+        games = []
+        states = []
+        logs = []
+        for game_id in range(args.games):
+            rng = random.Random("{}-{}-{}".format(args.seed, num_players, game_id))
+            # the copy taken halfway through the game
+            encoded = codec.encode_chat_data({ "game_obj": snapshots(num_players, rng, args.max_turns)[2] })
+            games.append(retained(lambda: loaded(encoded), args.copies))
+            states.append(retained(lambda: loaded(encoded).state, args.copies))
+            logs.append(retained(lambda: loaded(encoded).log, args.copies))
+        print("{:>3} {:>10.0f} {:>10.0f} {:>10.0f}".format(num_players,
+            statistics.mean(games), statistics.mean(states), statistics.mean(logs)))
+
+if __name__ == "__main__":
+    main()
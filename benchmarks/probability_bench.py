@@ -0,0 +1,139 @@
+"""
+Benchmarks and checks the card probabilities of probability.py.
+
+Usage (from the repository root):
+
+    python -m benchmarks.probability_bench --players 3 4 5
+    python -m benchmarks.probability_bench --verify 200
+
+The tables are those of random legal games (see game_state_bench), taken
+after a random number of moves. For each player count, the exact count and
+the sampling estimate (with --time-limit) are timed, and the estimate's
+largest error against the exact probabilities is reported.
+
+--verify instead compares the world count and every probability with a
+brute force enumeration of the worlds on that many random tables per player
+count, which is only feasible for small tables.
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import time
+
+from benchmarks.game_state_bench import random_game
+from game_state import NUM_PER_SUIT, GameState
+from probability import WorldCounter
+
+def random_table(num_players, rng):
+    """
+    Returns a GameState after a random number of moves of a random legal
+    game, deduced.
+    """
+    state = GameState(num_players)
+    for asker, target, suit, n in random_game(num_players, rng, rng.randrange(4 * num_players)):
+        state.asked_for(asker, suit)
+        state.gave_away(target, suit, n)
+        state.received(asker, suit, n)
+        state.deduce_extrema()
+    return state
+
+def brute_force_worlds(state):
+    """
+    Returns every world consistent with 'state' as a tuple of rows, by
+    dealing each player's hand over the suits in turn.
+    """
+    n = state.num_players
+    worlds = []
+    rows = []
+    def deal(player, left):
+        if player == n:
+            if not any(left):
+                worlds.append(tuple(rows))
+            return
+        row = [ 0 ] * n
+        def fill(suit, cards):
+            if suit == n:
+                if cards == 0:
+                    rows.append(tuple(row))
+                    deal(player + 1, [ l - r for l, r in zip(left, row) ])
+                    rows.pop()
+                return
+            for k in range(state.player_minimums[player][suit],
+                           min(state.player_maximums[player][suit], left[suit], cards) + 1):
+                row[suit] = k
+                fill(suit + 1, cards - k)
+            row[suit] = 0
+        fill(0, state.hand_sizes[player])
+    deal(0, [ NUM_PER_SUIT ] * n)
+    return worlds
+
+def verify(player_counts, tables, seed):
+    """
+    Compares WorldCounter with brute_force_worlds on random tables. Returns
+    the number of mismatching tables, printing them.
+    """
+    mismatches = 0
+    for num_players in player_counts:
+        for table in range(tables):
+            rng = random.Random("verify-{}-{}-{}".format(seed, num_players, table))
+            state = random_table(num_players, rng)
+            worlds = brute_force_worlds(state)
+            counter = WorldCounter(state)
+            count, probs = counter.count(), counter.probabilities()
+            expected = [ [ [ sum( world[player][suit] == k for world in worlds ) / len(worlds)
+                             for k in range(NUM_PER_SUIT + 1) ] for suit in range(num_players) ]
+                         for player in range(num_players) ]
+            error = max( abs(p - e) for row, expected_row in zip(probs, expected)
+                         for cell, expected_cell in zip(row, expected_row)
+                         for p, e in zip(cell, expected_cell) )
+            if count != len(worlds) or error > 1e-9:
+                mismatches += 1
+                print("n={} table={}: {} worlds instead of {}, probabilities off by {}".format(
+                    num_players, table, count, len(worlds), error), file=sys.stderr)
+        print("n={:<3} {} tables".format(num_players, tables))
+    return mismatches
+
+def run(player_counts, tables, time_limit, seed):
+    print("{:>3} {:>12} {:>12} {:>14} {:>10}".format("n", "exact ms", "worlds", "estimate ms", "max error"))
+    for num_players in player_counts:
+        exact_times, estimate_times, errors, worlds = [], [], [], []
+        for table in range(tables):
+            rng = random.Random("run-{}-{}-{}".format(seed, num_players, table))
+            state = random_table(num_players, rng)
+            start = time.perf_counter()
+            counter = WorldCounter(state)
+            exact = counter.probabilities()
+            exact_times.append(time.perf_counter() - start)
+            worlds.append(counter.count())
+            start = time.perf_counter()
+            estimate = WorldCounter(state).estimate_probabilities(time_limit, rng)
+            estimate_times.append(time.perf_counter() - start)
+            errors.append(max( abs(p - e) for row, estimate_row in zip(exact, estimate)
+                               for cell, estimate_cell in zip(row, estimate_row)
+                               for p, e in zip(cell, estimate_cell) ))
+        print("{:>3} {:>12.2f} {:>12.0f} {:>14.2f} {:>10.3f}".format(num_players,
+            statistics.median(exact_times) * 1e3, statistics.median(worlds),
+            statistics.median(estimate_times) * 1e3, max(errors)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, nargs="+", default=[3, 4, 5])
+    parser.add_argument("--tables", type=int, default=20, help="tables per player count")
+    parser.add_argument("--time-limit", type=float, default=0.1, help="seconds of sampling per estimate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verify", type=int, metavar="TABLES",
+        help="check against brute force on this many random tables per player count instead")
+    args = parser.parse_args()
+
+    if args.verify:
+        # brute force only finishes on small tables
+        mismatches = verify([ n for n in args.players if n <= 4 ] or [2, 3, 4], args.verify, args.seed)
+        print("{} mismatches".format(mismatches))
+        sys.exit(1 if mismatches else 0)
+
+    run(args.players, args.tables, args.time_limit, args.seed)
+
+if __name__ == "__main__":
+    main()
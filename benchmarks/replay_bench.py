@@ -0,0 +1,83 @@
+"""
+Benchmarks rebuilding games from their event logs.
+
+Usage (from the repository root):
+
+    python -m benchmarks.replay_bench --players 3 5 10 20
+
+Random legal games are played through Game, then rebuilt from their logs in
+three ways: from the start of the game (every event replayed), from the
+latest snapshot (as on load, at most game_log.SNAPSHOT_INTERVAL events
+replayed), and as an undo of the last move. The time to explain why a move
+is impossible, which replays the whole game, is reported too. Every rebuilt
+game is checked against the original.
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import time
+
+from benchmarks.codec_bench import game_fields, snapshots
+from game_log import GameLog
+from game_state import NUM_PER_SUIT
+
+def timed(fn):
+    start = time.perf_counter()
+    res = fn()
+    return res, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, nargs="+", default=[3, 5, 10, 20])
+    parser.add_argument("--games", type=int, default=10, help="games per player count")
+    parser.add_argument("--max-turns", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failures = 0
+    print("{:>3} {:>8} {:>16} {:>16} {:>12} {:>12}".format("n", "events", "full events/s",
+        "snapshot ms", "undo ms", "explain ms"))
+    for num_players in args.players:
+        events = []
+        full = []
+        latest = []
+        undo = []
+        explain = []
+        for game_id in range(args.games):
+            rng = random.Random("{}-{}-{}".format(args.seed, num_players, game_id))
+            game = snapshots(num_players, rng, args.max_turns)[-1]
+            log = game.log
+            if not log.events:
+                continue
+            expected = game_fields(game)
+            del expected["log"]
+
+            from_start = GameLog(log.game_id, { 0: log.snapshots[0] }, log.events)
+            rebuilt, seconds = timed(from_start.rebuild)
+            full.append(seconds)
+            events.append(len(log.events))
+            rebuilt_latest, seconds = timed(log.rebuild)
+            latest.append(seconds)
+            _, seconds = timed(lambda: log.rebuild(len(log.events) - 1))
+            undo.append(seconds)
+            _, seconds = timed(lambda: log.explain(0, 0, NUM_PER_SUIT, NUM_PER_SUIT))
+            explain.append(seconds)
+
+            for res in (rebuilt, rebuilt_latest):
+                fields = game_fields(res)
+                del fields["log"]
+                if fields != expected:
+                    print("replay mismatch: n={} game {}".format(num_players, game_id), file=sys.stderr)
+                    failures += 1
+
+        print("{:>3} {:>8.1f} {:>16.0f} {:>16.2f} {:>12.2f} {:>12.2f}".format(num_players,
+            statistics.mean(events), sum(events) / sum(full), statistics.mean(latest) * 1e3,
+            statistics.mean(undo) * 1e3, statistics.mean(explain) * 1e3))
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
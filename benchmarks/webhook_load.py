@@ -0,0 +1,404 @@
+"""
+End-to-end load test of the bot through its webhook.
+
+Usage (from the repository root):
+
+    python -m benchmarks.webhook_load --launch --chats 2000 --seconds 60
+
+With --launch, main.py is started with its Bot API pointed at a fake one in
+this process (benchmarks/fake_bot_api.py) and stopped at the end; SHARDS,
+WORKERS and DATABASE_URL are passed through from the environment, and
+without DATABASE_URL the bot keeps everything in memory. The bot's outbox
+doesn't limit its rates unless OUTBOX_RATE, OUTBOX_CHAT_RATE and
+OUTBOX_GROUP_RATE are set (and sends from 32 threads unless OUTBOX_SENDERS
+is); --flood-limit makes the fake Bot API refuse
+messages beyond that many a second to a chat with a 429. Without --launch,
+updates go to --webhook, whose bot must already use a fake Bot API on
+--api-port.
+
+Every chat plays for real: /newgame, --players joins and /startgame, then
+the moves the bot's replies call for (an /ask from the player whose turn it
+is, an /ihave from the player asked), with a /blame from a spectator now and
+then and a new game after each one ends. Every update gets exactly one
+reply, and a chat only sends its next update when the reply to the last one
+arrives, so --chats is the number of updates in flight. With --buttons,
+players press a random button of the last keyboard the bot sent instead of
+typing their move, whenever there is one; a rejected press is answered
+rather than replied to.
+
+Reports updates per second and the p50/p99 latency from posting an update
+to its reply reaching the fake Bot API. --save writes every update posted,
+one JSON object per line, and --replay posts such a file instead of
+playing, pairing each chat's replies with its updates in order.
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from benchmarks.fake_bot_api import FakeBotAPI
+
+TOKEN = "123456:loadtest"
+
+_TURN = re.compile(r"^It's \[[^]]*\]\(tg://user\?id=(\d+)\)'s turn!")
+_ASKED = re.compile(r'^[^:]*: "\[[^]]*\]\(tg://user\?id=(\d+)\), do you have any ')
+
+class Chat:
+    """
+    One simulated chat: its players, what the game is waiting for as far as
+    the replies tell, and the send times of its updates awaiting a reply.
+    """
+
+    def __init__(self, chat_id, user_ids, rng):
+        self.id = chat_id
+        self.user_ids = user_ids
+        self.rng = rng
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.joined = 0
+        # the user the game waits for, and whether with an /ask (or an /ihave)
+        self.waiting_for = None
+        self.asking = True
+        self.tries = 0
+        # the callback data of the buttons of the last keyboard sent
+        self.keyboard = []
+        self.moves = 0
+        self.rejected = 0
+
+    def first(self):
+        return self.user_ids[0], "/newgame"
+
+    def _move(self):
+        self.moves += 1
+        user = self.waiting_for
+        if self.asking:
+            others = [ other for other in self.user_ids if other != user ]
+            return user, "/ask u{} s{}".format(self.rng.choice(others), self.rng.randrange(len(self.user_ids)))
+        # the likely counts first
+        return user, "/ihave {}".format((0, 1, 2, 3, 4)[min(self.tries, 4)])
+
+    def next(self, text, spectators):
+        """
+        Returns the (user id, text) to send after the reply 'text'.
+        """
+        if text.startswith("Started new"):
+            self.joined = 0
+            return self.user_ids[0], "/joingame"
+        if text.startswith("Welcome"):
+            self.joined += 1
+            if self.joined < len(self.user_ids):
+                return self.user_ids[self.joined], "/joingame"
+            return self.user_ids[0], "/startgame"
+        if text.startswith("Game is over!"):
+            return self.user_ids[0], "/newgame"
+        match = _TURN.match(text)
+        if match:
+            self.waiting_for, self.asking, self.tries = int(match.group(1)), True, 0
+        else:
+            match = _ASKED.match(text)
+            if match:
+                self.waiting_for, self.asking, self.tries = int(match.group(1)), False, 0
+            else:
+                # a rejected move: try another one, or look at the board again
+                self.rejected += 1
+                self.tries += 1
+                if self.waiting_for is None or self.tries > 8:
+                    self.tries = 0
+                    return self.user_ids[0], "/blame"
+        if self.rng.random() < spectators:
+            return self.rng.choice(self.user_ids), "/blame"
+        return self._move()
+
+    def button(self):
+        """
+        Returns the callback data of a random button of the last keyboard, or
+        None.
+        """
+        return self.rng.choice(self.keyboard) if self.keyboard else None
+
+class LoadGenerator:
+    def __init__(self, webhook, connections, save=None):
+        parts = urlsplit(webhook)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path
+        self.chats = {}
+        self.latencies = []
+        self.sent = 0
+        self.replies = 0
+        self.unmatched = 0
+        self.failed = 0
+        self.stopping = False
+        self.save = save
+        self._update_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._outbox = queue.Queue()
+        self._senders = [ threading.Thread(target=self._send_loop, daemon=True) for _ in range(connections) ]
+        for thread in self._senders:
+            thread.start()
+
+    def message(self, chat, user_id, text):
+        """
+        Returns the update of 'user_id' sending 'text' in 'chat', as JSON.
+        """
+        update_id = next(self._update_ids)
+        command = text.split()[0]
+        return { "update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": { "id": chat.id, "type": "group", "title": "load test" },
+            "from": { "id": user_id, "is_bot": False, "first_name": "u{}".format(user_id) },
+            "entities": [ { "type": "bot_command", "offset": 0, "length": len(command) } ] } }
+
+    def press(self, chat, user_id, data):
+        """
+        Returns the update of 'user_id' pressing the button with callback
+        data 'data' in 'chat', as JSON. The query's id starts with the chat's,
+        for on_answer.
+        """
+        update_id = next(self._update_ids)
+        return { "update_id": update_id, "callback_query": {
+            "id": "{}:{}".format(chat.id, update_id), "chat_instance": str(chat.id), "data": data,
+            "from": { "id": user_id, "is_bot": False, "first_name": "u{}".format(user_id) },
+            "message": { "message_id": update_id, "date": int(time.time()),
+                         "chat": { "id": chat.id, "type": "group", "title": "load test" } } } }
+
+    def send(self, chat, update):
+        self._outbox.put((chat, json.dumps(update).encode("utf-8")))
+
+    def _send_loop(self):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        while True:
+            chat, body = self._outbox.get()
+            with chat.lock:
+                chat.pending.append(time.monotonic())
+            for attempt in (0, 1):
+                try:
+                    conn.request("POST", self.path, body, { "Content-Type": "application/json" })
+                    conn.getresponse().read()
+                    break
+                except (OSError, http.client.HTTPException):
+                    # the bot closed a kept-alive connection, or is stopping
+                    conn.close()
+            else:
+                with self._lock:
+                    self.failed += 1
+                continue
+            with self._lock:
+                self.sent += 1
+                if self.save is not None:
+                    self.save.write(body.decode("utf-8") + "\n")
+
+    def on_message(self, chat_id, text, received, reply_markup=None):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return
+        with chat.lock:
+            sent = chat.pending.popleft() if chat.pending else None
+        with self._lock:
+            self.replies += 1
+            if sent is None:
+                self.unmatched += 1
+            else:
+                self.latencies.append(received - sent)
+        return chat
+
+    def on_answer(self, query_id, text, received):
+        # a press that made a move gets an empty answer and the bot's next
+        # message; only a rejected one is answered with a text, its reply
+        if text is None:
+            return None
+        return LoadGenerator.on_message(self, int(query_id.split(":")[0]), text, received)
+
+class Player(LoadGenerator):
+    """
+    Plays --chats games in closed loop.
+    """
+
+    def __init__(self, webhook, connections, num_chats, num_players, spectators, seed, save=None, buttons=False):
+        super().__init__(webhook, connections, save)
+        self.spectators = spectators
+        self.buttons = buttons
+        rng = random.Random(seed)
+        for i in range(num_chats):
+            chat_id = -1000000000 - i
+            user_ids = [ (i + 1) * 100 + k for k in range(num_players) ]
+            self.chats[chat_id] = Chat(chat_id, user_ids, random.Random(rng.random()))
+
+    def start(self):
+        for chat in self.chats.values():
+            self.send(chat, self.message(chat, *chat.first()))
+
+    def on_message(self, chat_id, text, received, reply_markup=None):
+        chat = super().on_message(chat_id, text, received)
+        if chat is not None:
+            chat.keyboard = [ button["callback_data"] for row in (reply_markup or {}).get("inline_keyboard", [])
+                              for button in row if "callback_data" in button ]
+            self._reply(chat, text)
+
+    def on_answer(self, query_id, text, received):
+        chat = super().on_answer(query_id, text, received)
+        if chat is not None:
+            self._reply(chat, text)
+
+    def _reply(self, chat, text):
+        if self.stopping:
+            return
+        with chat.lock:
+            user_id, reply = chat.next(text, self.spectators)
+            data = chat.button() if self.buttons and reply.startswith(("/ask", "/ihave")) else None
+        if data is None:
+            self.send(chat, self.message(chat, user_id, reply))
+        else:
+            self.send(chat, self.press(chat, user_id, data))
+
+class Replayer(LoadGenerator):
+    """
+    Posts recorded updates, at most 'rate' per second.
+    """
+
+    def __init__(self, webhook, connections, path, rate):
+        super().__init__(webhook, connections)
+        with open(path) as f:
+            self.updates = [ json.loads(line) for line in f if line.strip() ]
+        self.rate = rate
+        for update in self.updates:
+            chat_id = self._chat_id(update)
+            if chat_id is not None and chat_id not in self.chats:
+                self.chats[chat_id] = Chat(chat_id, [], None)
+
+    @staticmethod
+    def _chat_id(update):
+        message = update.get("message") or update.get("callback_query", {}).get("message") or {}
+        return message.get("chat", {}).get("id")
+
+    def start(self):
+        threading.Thread(target=self._feed, daemon=True).start()
+
+    def _feed(self):
+        start = time.monotonic()
+        for i, update in enumerate(self.updates):
+            if self.stopping:
+                return
+            if self.rate:
+                delay = start + i / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            chat_id = self._chat_id(update)
+            self.send(self.chats.get(chat_id) or Chat(chat_id, [], None), update)
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else float("nan")
+
+def wait_for_port(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("the bot exited with {}".format(process.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("the bot did not open port {}".format(port))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--launch", action="store_true", help="start main.py against the fake Bot API")
+    parser.add_argument("--webhook", help="the bot's webhook URL, without --launch")
+    parser.add_argument("--port", type=int, default=8443, help="webhook port of the launched bot")
+    parser.add_argument("--api-port", type=int, default=0, help="port of the fake Bot API (any free one by default)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="milliseconds per sendMessage")
+    parser.add_argument("--flood-limit", type=int, default=0, help="messages a second to a chat before a 429")
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--spectators", type=float, default=0.05, help="chance of a /blame instead of a move")
+    parser.add_argument("--buttons", action="store_true", help="press the keyboards' buttons instead of typing moves")
+    parser.add_argument("--seconds", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds not counted at the start")
+    parser.add_argument("--connections", type=int, default=32, help="concurrent webhook requests")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show the launched bot's log")
+    parser.add_argument("--save", help="write the updates posted to this file")
+    parser.add_argument("--replay", help="post the updates in this file instead of playing")
+    parser.add_argument("--rate", type=float, default=0.0, help="updates per second to replay (0: as fast as possible)")
+    args = parser.parse_args()
+    if not args.launch and not args.webhook:
+        parser.error("one of --launch and --webhook is required")
+
+    save = open(args.save, "w") if args.save else None
+    webhook = args.webhook or "http://127.0.0.1:{}/{}".format(args.port, TOKEN)
+    if args.replay:
+        generator = Replayer(webhook, args.connections, args.replay, args.rate)
+    else:
+        generator = Player(webhook, args.connections, args.chats, args.players, args.spectators, args.seed, save,
+            args.buttons)
+    api = FakeBotAPI(args.api_latency / 1000, generator.on_message, flood_limit=args.flood_limit,
+        on_answer=generator.on_answer)
+    api_url = api.serve(args.api_port)
+
+    process = None
+    if args.launch:
+        env = dict(os.environ, BOT_TOKEN=TOKEN, BOT_USERNAME="@" + api.username, PORT=str(args.port),
+                   TELEGRAM_API_URL=api_url, WEBHOOK_URL="http://127.0.0.1:{}/".format(args.port))
+        for name in ("OUTBOX_RATE", "OUTBOX_CHAT_RATE", "OUTBOX_GROUP_RATE"):
+            env.setdefault(name, "0")
+        # enough messages in flight for the rates above
+        env.setdefault("OUTBOX_SENDERS", "32")
+        output = None if args.verbose else subprocess.DEVNULL
+        process = subprocess.Popen([ sys.executable, "main.py" ], env=env, stdout=output, stderr=output,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        wait_for_port(args.port, process)
+    print("fake Bot API at {}, posting to {}".format(api_url, webhook), file=sys.stderr)
+
+    try:
+        generator.start()
+        time.sleep(args.warmup)
+        with generator._lock:
+            sent, replies, counted = generator.sent, generator.replies, len(generator.latencies)
+        start = time.monotonic()
+        time.sleep(args.seconds)
+        with generator._lock:
+            sent, replies = generator.sent - sent, generator.replies - replies
+            failed = generator.failed
+            latencies = sorted(generator.latencies[counted:])
+        elapsed = time.monotonic() - start
+        generator.stopping = True
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            process.wait(60)
+        api.shutdown()
+        if save is not None:
+            save.close()
+
+    print("updates posted:   {:>10.1f} /s".format(sent / elapsed))
+    print("replies:          {:>10.1f} /s".format(replies / elapsed))
+    print("latency:          p50 {:.1f} ms, p99 {:.1f} ms".format(
+        percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3))
+    if failed:
+        print("updates the bot did not take: {}".format(failed))
+    moves = sum( chat.moves for chat in generator.chats.values() )
+    if moves:
+        print("moves rejected:   {:>10} of {}".format(sum( chat.rejected for chat in generator.chats.values() ), moves))
+    if generator.unmatched:
+        print("replies without a pending update: {}".format(generator.unmatched))
+    for method, (count, seconds) in sorted(api.summary().items()):
+        print("Bot API {:<12} {:>8} calls, {:.2f} ms each".format(method, count, seconds * 1e3))
+    if api.flooded:
+        print("Bot API 429s       {:>8}".format(api.flooded))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""
+Compact binary encoding of chat data holding Quantum Go Fish games.
+
+Pickle ties stored rows to the class layout of Game, Player and GameState
+and spends most of its bytes on attribute names. This codec writes only the
+values, in a fixed order:
+
+    chat data:  magic "QG", u8 format version, u16 entry count, then per entry
+                a string key, a u8 tag and a u32-length payload (an encoded
+                Game for TAG_GAME, a pickle for anything else)
+    Game:       u8 status, u8 started, i16 asking/target player and
+                requested suit indices (-1 for None), u16 player count, i64
+                id of every player, player names, suit names, optional win
+                info string, optional GameState
+    GameState:  u16 players, u8 backend, i16 last actor, u32 version, u16 hand
+                size per player, then one byte per (player, suit) cell holding
+                the minimum in the low and the maximum in the high nibble
+
+Since format version 2, every Game is followed by its log: u8 mode, then for
+LOG_INLINE an i64 game id, u32 event count, the start snapshot and every
+event; for LOG_EXTERNAL an i64 game id, the u32 number of events the game is
+a snapshot after, and the start snapshot. Snapshots and events are u32-length
+blobs holding a Game (without log) and an event as encoded below.
+
+A string is a u16 byte length followed by UTF-8; a list of strings is a u16
+count, the u16 length in characters of each string, a u32 byte length and all
+of them concatenated in UTF-8. Everything is little endian.
+
+Every layout ever written keeps its reader in _READERS, keyed by format
+version, so rows written by an older version of the bot still decode; to
+change the layout, bump VERSION and add a reader for it. Rows that don't
+start with the magic are pickles written before this codec existed and are
+unpickled.
+"""
+
+import pickle
+import struct
+
+# imported as modules, since game imports game_log, which imports this module
+import game as game_module
+import game_log
+from game_state import GameState, NUM_PER_SUIT
+
+MAGIC = b"QG"
+VERSION = 2
+
+TAG_GAME = 0
+TAG_PICKLE = 1
+
+BACKEND_PYTHON = 0
+BACKEND_NUMPY = 1
+
+LOG_NONE = 0
+LOG_INLINE = 1
+LOG_EXTERNAL = 2
+
+_HEADER = struct.Struct("<2sB")
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_GAME_FIELDS = struct.Struct("<BBhhh")
+_STATE_FIELDS = struct.Struct("<HBhI")
+_LOG_FIELDS = struct.Struct("<qI")
+_EVENT_FIELDS = struct.Struct("<BHH")
+
+class CodecError(ValueError):
+    pass
+
+class _Reader:
+    """
+    Cursor over an encoded buffer.
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def unpack(self, fmt):
+        res = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return res
+
+    def take(self, n):
+        if self.pos + n > len(self.data):
+            raise CodecError("truncated data")
+        res = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return res
+
+    def string(self):
+        n, = self.unpack(_U16)
+        return str(self.take(n), "utf-8")
+
+    def strings(self):
+        count, = self.unpack(_U16)
+        lengths = self.unpack(struct.Struct("<{}H".format(count)))
+        size, = self.unpack(_U32)
+        text = str(self.take(size), "utf-8")
+        res = []
+        pos = 0
+        for length in lengths:
+            res.append(text[pos:pos + length])
+            pos += length
+        return res
+
+    def optional_string(self):
+        present, = self.unpack(_U8)
+        return self.string() if present else None
+
+    def blob(self):
+        n, = self.unpack(_U32)
+        return bytes(self.take(n))
+
+def _string(out, s):
+    data = s.encode("utf-8")
+    out += _U16.pack(len(data))
+    out += data
+
+def _strings(out, strings):
+    # one UTF-8 blob, sliced by the lengths in characters when read
+    data = "".join(strings).encode("utf-8")
+    out += _U16.pack(len(strings))
+    out += struct.pack("<{}H".format(len(strings)), *[ len(s) for s in strings ])
+    out += _U32.pack(len(data))
+    out += data
+
+def _blob(out, data):
+    out += _U32.pack(len(data))
+    out += data
+
+def _optional_string(out, s):
+    if s is None:
+        out += _U8.pack(0)
+    else:
+        out += _U8.pack(1)
+        _string(out, s)
+
+def _index(i):
+    return -1 if i is None else i
+
+_LOW_NIBBLES = bytes( i & 0xf for i in range(256) )
+_HIGH_NIBBLES = bytes( i >> 4 for i in range(256) )
+
+def _write_state(out, state):
+    n = state.num_players
+    if isinstance(state, GameState):
+        out += _STATE_FIELDS.pack(n, BACKEND_PYTHON, _index(state.last_actor), state.version)
+        out += struct.pack("<{}H".format(n), *state.hand_sizes)
+        for low, high in zip(state.player_minimums, state.player_maximums):
+            out += bytes( a | b << 4 for a, b in zip(low, high) )
+    else:
+        out += _STATE_FIELDS.pack(n, BACKEND_NUMPY, _index(state.last_actor), state.version)
+        out += state.hand_sizes.astype("<u2").tobytes()
+        out += (state.player_minimums | state.player_maximums << 4).astype("u1").tobytes()
+
+def _read_state(reader):
+    n, backend, last_actor, version = reader.unpack(_STATE_FIELDS)
+    hand_sizes = list(reader.unpack(struct.Struct("<{}H".format(n))))
+    cells = bytes(reader.take(n * n))
+    low = list(cells.translate(_LOW_NIBBLES))
+    high = list(cells.translate(_HIGH_NIBBLES))
+    if n and max(high) > NUM_PER_SUIT:
+        raise CodecError("bound out of range")
+    mins = [ low[start:start + n] for start in range(0, n * n, n) ]
+    maxs = [ high[start:start + n] for start in range(0, n * n, n) ]
+
+    if backend == BACKEND_PYTHON:
+        state = GameState.from_bounds(mins, maxs, hand_sizes)
+    elif backend == BACKEND_NUMPY:
+        from game_state_numpy import NumpyGameState
+        state = NumpyGameState(n)
+        state.player_minimums[:] = mins
+        state.player_maximums[:] = maxs
+        state.hand_sizes[:] = hand_sizes
+    else:
+        raise CodecError("unknown GameState backend {}".format(backend))
+    state.last_actor = None if last_actor < 0 else last_actor
+    state.version = version
+    return state
+
+def _write_game(out, game):
+    out += _GAME_FIELDS.pack(game.status.value, game.started, _index(game.asking_player_idx),
+        _index(game.target_player_idx), _index(game.requested_suit_idx))
+    out += _U16.pack(len(game.players))
+    out += struct.pack("<{}q".format(len(game.players)), *[ player.id for player in game.players ])
+    _strings(out, [ player.name for player in game.players ])
+    _strings(out, game.suit_names)
+    _optional_string(out, getattr(game, "win_info", None))
+    state = getattr(game, "state", None)
+    out += _U8.pack(state is not None)
+    if state is not None:
+        _write_state(out, state)
+
+def _read_game(reader):
+    game = game_module.Game()
+    status, started, asking, target, suit = reader.unpack(_GAME_FIELDS)
+    game.status = game_module.GameStatus(status)
+    game.started = bool(started)
+
+    num_players, = reader.unpack(_U16)
+    ids = reader.unpack(struct.Struct("<{}q".format(num_players)))
+    game.players = [ game_module.Player(player_id, name) for player_id, name in zip(ids, reader.strings()) ]
+    game.suit_names = reader.strings()
+
+    # the player and suit attributes that duplicate an index are rebuilt from it
+    if asking >= 0:
+        game.asking_player_idx = asking
+        game.asking_player = game.players[asking]
+    if target >= 0:
+        game.target_player_idx = target
+        game.target_player = game.players[target]
+    if suit >= 0:
+        game.requested_suit_idx = suit
+        game.requested_suit = game.suit_names[suit]
+    if game.started:
+        game.num_players = num_players
+
+    win_info = reader.optional_string()
+    if win_info is not None:
+        game.win_info = win_info
+    has_state, = reader.unpack(_U8)
+    if has_state:
+        game.state = _read_state(reader)
+    return game
+
+def _with_names(body, players):
+    """
+    Returns the encoded Game 'body' with the names of 'players', who are its
+    players in the same order; the rest of the body is copied as it is.
+    """
+    reader = _Reader(body)
+    reader.unpack(_GAME_FIELDS)
+    num_players, = reader.unpack(_U16)
+    reader.take(8 * num_players)
+    start = reader.pos
+    names = [ player.name for player in players ]
+    if reader.strings() == names:
+        return body
+    out = bytearray(body[:start])
+    _strings(out, names)
+    out += body[reader.pos:]
+    return bytes(out)
+
+def _write_log(out, game, external_events):
+    log = game.log
+    if log is None:
+        out += _U8.pack(LOG_NONE)
+    elif external_events:
+        out += _U8.pack(LOG_EXTERNAL)
+        out += _LOG_FIELDS.pack(log.game_id, log.snapshot_seq)
+        _blob(out, log.snapshots[0])
+    else:
+        out += _U8.pack(LOG_INLINE)
+        out += _LOG_FIELDS.pack(log.game_id, len(log.events))
+        _blob(out, log.snapshots[0])
+        for event in log.events:
+            _blob(out, event)
+
+def _read_logged_game(reader):
+    """
+    Reads a Game followed by its log section (format version 2 and later).
+    """
+    start = reader.pos
+    game = _read_game(reader)
+    body = bytes(reader.data[start:reader.pos])
+    mode, = reader.unpack(_U8)
+    if mode == LOG_NONE:
+        return game
+    game_id, count = reader.unpack(_LOG_FIELDS)
+    snapshots = { 0: reader.blob() }
+    if mode == LOG_INLINE:
+        game.log = game_log.GameLog(game_id, snapshots, [ reader.blob() for _ in range(count) ])
+    elif mode == LOG_EXTERNAL:
+        # 'game' is the snapshot after event 'count'; the events themselves
+        # are stored elsewhere and replayed by whoever stores them
+        snapshots[count] = body
+        game.log = game_log.GameLog(game_id, snapshots, [])
+    else:
+        raise CodecError("unknown log mode {}".format(mode))
+    return game
+
+def _read_entries(reader, read_game):
+    res = {}
+    count, = reader.unpack(_U16)
+    for _ in range(count):
+        key = reader.string()
+        tag, = reader.unpack(_U8)
+        size, = reader.unpack(_U32)
+        end = reader.pos + size
+        if tag == TAG_GAME:
+            res[key] = read_game(reader)
+        elif tag == TAG_PICKLE:
+            res[key] = pickle.loads(reader.take(size))
+        else:
+            raise CodecError("unknown tag {}".format(tag))
+        if reader.pos != end:
+            raise CodecError("entry {!r} has the wrong length".format(key))
+    return res
+
+def _read_chat_data_v1(reader):
+    return _read_entries(reader, _read_game)
+
+def _read_chat_data_v2(reader):
+    return _read_entries(reader, _read_logged_game)
+
+_READERS = {
+    1: _read_chat_data_v1,
+    2: _read_chat_data_v2,
+}
+
+def encode_chat_data(chat_data, external_events=False):
+    """
+    Encodes a chat data dict. Game values use the compact layout, anything
+    else is pickled. Dicts with non-string keys are pickled whole.
+
+    A game's event log is included, unless 'external_events' is set: then
+    the game is written as of its latest snapshot, but with its players'
+    current names, and the events after it have to be stored and replayed
+    separately (see game_log.GameEvents).
+    """
+    if not all( isinstance(key, str) for key in chat_data ):
+        return pickle.dumps(chat_data, pickle.HIGHEST_PROTOCOL)
+    out = bytearray(_HEADER.pack(MAGIC, VERSION))
+    out += _U16.pack(len(chat_data))
+    for key, value in chat_data.items():
+        _string(out, key)
+        if type(value) is game_module.Game:
+            entry = bytearray()
+            if external_events and value.log is not None:
+                # players can be renamed after the snapshot, and no event
+                # says so
+                entry += _with_names(value.log.snapshots[value.log.snapshot_seq], value.players)
+            else:
+                _write_game(entry, value)
+            _write_log(entry, value, external_events)
+            out += _U8.pack(TAG_GAME)
+        else:
+            entry = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            out += _U8.pack(TAG_PICKLE)
+        out += _U32.pack(len(entry))
+        out += entry
+    return bytes(out)
+
+def decode_chat_data(data):
+    """
+    Decodes chat data written by encode_chat_data in any format version, or
+    pickled by an older version of the bot.
+    """
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        return pickle.loads(data)
+    reader = _Reader(data)
+    _, version = reader.unpack(_HEADER)
+    if version not in _READERS:
+        raise CodecError("unknown chat data format version {}".format(version))
+    try:
+        return _READERS[version](reader)
+    except (struct.error, IndexError, UnicodeDecodeError) as exc:
+        raise CodecError("corrupt chat data") from exc
+
+def encode_game(game):
+    """
+    Encodes a single Game, as stored under a chat data key.
+    """
+    return encode_chat_data({ "game_obj": game })
+
+def decode_game(data):
+    return decode_chat_data(data)["game_obj"]
+
+def encode_game_body(game):
+    """
+    Encodes a Game without its log, as used for snapshots.
+    """
+    out = bytearray()
+    _write_game(out, game)
+    return bytes(out)
+
+def decode_game_body(data):
+    return _read_game(_Reader(data))
+
+def encode_event(event):
+    """
+    Encodes a game_log.Event: u8 kind, u16 player, u16 target player (asks)
+    or number of cards (responses), then the suit name for asks.
+    """
+    if event.kind == game_log.ASK:
+        out = bytearray(_EVENT_FIELDS.pack(event.kind, event.player, event.target))
+        _string(out, event.suit)
+        return bytes(out)
+    return _EVENT_FIELDS.pack(event.kind, event.player, event.n)
+
+def decode_event(data):
+    reader = _Reader(data)
+    kind, player, arg = reader.unpack(_EVENT_FIELDS)
+    if kind == game_log.ASK:
+        return game_log.Event(kind, player, arg, reader.string(), None)
+    return game_log.Event(kind, player, None, None, arg)
@@ -0,0 +1,122 @@
+"""
+Runs handlers for different chats in parallel and those for one chat in order.
+
+Handlers registered through ChatQueues.serialized() no longer run on the
+dispatcher thread. Each update is appended to its chat's queue, and a chat
+with queued updates is drained by one job on the dispatcher's worker pool
+(Dispatcher.run_async) at a time. So a slow deduction or Telegram round
+trip in one chat only delays that chat, while the moves of a chat are still
+applied one at a time in the order they arrived, and a handler never sees
+its chat's Game half-changed by another.
+
+Code outside the handlers that changes a chat's data (see eviction.py) uses
+idle() to keep the chat's handlers from running meanwhile.
+"""
+
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+class _Chat:
+    __slots__ = ("pending", "running")
+
+    def __init__(self):
+        # (callback, update, context) waiting to run, oldest first
+        self.pending = deque()
+        # whether a job is draining the queue, or idle() holds the chat
+        self.running = False
+
+class ChatQueues:
+    """
+    Per-chat serial queues of handler callbacks, drained on the worker pool of
+    'dispatcher'.
+    """
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        # only chats with something queued or running have an entry
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def serialized(self, fn):
+        """
+        Wraps the handler callback 'fn' to be run in its chat's queue rather
+        than on the dispatcher thread. Updates without a chat run right away
+        on the worker pool.
+        """
+        def wrapper(update, context):
+            chat = getattr(update, "effective_chat", None)
+            if chat is None:
+                self.dispatcher.run_async(fn, update, context, update=update)
+                return
+            with self._lock:
+                entry = self._chats.get(chat.id)
+                if entry is None:
+                    entry = self._chats[chat.id] = _Chat()
+                entry.pending.append((fn, update, context))
+                if entry.running:
+                    return
+                entry.running = True
+            self.dispatcher.run_async(self._drain, chat.id, entry)
+        wrapper.__name__ = getattr(fn, "__name__", "handler")
+        return wrapper
+
+    def _drain(self, chat_id, entry):
+        while True:
+            with self._lock:
+                if not entry.pending:
+                    entry.running = False
+                    del self._chats[chat_id]
+                    return
+                fn, update, context = entry.pending.popleft()
+            try:
+                fn(update, context)
+            except Exception as error:
+                # what the dispatcher does for a handler that raises
+                try:
+                    self.dispatcher.dispatch_error(update, error)
+                except Exception:
+                    logging.getLogger(__name__).exception("error handler failed")
+            # the dispatcher can't know when a queued handler is done, so the
+            # chat's changes are handed to the persistence here
+            self.dispatcher.update_persistence(update=update)
+
+    def depth(self):
+        """
+        Returns the number of updates waiting in all chats' queues.
+        """
+        with self._lock:
+            return sum( len(entry.pending) for entry in self._chats.values() )
+
+    def busy_chats(self):
+        """
+        Returns the number of chats with a handler queued or running.
+        """
+        with self._lock:
+            return len(self._chats)
+
+    @contextmanager
+    def idle(self, chat_id):
+        """
+        Yields True if chat 'chat_id' has nothing queued or running, in which
+        case its handlers wait until the block ends; yields False otherwise.
+        """
+        with self._lock:
+            if chat_id in self._chats:
+                held = False
+            else:
+                held = True
+                entry = self._chats[chat_id] = _Chat()
+                entry.running = True
+        try:
+            yield held
+        finally:
+            if held:
+                with self._lock:
+                    restart = bool(entry.pending)
+                    if not restart:
+                        entry.running = False
+                        del self._chats[chat_id]
+                if restart:
+                    self.dispatcher.run_async(self._drain, chat_id, entry)
@@ -0,0 +1,136 @@
+"""
+Eviction of finished and idle games from chat data into cold storage.
+
+Every chat that ever ran /newgame keeps its Game in chat data, so without
+this memory use and the chat rows would grow with every game ever played.
+GameEviction archives a game (encoded with its whole log, see codec.py)
+through PostgresPersistence.archive and drops it from the chat data once the
+chat has seen no update for a while: 'finished_ttl' seconds for a game that
+is over, 'idle_ttl' seconds for any other. If more than 'max_games' games
+are still in memory after that, the least recently used ones go too.
+
+The next update in a chat whose game was archived brings the game back
+before any handler runs, so /blame, /listplayers and the rest see it as if
+it had never left.
+"""
+
+import logging
+import threading
+import time
+
+import codec
+import instrumentation
+from game import GameStatus
+
+class GameEviction:
+    """
+    Register touch() as a TypeHandler(Update, ...) in a group that runs
+    before every other handler, and run evict() as a repeating job. If the
+    handlers run in 'chats' (a concurrency.ChatQueues), touch() has to as
+    well, and a game is only evicted while its chat has none queued.
+    """
+
+    def __init__(self, persistence, finished_ttl=3600.0, idle_ttl=7 * 86400.0, max_games=None, key="game_obj",
+                 chats=None):
+        self.persistence = persistence
+        self.finished_ttl = finished_ttl
+        self.idle_ttl = idle_ttl
+        self.max_games = max_games
+        self.key = key
+        # the concurrency.ChatQueues the handlers run in, if any
+        self.chats = chats
+        # monotonic time of the last update in every chat with a game in
+        # memory; chats seen by evict() first are counted from then
+        self._last_seen = {}
+        # ids of the chats with an archived game, read on first use
+        self._archived = None
+        self._lock = threading.Lock()
+
+    def _archived_ids(self):
+        with self._lock:
+            if self._archived is None:
+                self._archived = self.persistence.archived_chat_ids(self.key)
+            return self._archived
+
+    def touch(self, update, context):
+        """
+        Notes that the chat of 'update' is in use, and restores its archived
+        game if it has none in memory.
+        """
+        chat = update.effective_chat
+        if chat is None:
+            return
+        self._last_seen[chat.id] = time.monotonic()
+        if self.key not in context.chat_data and chat.id in self._archived_ids():
+            self.restore(chat.id, context.chat_data)
+
+    def restore(self, chat_id, chat_data):
+        data = self.persistence.load_archived(chat_id, self.key)
+        if data is None:
+            self._archived_ids().discard(chat_id)
+            return
+        # the dispatcher writes the chat data back after the update
+        chat_data[self.key] = codec.decode_chat_data(data)[self.key]
+        instrumentation.GAMES_RESTORED.inc()
+        logging.getLogger(__name__).info("restored the archived game of chat %d", chat_id)
+
+    def evict(self, context):
+        """
+        Job callback: archives and drops every game past its TTL, then the
+        least recently used ones over max_games. Returns how many went.
+        """
+        now = time.monotonic()
+        expired = []
+        kept = []
+        with_games = set()
+        for chat_id, chat_data in list(context.dispatcher.chat_data.items()):
+            game = chat_data.get(self.key)
+            if game is None:
+                continue
+            with_games.add(chat_id)
+            seen = self._last_seen.setdefault(chat_id, now)
+            if game.status == GameStatus.GAME_OVER:
+                reason, ttl = "finished", self.finished_ttl
+            else:
+                reason, ttl = "idle", self.idle_ttl
+            if now - seen >= ttl:
+                expired.append((reason, chat_id, chat_data, game, seen))
+            else:
+                kept.append((seen, chat_id, chat_data, game))
+        # chats without a game in memory are counted from their next update
+        for chat_id in list(self._last_seen):
+            if chat_id not in with_games:
+                self._last_seen.pop(chat_id, None)
+        if self.max_games is not None and len(kept) > self.max_games:
+            kept.sort(key=lambda entry: entry[0])
+            expired.extend( ("lru", chat_id, chat_data, game, seen)
+                            for seen, chat_id, chat_data, game in kept[:len(kept) - self.max_games] )
+
+        res = 0
+        for reason, chat_id, chat_data, game, seen in expired:
+            if self._evict(chat_id, chat_data, game, seen):
+                instrumentation.GAMES_EVICTED.inc(reason)
+                res += 1
+        if res:
+            logging.getLogger(__name__).info("archived %d games", res)
+        return res
+
+    def _evict(self, chat_id, chat_data, game, seen):
+        if self.chats is None:
+            return self._evict_idle(chat_id, chat_data, game, seen)
+        # a chat with handlers queued or running is in use, whatever its
+        # last update says
+        with self.chats.idle(chat_id) as idle:
+            return idle and self._evict_idle(chat_id, chat_data, game, seen)
+
+    def _evict_idle(self, chat_id, chat_data, game, seen):
+        # archived before it leaves the chat data, which is only written later
+        self.persistence.archive(chat_id, self.key, codec.encode_chat_data({ self.key: game }))
+        self._archived_ids().add(chat_id)
+        # an update that arrived meanwhile keeps the game in memory
+        if self._last_seen.get(chat_id) != seen or chat_data.get(self.key) is not game:
+            return False
+        del chat_data[self.key]
+        self._last_seen.pop(chat_id, None)
+        self.persistence.update_chat_data(chat_id, chat_data)
+        return True
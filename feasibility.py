@@ -0,0 +1,311 @@
+from collections import deque
+from operator import gt
+
+class CardFlow:
+    """
+    Exact consistency checking for a game of Quantum Go Fish.
+
+    A set of bounds is consistent iff some assignment x[player][suit] of cards
+    to hands exists with minimums <= x <= maximums, every row summing to that
+    player's hand size and every column summing to num_per_suit. That is a
+    bounded transportation problem, i.e. a flow from players to suits with
+    lower and upper capacities on every edge.
+
+    The current assignment is kept between calls: when the bounds change, it
+    is clamped into the new bounds and only the resulting imbalance is
+    repaired with augmenting paths, so the cost of a call depends on how much
+    the bounds moved rather than on the size of the table.
+    """
+
+    __slots__ = ("num_players", "num_per_suit", "flow")
+
+    def __init__(self, num_players, num_per_suit):
+        self.num_players = num_players
+        self.num_per_suit = num_per_suit
+        # one bytearray per player: no cell ever exceeds num_per_suit
+        self.flow = [ bytearray(num_players) for _ in range(num_players) ]
+
+    def is_feasible(self, minimums, maximums, hand_sizes):
+        """
+        Returns whether any assignment of cards satisfies the given bounds. If
+        so, self.flow is left holding one.
+        """
+        return self._repair(minimums, maximums, hand_sizes)
+
+    def is_feasible_with(self, minimums, maximums, hand_sizes, player, suit, low, high):
+        """
+        Like is_feasible, but additionally requires that 'player' holds
+        between 'low' and 'high' cards of suit 'suit'.
+        """
+        minimums = list(minimums)
+        maximums = list(maximums)
+        minimums[player] = list(minimums[player])
+        maximums[player] = list(maximums[player])
+        minimums[player][suit] = max(minimums[player][suit], low)
+        maximums[player][suit] = min(maximums[player][suit], high)
+        return self._repair(minimums, maximums, hand_sizes)
+
+    def tightest_bounds(self, minimums, maximums, hand_sizes):
+        """
+        Returns (mins, maxs), the smallest and largest number of cards of each
+        suit each player holds in any consistent assignment, or None if there
+        is no consistent assignment at all.
+        """
+        if not self._repair(minimums, maximums, hand_sizes):
+            return None
+
+        n = self.num_players
+        x = self.flow
+        component = self._components(minimums, maximums)
+        # a bound is settled once some consistent assignment reaches the
+        # interval bound (the exact bound can't be any looser), or once the
+        # cell can't be pushed any further
+        max_known = [ [ x[player][suit] == maximums[player][suit] for suit in range(n) ] for player in range(n) ]
+        min_known = [ [ x[player][suit] == minimums[player][suit] for suit in range(n) ] for player in range(n) ]
+        tight_mins = [ row[:] for row in minimums ]
+        tight_maxs = [ row[:] for row in maximums ]
+
+        def push(player, suit, start, goal, step):
+            # move one unit around a residual cycle through (player, suit)
+            path = self._path(minimums, maximums, start, goal, (player, suit))
+            if path is None:
+                return False
+            x[player][suit] += step
+            self._augment(path)
+            for u, v in zip(path, path[1:]):
+                row, col = (u, v - n) if u < n else (v, u - n)
+                if x[row][col] == maximums[row][col]:
+                    max_known[row][col] = True
+                if x[row][col] == minimums[row][col]:
+                    min_known[row][col] = True
+            return True
+
+        for player in range(n):
+            for suit in range(n):
+                # a cell can only move if its player and suit lie on a common
+                # residual cycle; everything else is fixed at its current value
+                if component[player] != component[n + suit]:
+                    tight_mins[player][suit] = tight_maxs[player][suit] = x[player][suit]
+                    continue
+                if not max_known[player][suit]:
+                    while x[player][suit] < maximums[player][suit]:
+                        if not push(player, suit, n + suit, player, 1):
+                            tight_maxs[player][suit] = x[player][suit]
+                            break
+                if not min_known[player][suit]:
+                    while x[player][suit] > minimums[player][suit]:
+                        if not push(player, suit, player, n + suit, -1):
+                            tight_mins[player][suit] = x[player][suit]
+                            break
+                max_known[player][suit] = min_known[player][suit] = True
+        return tight_mins, tight_maxs
+
+    def free_cells(self, minimums, maximums, hand_sizes):
+        """
+        Returns None if there is no consistent assignment, or else one
+        bytearray per player marking the cells that take some other value in
+        another consistent assignment, i.e. those whose tightest bounds
+        differ. self.flow is left holding a consistent assignment.
+
+        A cell can change iff a residual cycle runs through it. Where the
+        cell's flow sits at one of its bounds, that is just its player and
+        suit sharing a strongly connected component, so one pass over the
+        table settles it; only cells strictly inside their bounds (the
+        component may then close through the cell itself) need a search.
+        """
+        if not self._repair(minimums, maximums, hand_sizes):
+            return None
+        n = self.num_players
+        x = self.flow
+        component = self._components(minimums, maximums)
+        free = [ bytearray(n) for _ in range(n) ]
+        for player in range(n):
+            for suit in range(n):
+                low = minimums[player][suit]
+                high = maximums[player][suit]
+                if low == high or component[player] != component[n + suit]:
+                    continue
+                if low < x[player][suit] < high:
+                    free[player][suit] = self._path(minimums, maximums, n + suit, player, (player, suit)) is not None
+                else:
+                    free[player][suit] = 1
+        return free
+
+    def cell_bounds(self, minimums, maximums, hand_sizes, player, suit):
+        """
+        Returns (low, high), the smallest and largest number of cards of suit
+        'suit' that 'player' holds in any consistent assignment, or None if
+        there is no consistent assignment at all. Only that one cell is pushed
+        around residual cycles, so this is tightest_bounds for a single cell.
+        """
+        if not self._repair(minimums, maximums, hand_sizes):
+            return None
+        n = self.num_players
+        x = self.flow
+        cell = (player, suit)
+        while x[player][suit] < maximums[player][suit]:
+            path = self._path(minimums, maximums, n + suit, player, cell)
+            if path is None:
+                break
+            x[player][suit] += 1
+            self._augment(path)
+        high = x[player][suit]
+        while x[player][suit] > minimums[player][suit]:
+            path = self._path(minimums, maximums, player, n + suit, cell)
+            if path is None:
+                break
+            x[player][suit] -= 1
+            self._augment(path)
+        return x[player][suit], high
+
+    # Nodes 0..n-1 are players and n..2n-1 are suits. The residual graph has
+    # an edge player -> suit where the flow can grow and suit -> player where
+    # it can shrink.
+
+    def _neighbors(self, minimums, maximums, node):
+        n = self.num_players
+        x = self.flow
+        if node < n:
+            row = x[node]
+            upper = maximums[node]
+            return [ n + suit for suit in range(n) if row[suit] < upper[suit] ]
+        else:
+            suit = node - n
+            return [ player for player in range(n) if x[player][suit] > minimums[player][suit] ]
+
+    def _augment(self, path):
+        n = self.num_players
+        for u, v in zip(path, path[1:]):
+            if u < n:
+                self.flow[u][v - n] += 1
+            else:
+                self.flow[v][u - n] -= 1
+
+    def _path(self, minimums, maximums, start, goal, excluded):
+        """
+        Breadth-first search for a residual path from 'start' to 'goal' that
+        does not use the cell 'excluded' (in either direction). Returns the
+        list of nodes on the path or None.
+        """
+        n = self.num_players
+        x = self.flow
+        excluded_player, excluded_suit = excluded
+        parent = [ None ] * (2 * n)
+        parent[start] = start
+        queue = deque([start])
+        while queue and parent[goal] is None:
+            node = queue.popleft()
+            if node < n:
+                row = x[node]
+                upper = maximums[node]
+                for suit in range(n):
+                    nxt = n + suit
+                    if parent[nxt] is None and row[suit] < upper[suit] and \
+                            not (node == excluded_player and suit == excluded_suit):
+                        parent[nxt] = node
+                        if nxt == goal:
+                            break
+                        queue.append(nxt)
+            else:
+                suit = node - n
+                for player in range(n):
+                    if parent[player] is None and x[player][suit] > minimums[player][suit] and \
+                            not (player == excluded_player and suit == excluded_suit):
+                        parent[player] = node
+                        if player == goal:
+                            break
+                        queue.append(player)
+        if parent[goal] is None:
+            return None
+        path = [ goal ]
+        while path[-1] != start:
+            path.append(parent[path[-1]])
+        return path[::-1]
+
+    def _repair(self, minimums, maximums, hand_sizes):
+        n = self.num_players
+        x = self.flow
+        if sum(hand_sizes) != n * self.num_per_suit:
+            return False
+        # row at a time with map, since every check and move clamps the table
+        for player in range(n):
+            if any(map(gt, minimums[player], maximums[player])):
+                return False
+            x[player] = bytearray(map(min, map(max, x[player], minimums[player]), maximums[player]))
+
+        # excess[node] > 0: a player who must hand out more cards, or a suit
+        # with too many cards placed. excess[node] < 0: the reverse.
+        excess = [ hand_sizes[player] - sum(x[player]) for player in range(n) ] + \
+            [ total - self.num_per_suit for total in map(sum, zip(*x)) ]
+
+        while True:
+            sources = [ node for node in range(2 * n) if excess[node] > 0 ]
+            if not sources:
+                return True
+            path = self._path_to_deficit(minimums, maximums, sources, excess)
+            if path is None:
+                return False
+            self._augment(path)
+            excess[path[0]] -= 1
+            excess[path[-1]] += 1
+
+    def _path_to_deficit(self, minimums, maximums, sources, excess):
+        parent = { source: None for source in sources }
+        queue = deque(sources)
+        while queue:
+            node = queue.popleft()
+            for nxt in self._neighbors(minimums, maximums, node):
+                if nxt in parent:
+                    continue
+                parent[nxt] = node
+                if excess[nxt] < 0:
+                    path = [ nxt ]
+                    while parent[path[-1]] is not None:
+                        path.append(parent[path[-1]])
+                    return path[::-1]
+                queue.append(nxt)
+        return None
+
+    def _components(self, minimums, maximums):
+        """
+        Strongly connected components of the residual graph (Kosaraju),
+        as a list mapping each node to a component id.
+        """
+        num_nodes = 2 * self.num_players
+        adjacency = [ self._neighbors(minimums, maximums, node) for node in range(num_nodes) ]
+        reverse = [ [] for _ in range(num_nodes) ]
+        for node, targets in enumerate(adjacency):
+            for target in targets:
+                reverse[target].append(node)
+
+        order = []
+        visited = [ False ] * num_nodes
+        for root in range(num_nodes):
+            if visited[root]:
+                continue
+            visited[root] = True
+            stack = [ (root, iter(adjacency[root])) ]
+            while stack:
+                node, targets = stack[-1]
+                for target in targets:
+                    if not visited[target]:
+                        visited[target] = True
+                        stack.append((target, iter(adjacency[target])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(node)
+
+        component = [ None ] * num_nodes
+        for root in reversed(order):
+            if component[root] is not None:
+                continue
+            component[root] = root
+            stack = [ root ]
+            while stack:
+                node = stack.pop()
+                for target in reverse[node]:
+                    if component[target] is None:
+                        component[target] = root
+                        stack.append(target)
+        return component
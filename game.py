@@ -0,0 +1,531 @@
+import itertools
+import logging
+import random
+import zlib
+from enum import Enum
+
+import telegram
+
+import game_log
+import instrumentation
+import probability
+from game_state import *
+
+_rename_epochs = itertools.count(1)
+
+# Telegram's limits on the buttons of an inline keyboard, in all and in a row
+MAX_KEYBOARD_BUTTONS = 100
+MAX_KEYBOARD_ROW = 8
+
+def _suit_check(suit):
+    return zlib.crc32(suit.encode("utf-8"))
+
+# beyond this many players, counting every world early in a game takes most
+# of a second or more; /odds samples them instead, for ODDS_SAMPLE_SECONDS
+EXACT_ODDS_MAX_PLAYERS = 4
+ODDS_SAMPLE_SECONDS = 0.2
+
+class Player:
+    """
+    Helper class for representing a Telegram user,
+    allowing them to set a nickname, and tag them in a Markdown-encoded message.
+    """
+    __slots__ = ("id", "name")
+
+    # changes whenever any player is renamed, so that games know to rebuild
+    # their nickname index
+    rename_epoch = 0
+
+    def __init__(self, id, nickname):
+        self.id = id
+        self.name = nickname
+
+    def __setstate__(self, state):
+        # Players pickled before __slots__ have their attributes as a plain dict
+        if isinstance(state, tuple):
+            state = state[1]
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def set_nickname(self, name):
+        self.name = name
+        Player.rename_epoch = next(_rename_epochs)
+
+    def get_markdown_tag(self):
+        return "[{}](tg://user?id={})".format(self.name, self.id)
+
+    # user data and chat data are persisted separately, so after a restart the
+    # Player in a user's data and the one in their game are different objects
+    def __eq__(self, other):
+        return isinstance(other, Player) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class GameStatus(Enum):
+    GAME_NOT_STARTED = 0
+    AWAITING_ASK = 1
+    AWAITING_RESPONSE = 2
+    GAME_OVER = 3
+
+class Game:
+    """
+    Represents a game of Quantum Go Fish. Maintains a GameState representing the
+    current state of the game, and a list of players and suit names with indices
+    corresponding to the GameState.
+
+    Once started, every successful move is recorded in a GameLog, from which
+    the game can be rebuilt at any earlier move.
+
+    'version' goes up with every change to the game outside its GameState,
+    which has a version of its own. Messages rendered from the game are kept
+    until either version or Player.rename_epoch changes.
+    """
+    __slots__ = ("players", "suit_names", "started", "status", "num_players", "state", "log",
+                 "asking_player", "asking_player_idx", "target_player", "target_player_idx",
+                 "requested_suit", "requested_suit_idx", "win_info",
+                 "version", "_rendered",
+                 "_indexed_players", "_indexed_epoch", "_index_by_id", "_index_by_name")
+
+    # the list of players the indexes were built from; they are rebuilt
+    # whenever self.players is another list, or was changed in place (which
+    # sets _indexed_players to None), and the nickname index also whenever
+    # anyone was renamed
+    _INDEXES = ("_indexed_players", "_indexed_epoch", "_index_by_id", "_index_by_name")
+    # not persisted either: a game loaded from anywhere starts with no messages
+    # rendered, so its version only has to go up while it's in memory
+    _TRANSIENT = _INDEXES + ("version", "_rendered")
+
+    def __init__(self):
+        self.players = []
+        self.suit_names = []
+        self.started = False
+        self.status = GameStatus.GAME_NOT_STARTED
+        self.log = None
+
+        self.asking_player_idx = None
+        self.requested_suit_idx = None
+        self.target_player = None
+        self.target_player_idx = None
+        self.version = 0
+        self._rendered = {}
+        self._indexed_players = None
+        self._indexed_epoch = None
+
+    def __getstate__(self):
+        # the indexes are rebuilt on demand, and a rename epoch means nothing
+        # to another process
+        return { key: getattr(self, key) for key in self.__slots__
+                 if key not in self._TRANSIENT and hasattr(self, key) }
+
+    def __setstate__(self, state):
+        # replaces everything, so that undo can also use it; games pickled
+        # before __slots__ have a plain dict, and the oldest ones no log
+        if isinstance(state, tuple):
+            state = state[1]
+        for key in self.__slots__:
+            if hasattr(self, key):
+                delattr(self, key)
+        self.log = None
+        self.version = 0
+        self._rendered = {}
+        self._indexed_players = None
+        self._indexed_epoch = None
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def _changed(self):
+        self.version += 1
+
+    def _indexes(self):
+        epoch = Player.rename_epoch
+        if self._indexed_players is not self.players:
+            self._index_by_id = { player.id: i for i, player in enumerate(self.players) }
+            self._indexed_players = self.players
+            self._indexed_epoch = None
+        if self._indexed_epoch != epoch:
+            # with colliding nicknames, the first player in turn order gets it
+            self._index_by_name = {}
+            for i, player in enumerate(self.players):
+                self._index_by_name.setdefault(player.name, i)
+            self._indexed_epoch = epoch
+        return self._index_by_id, self._index_by_name
+
+    def player_index(self, player):
+        """
+        The turn order index of 'player' (or anyone with their id), or None if
+        they are not in this game.
+        """
+        return self._indexes()[0].get(player.id)
+
+    def player_join(self, player):
+        if self.started:
+            return "cannot join a game that has already started"
+        elif self.player_index(player) is not None:
+            return "You're already in this game!"
+        else:
+            self.players.append(player)
+            self._indexed_players = None
+            self._changed()
+
+    def player_leave(self, player):
+        idx = self.player_index(player)
+        if self.started:
+            return "cannot leave a game that has already started"
+        elif idx is None:
+            return "it's not like you were playing..."
+        else:
+            del self.players[idx]
+            self._indexed_players = None
+            self._changed()
+
+    def game_start(self):
+        self.num_players = len(self.players)
+        self.state = new_game_state(self.num_players)
+        self.started = True
+
+        random.shuffle(self.players)
+        self._indexed_players = None
+        self.status = GameStatus.AWAITING_ASK
+        self.asking_player_idx = 0
+        self.asking_player = self.players[0]
+        self.log = game_log.GameLog.start(self)
+        self._changed()
+
+    def get_player(self, nickname_or_idx):
+        """
+        Get a Player object of a player in this game given 'nickname_or_idx', a
+        string that another user might use to refer to them
+        (their index in the turn order or their nickname).
+
+        Returns None if no player with that index/nickname exists.
+        """
+        if nickname_or_idx.isdigit() and int(nickname_or_idx) < len(self.players):
+            return self.players[int(nickname_or_idx)]
+        idx = self._indexes()[1].get(nickname_or_idx)
+        if idx is not None:
+            return self.players[idx]
+
+    def get_player_md_tag(self, nickname_or_idx):
+        """
+        Wrapper for get_player that returns either the Markdown tag of the
+        player referred to by 'nickname_or_idx' or None if the player could not
+        be identified.
+        """
+
+        res = self.get_player(nickname_or_idx)
+        if res:
+            return res.get_markdown_tag()
+        else:
+            return None
+
+    def ask_for(self, player, target_str, suit):
+        if self.status != GameStatus.AWAITING_ASK:
+            return "/ask unexpected"
+
+        player_idx = self.player_index(player)
+        target = self.get_player(target_str)
+        if target:
+            target_idx = self.player_index(target)
+        else:
+            return "cannot parse target user: " + target_str
+
+        if player == target:
+            return "Players cannot ask themselves for cards. Please ask another player."
+
+        if suit in self.suit_names:
+            suit_idx = self.suit_names.index(suit)
+        elif len(self.suit_names) == self.num_players:
+            return "could not parse suit name: " + suit
+        else:
+            suit_idx = len(self.suit_names)
+
+        if not self.state.asked_for(player_idx, suit_idx):
+            instrumentation.REJECTED_MOVES.inc("ask")
+            instrumentation.event("ask", player=player.id, target=target.id, suit=suit, outcome="rejected")
+            return "error: game state indicates that {} has at least one {} with probability zero".format(player.name, suit) + \
+                self._proof(player_idx, suit_idx, 1, NUM_PER_SUIT)
+
+        # a suit name only counts once a legal ask has used it
+        if suit_idx == len(self.suit_names):
+            logging.info("new suit: %s", suit)
+            self.suit_names.append(suit)
+
+        if not self.check_win_conditions():
+            self.status = GameStatus.AWAITING_RESPONSE
+            self.requested_suit = suit
+            self.requested_suit_idx = suit_idx
+            self.target_player = target
+            self.target_player_idx = target_idx
+        self._changed()
+
+        if self.log is not None:
+            self.log.record(self, game_log.Event(game_log.ASK, player_idx, target_idx, suit, None))
+        instrumentation.event("ask", player=player.id, target=target.id, suit=suit,
+            outcome="win" if self.status == GameStatus.GAME_OVER else "ok")
+
+    def respond_to_request(self, player, n_str):
+        if self.status != GameStatus.AWAITING_RESPONSE:
+            return "/ihave unexpected"
+
+        if n_str.isdigit():
+            n = int(n_str)
+        else:
+            return "cannot parse number of cards: " + n_str
+
+        if player == self.target_player:
+            player_idx = self.target_player_idx
+        else:
+            return "expected \"/ihave [n]\" from {}, not {}".format(self.target_player.name, player.name)
+
+        if self.state.gave_away(player_idx, self.requested_suit_idx, n):
+            self.state.received(self.asking_player_idx, self.requested_suit_idx, n)
+        else:
+            instrumentation.REJECTED_MOVES.inc("respond")
+            instrumentation.event("respond", player=player.id, suit=self.requested_suit, n=n, outcome="rejected")
+            return "error: game state indicates that {} has {} \"{}\" with probability zero".format(player.name, n, self.requested_suit) + \
+                self._proof(player_idx, self.requested_suit_idx, n, n)
+
+        if not self.check_win_conditions():
+            self.status = GameStatus.AWAITING_ASK
+            while True:
+                self.asking_player_idx = (self.asking_player_idx + 1) % self.num_players
+                self.asking_player = self.players[self.asking_player_idx]
+
+                if self.state.hand_sizes[self.asking_player_idx] > 0:
+                    break # find the next player with a nonempty hand
+        self._changed()
+
+        if self.log is not None:
+            self.log.record(self, game_log.Event(game_log.RESPOND, player_idx, None, None, n))
+        instrumentation.event("respond", player=player.id, suit=self.requested_suit, n=n,
+            outcome="win" if self.status == GameStatus.GAME_OVER else "ok")
+
+    def _proof(self, player_idx, suit_idx, low, high):
+        """
+        Points at the move that ruled out 'player_idx' holding between 'low'
+        and 'high' of suit 'suit_idx', for appending to an error message.
+        """
+        if self.log is None:
+            return ""
+        i = self.log.explain(player_idx, suit_idx, low, high)
+        if i is None:
+            return ""
+        return " (ruled out by move {}: {})".format(i + 1, self.log.describe(i, self.players))
+
+    def undo(self, player):
+        """
+        Takes back the last move, if 'player' made it. Returns an error
+        message or None.
+        """
+        if self.log is None or not self.log.events:
+            return "There's nothing to undo"
+        last = self.log.event(len(self.log.events) - 1)
+        if self.players[last.player] != player:
+            return "Only {} can undo the last move".format(self.players[last.player].name)
+
+        previous = self.log.rebuild(len(self.log.events) - 1)
+        version, players = self.version, self.players
+        self.__setstate__(previous.__getstate__())
+        self.version = version + 1
+        # the same players, but the snapshot has the names they had then
+        self.players = players
+        self.asking_player = players[self.asking_player_idx]
+        if self.target_player_idx is not None:
+            self.target_player = players[self.target_player_idx]
+
+    def history(self):
+        if self.log is None or not self.log.events:
+            return "No moves yet"
+        return "\n".join( "{}. {}".format(i + 1, self.log.describe(i, self.players))
+                          for i in range(len(self.log.events)) )
+
+    def check_win_conditions(self):
+        res = self.state.check_win_conditions()
+        if res:
+            winner = self.players[ res[1] ]
+            if res[0] == WinType.CONVERGED_STATE:
+                self.win_info = "{} won by converging the game state".format(winner.name)
+            elif res[0] == WinType.ALL_SUIT:
+                # deduction can complete a suit nobody has asked for yet, and
+                # so has no name
+                if res[2] < len(self.suit_names):
+                    suit = self.suit_names[ res[2] ]
+                    self.win_info = "{} won by provably obtaining all {}".format(winner.name, suit)
+                else:
+                    self.win_info = "{} won by provably obtaining all of a suit nobody has named".format(winner.name)
+            self.status = GameStatus.GAME_OVER
+            return True
+        else:
+            return False
+
+    def _render(self, view, build):
+        """
+        Returns the message 'build()' renders for 'view', built again only
+        once the game, its state or any nickname changed.
+        """
+        state = getattr(self, "state", None)
+        key = (self.version, state.version if state is not None else None, Player.rename_epoch)
+        cached = self._rendered.get(view)
+        if cached is not None and cached[0] == key:
+            instrumentation.RENDERS.inc(view, "hit")
+            return cached[1]
+        instrumentation.RENDERS.inc(view, "miss")
+        text = build()
+        self._rendered[view] = (key, text)
+        return text
+
+    def player_list(self):
+        return self._render("players", self._player_list)
+
+    def _player_list(self):
+        res = "List of players:\n"
+        for i, player in enumerate(self.players):
+            res += str(i) + ". "
+            res += player.name + " "
+
+            if self.status != GameStatus.GAME_NOT_STARTED:
+                res += "({} cards)".format(self.state.hand_sizes[i])
+
+            if i == self.asking_player_idx:
+                res += " (Q)"
+            elif i == self.target_player_idx and self.status == GameStatus.AWAITING_RESPONSE:
+                res += " (A)"
+
+            res += "\n"
+
+        return res
+
+    def blame(self):
+        """
+        The Markdown message saying whose move it is, or how the game ended.
+        """
+        return self._render("blame", self._blame)
+
+    def _blame(self):
+        if self.status == GameStatus.AWAITING_ASK:
+            return "It's {}'s turn!".format(self.asking_player.get_markdown_tag())
+        elif self.status == GameStatus.AWAITING_RESPONSE:
+            return '{}: "{}, do you have any {}?"'.format(
+                self.asking_player.name,
+                self.target_player.get_markdown_tag(),
+                self.requested_suit)
+        elif self.status == GameStatus.GAME_NOT_STARTED:
+            return "Waiting on anyone to start the game"
+        else:
+            msg = "Game is over! {}.\n\nFinal game state:\n".format(self.win_info)
+            for player_idx, player in enumerate(self.players):
+                msg += player.name + ": "
+                for suit_idx, suit in enumerate(self.suit_names):
+                    msg += "{} {} ".format(self.state.player_minimums[player_idx][suit_idx], suit)
+                msg += "\n"
+            return msg
+
+    def odds(self):
+        """
+        The chances of each answer to the pending question, or while waiting
+        for an ask those of every player holding any of each named suit, with
+        every consistent deal equally likely (see probability.py).
+        """
+        return self._render("odds", self._odds)
+
+    def _odds(self):
+        if self.status not in (GameStatus.AWAITING_ASK, GameStatus.AWAITING_RESPONSE):
+            return "No game in progress"
+        approximate = self.num_players > EXACT_ODDS_MAX_PLAYERS
+        probs = probability.card_probabilities(self.state, approximate=approximate, time_limit=ODDS_SAMPLE_SECONDS)
+        if probs is None:
+            return "No deal of the cards fits what is known"
+        estimated = " (estimated)" if approximate else ""
+        if self.status == GameStatus.AWAITING_RESPONSE:
+            cell = probs[self.target_player_idx][self.requested_suit_idx]
+            return "Chances that {} has this many {}{}: {}".format(self.target_player.name, self.requested_suit,
+                estimated, ", ".join( "{}: {:.0%}".format(n, p) for n, p in enumerate(cell) if p > 0 ))
+        if not self.suit_names:
+            return "No suits named yet"
+        res = "Chances of holding any of each suit{}:\n".format(estimated)
+        for player_idx, player in enumerate(self.players):
+            res += "{}: {}\n".format(player.name, ", ".join( "{} {:.0%}".format(suit, 1 - probs[player_idx][suit_idx][0])
+                                                            for suit_idx, suit in enumerate(self.suit_names) ))
+        return res
+
+    def _position(self):
+        """
+        The game and the number of moves into it, as button callback data
+        starts with them; with undo, the same position can come back with
+        other moves behind it.
+        """
+        game_id = "{:x}".format(self.log.game_id) if self.log is not None else "-"
+        return "{}:{}".format(game_id, len(self.log.events) if self.log is not None else 0)
+
+    def keyboard(self):
+        """
+        An InlineKeyboardMarkup of the moves the player to move can make, or
+        None. Asks offer every other player and every named suit the asking
+        player may ask for, responses every count the target may have, by
+        GameState.legal_asks and legal_responses; a new suit still has to be
+        named with /ask.
+        """
+        return self._render("keyboard", self._keyboard)
+
+    def _keyboard(self):
+        # the callback data says everything press_button needs, checked
+        # against the game itself, so that the buttons need no storage of
+        # their own and keep working across restarts: "a:<position>:<target
+        # index>:<suit index>:<crc32 of the suit's name>" for an ask (suit
+        # indexes can be reused after an undo) and "r:<position>:<count>" for
+        # a response, at most Telegram's 64 bytes
+        position = self._position()
+        if self.status == GameStatus.AWAITING_ASK:
+            suits = [ suit_idx for suit_idx in self.state.legal_asks(self.asking_player_idx)
+                      if suit_idx < len(self.suit_names) ]
+            rows = []
+            for target_idx, target in enumerate(self.players):
+                if target_idx == self.asking_player_idx:
+                    continue
+                buttons = [ telegram.InlineKeyboardButton("{}: {}".format(target.name, self.suit_names[suit_idx]),
+                                callback_data="a:{}:{}:{}:{:x}".format(position, target_idx, suit_idx,
+                                                                       _suit_check(self.suit_names[suit_idx])))
+                            for suit_idx in suits ]
+                rows += [ buttons[i:i + MAX_KEYBOARD_ROW] for i in range(0, len(buttons), MAX_KEYBOARD_ROW) ]
+        elif self.status == GameStatus.AWAITING_RESPONSE:
+            rows = [[ telegram.InlineKeyboardButton("go fish" if n == 0 else "I have {}".format(n),
+                          callback_data="r:{}:{}".format(position, n))
+                      for n in self.state.legal_responses(self.target_player_idx, self.requested_suit_idx) ]]
+        else:
+            return None
+        # Telegram takes at most MAX_KEYBOARD_BUTTONS; the rest can be typed
+        while sum(map(len, rows)) > MAX_KEYBOARD_BUTTONS:
+            rows.pop()
+        rows = [ row for row in rows if row ]
+        return telegram.InlineKeyboardMarkup(rows) if rows else None
+
+    def press_button(self, player, data):
+        """
+        Makes the move of a keyboard button's callback data, pressed by
+        'player'. Returns an error message or None.
+        """
+        stale = "This move was already made; /blame for the current one"
+        if not isinstance(data, str):
+            return stale
+        parts = data.split(":")
+        if len(parts) < 4 or "{}:{}".format(parts[1], parts[2]) != self._position() \
+                or not all(map(str.isdigit, parts[3:5])):
+            return stale
+        if parts[0] == "a" and len(parts) == 6 and self.status == GameStatus.AWAITING_ASK:
+            if player != self.asking_player:
+                return "It's {}'s turn".format(self.asking_player.name)
+            target_idx, suit_idx = int(parts[3]), int(parts[4])
+            if target_idx >= len(self.players) or suit_idx >= len(self.suit_names) \
+                    or parts[5] != "{:x}".format(_suit_check(self.suit_names[suit_idx])):
+                return stale
+            return self.ask_for(player, str(target_idx), self.suit_names[suit_idx])
+        if parts[0] == "r" and len(parts) == 4 and self.status == GameStatus.AWAITING_RESPONSE:
+            if player != self.target_player:
+                return "{} was asked, not you".format(self.target_player.name)
+            return self.respond_to_request(player, parts[3])
+        return stale
+
+    def send_blame(self, bot, chat_id):
+        bot.send_message(chat_id=chat_id, text=self.blame(), parse_mode=telegram.ParseMode.MARKDOWN,
+            reply_markup=self.keyboard())
@@ -0,0 +1,180 @@
+"""
+Event log of a game of Quantum Go Fish.
+
+Once a game starts, every successful ask and response is appended to its
+GameLog as a small encoded Event, and a snapshot of the whole game is taken
+every SNAPSHOT_INTERVAL events. The game after any prefix of its moves can
+be rebuilt from the closest snapshot by replaying the events after it, which
+is what undo, the move history and the explanation of rejected moves use.
+"""
+
+import logging
+import random
+from collections import namedtuple
+
+import codec
+import instrumentation
+
+ASK = 0
+RESPOND = 1
+
+# 'player' asked 'target' for the suit named 'suit' (ASK), or 'player'
+# responded that they had 'n' cards (RESPOND); players are turn order indices
+Event = namedtuple("Event", ["kind", "player", "target", "suit", "n"])
+
+SNAPSHOT_INTERVAL = 16
+
+class GameLog:
+    """
+    The encoded events of a started game, and snapshots of the game (encoded
+    without its log) keyed by the number of events they were taken after:
+    always the start of the game (0), and the latest two periodic ones (so an
+    undo right after a snapshot doesn't have to replay the whole game).
+    """
+
+    __slots__ = ("game_id", "snapshots", "events")
+
+    def __init__(self, game_id, snapshots, events):
+        self.game_id = game_id
+        self.snapshots = snapshots
+        self.events = events
+
+    def __setstate__(self, state):
+        # logs pickled before __slots__ have their attributes as a plain dict
+        if isinstance(state, tuple):
+            state = state[1]
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    @classmethod
+    def start(cls, game):
+        return cls(random.getrandbits(63), { 0: codec.encode_game_body(game) }, [])
+
+    @property
+    def snapshot_seq(self):
+        return max(self.snapshots)
+
+    def record(self, game, event):
+        """
+        Appends 'event', which has just been applied to 'game'.
+        """
+        self.events.append(codec.encode_event(event))
+        if len(self.events) % SNAPSHOT_INTERVAL == 0:
+            seq = len(self.events)
+            self.snapshots = { old: data for old, data in self.snapshots.items()
+                               if old == 0 or old >= seq - SNAPSHOT_INTERVAL }
+            self.snapshots[seq] = codec.encode_game_body(game)
+
+    def event(self, i):
+        return codec.decode_event(self.events[i])
+
+    def rebuild(self, until=None):
+        """
+        Returns a new Game as it was after the first 'until' events (all of
+        them by default), with a log of just those events.
+        """
+        if until is None:
+            until = len(self.events)
+        seq = max( seq for seq in self.snapshots if seq <= until )
+        game = codec.decode_game_body(self.snapshots[seq])
+        for i in range(seq, until):
+            apply(game, self.event(i))
+        game.log = GameLog(self.game_id,
+            { seq: data for seq, data in self.snapshots.items() if seq <= until }, self.events[:until])
+        return game
+
+    def explain(self, player, suit, low, high):
+        """
+        Finds the move that ruled out 'player' holding between 'low' and 'high'
+        cards of suit index 'suit': returns the index of the last event before
+        which that was still possible, or None if it never was.
+        """
+        # only the moves are replayed, onto the bare state: the deductions the
+        # game makes after every move don't change what is consistent
+        start = codec.decode_game_body(self.snapshots[0])
+        state = start.state
+        suit_names = list(start.suit_names)
+        asker = asked = None
+        possible = state.is_consistent_with(player, suit, low, high)
+        res = None
+        for i in range(len(self.events)):
+            event = self.event(i)
+            if event.kind == ASK:
+                if event.suit not in suit_names:
+                    suit_names.append(event.suit)
+                asker, asked = event.player, suit_names.index(event.suit)
+                state.asked_for(asker, asked)
+            else:
+                state.gave_away(event.player, asked, event.n)
+                state.received(asker, asked, event.n)
+            now = state.is_consistent_with(player, suit, low, high)
+            if possible and not now:
+                res = i
+            possible = now
+        return res
+
+    def describe(self, i, players):
+        """
+        Describes event 'i' using the names of 'players'.
+        """
+        event = self.event(i)
+        if event.kind == ASK:
+            return "{} asked {} for {}".format(players[event.player].name, players[event.target].name, event.suit)
+        return "{} had {}".format(players[event.player].name, event.n)
+
+def apply(game, event):
+    """
+    Applies 'event' to 'game' without recording it. Raises ValueError if the
+    game rejects it, which means the log doesn't belong to the game.
+    """
+    log, game.log = game.log, None
+    try:
+        with instrumentation.context(replay=True):
+            if event.kind == ASK:
+                error = game.ask_for(game.players[event.player], str(event.target), event.suit)
+            else:
+                error = game.respond_to_request(game.players[event.player], str(event.n))
+    finally:
+        game.log = log
+    if error:
+        raise ValueError("{} rejected during replay: {}".format(event, error))
+
+class GameEvents:
+    """
+    Chat data hooks for PostgresPersistence(chat_events=...), which store a
+    game's events as rows of their own. Chat data is encoded with every game
+    as of its latest snapshot, which changes only every SNAPSHOT_INTERVAL
+    moves, so a move costs one appended event instead of rewriting the game.
+    """
+
+    def encode_chat_data(self, chat_data):
+        return codec.encode_chat_data(chat_data, external_events=True)
+
+    def decode_chat_data(self, data):
+        return codec.decode_chat_data(data)
+
+    def events(self, chat_data):
+        """
+        Returns the encoded events of every logged game in 'chat_data', keyed
+        by game id. The lists are the logs' own; they must not be modified.
+        """
+        return { value.log.game_id: value.log.events for value in chat_data.values()
+                 if isinstance(getattr(value, "log", None), GameLog) }
+
+    def replay(self, chat_data, game_id, events):
+        """
+        Brings the game 'game_id' in freshly decoded 'chat_data' up to date by
+        replaying the stored 'events' after its snapshot, and keeps 'events'
+        (the same list) as its log.
+        """
+        for value in chat_data.values():
+            log = getattr(value, "log", None)
+            if isinstance(log, GameLog) and log.game_id == game_id:
+                seq = log.snapshot_seq
+                if len(events) < seq:
+                    raise ValueError("game {} has {} stored events but a snapshot after {}".format(
+                        game_id, len(events), seq))
+                for data in events[seq:]:
+                    apply(value, codec.decode_event(data))
+                log.events = events
+                logging.debug("replayed %d events of game %d", len(events) - seq, game_id)
@@ -1,6 +1,11 @@
 import logging
+import os
+from array import array
 from enum import Enum
 
+import instrumentation
+from feasibility import CardFlow
+
 class WinType(Enum):
     CONVERGED_STATE = 1
     ALL_SUIT = 2
@@ -11,29 +16,158 @@ class GameState:
     Class for tracking the state of a game. That is, given n players
     (referred to by indices 0 to n-1) and n suits (also 0 to n-1), learn data
     about what players may or may not have.
+
+    Bounds are kept one bytearray per player (so player_minimums[player][suit]
+    reads and writes as with nested lists) and hand sizes and running sums in
+    typed arrays, since every chat with a game keeps one of these in memory.
     """
+    __slots__ = ("num_players", "player_minimums", "player_maximums", "hand_sizes", "last_actor", "version",
+                 "_flow", "_min_row_sums", "_max_row_sums", "_min_col_sums", "_max_col_sums",
+                 "_dirty_rows", "_dirty_cols", "_queued_rows", "_queued_cols", "_bounds_changed",
+                 "_unconverged", "_full_cells", "_legal_moves", "_legal_version",
+                 # probability.card_probabilities caches its results per state
+                 "__weakref__")
 
     def __init__(self, num_players):
         # TODO will need to change if we want to support arbitrary joins in first round
         self.num_players = num_players
-        self.player_minimums = [ [ 0 for _ in range(num_players) ] for _ in range(num_players) ]
-        self.player_maximums = [ [ NUM_PER_SUIT for _ in range(num_players) ] for _ in range(num_players) ]
-        self.hand_sizes = [ NUM_PER_SUIT for _ in range(num_players) ]
+        self.player_minimums = [ bytearray(num_players) for _ in range(num_players) ]
+        self.player_maximums = [ bytearray([ NUM_PER_SUIT ]) * num_players for _ in range(num_players) ]
+        self.hand_sizes = array("h", [ NUM_PER_SUIT ]) * num_players
         self.last_actor = None
+        # incremented whenever any bound or hand size changes
+        self.version = 0
+        self._flow = CardFlow(num_players, NUM_PER_SUIT)
+        self._init_propagation()
+
+    @classmethod
+    def from_bounds(cls, minimums, maximums, hand_sizes):
+        """
+        Make a GameState with the given bounds (sequences of rows of ints, e.g.
+        lists or bytes) and hand sizes, e.g. when restoring one from storage.
+        """
+        res = cls.__new__(cls)
+        res.num_players = len(hand_sizes)
+        res.player_minimums = list(map(bytearray, minimums))
+        res.player_maximums = list(map(bytearray, maximums))
+        res.hand_sizes = array("h", hand_sizes)
+        res.last_actor = None
+        res.version = 0
+        res._flow = CardFlow(res.num_players, NUM_PER_SUIT)
+        res._init_propagation()
+        return res
+
+    def _init_propagation(self):
+        """
+        Set up the bookkeeping used by deduce_extrema: running sums of the
+        minimums/maximums of every player (row) and every suit (column), and a
+        worklist of rows and columns whose bounds changed since the last
+        deduction. Everything is queued initially so that the first deduction
+        examines the whole table.
+
+        Also counts what check_win_conditions looks for, kept up to date by
+        every bound change: the cells whose minimum and maximum differ, and
+        the cells (as player * n + suit) whose minimum is a whole suit.
+        """
+        n = self.num_players
+        self._min_row_sums = array("h", map(sum, self.player_minimums))
+        self._max_row_sums = array("h", map(sum, self.player_maximums))
+        self._min_col_sums = array("h", map(sum, zip(*self.player_minimums)))
+        self._max_col_sums = array("h", map(sum, zip(*self.player_maximums)))
+        # queues of row/column indices; the flags say what is already queued
+        self._dirty_rows = list(range(n))
+        self._dirty_cols = list(range(n))
+        self._queued_rows = bytearray([ 1 ]) * n
+        self._queued_cols = bytearray([ 1 ]) * n
+        self._bounds_changed = True
+        self._unconverged = sum( low != high for mins, maxs in zip(self.player_minimums, self.player_maximums)
+                                 for low, high in zip(mins, maxs) )
+        self._full_cells = { player * n + suit for player, mins in enumerate(self.player_minimums)
+                             for suit, low in enumerate(mins) if low == NUM_PER_SUIT }
+        # legal_asks, legal_responses and _free_cells of the version in
+        # _legal_version
+        self._legal_moves = {}
+        self._legal_version = None
+
+    def __getstate__(self):
+        # the propagation bookkeeping and the flow are rebuilt on load
+        return { "num_players": self.num_players, "player_minimums": self.player_minimums,
+                 "player_maximums": self.player_maximums, "hand_sizes": self.hand_sizes,
+                 "last_actor": self.last_actor, "version": self.version }
+
+    def __setstate__(self, state):
+        # states pickled before __slots__ have nested lists, and maybe no version
+        if isinstance(state, tuple):
+            state = state[1]
+        self.num_players = state["num_players"]
+        self.player_minimums = list(map(bytearray, state["player_minimums"]))
+        self.player_maximums = list(map(bytearray, state["player_maximums"]))
+        self.hand_sizes = array("h", state["hand_sizes"])
+        self.last_actor = state["last_actor"]
+        self.version = state.get("version", 0)
+        self._flow = CardFlow(self.num_players, NUM_PER_SUIT)
+        self._init_propagation()
 
-    # TODO track the message that lets us know each thing so we can send "proof" of why a move is invalid
+    def _mark_dirty(self, player, suit):
+        self.version += 1
+        self._bounds_changed = True
+        if not self._queued_rows[player]:
+            self._queued_rows[player] = 1
+            self._dirty_rows.append(player)
+        if not self._queued_cols[suit]:
+            self._queued_cols[suit] = 1
+            self._dirty_cols.append(suit)
+
+    def _set_minimum(self, player, suit, n):
+        old = self.player_minimums[player][suit]
+        delta = n - old
+        if delta:
+            self.player_minimums[player][suit] = n
+            high = self.player_maximums[player][suit]
+            self._unconverged += (n != high) - (old != high)
+            if n == NUM_PER_SUIT:
+                self._full_cells.add(player * self.num_players + suit)
+            elif old == NUM_PER_SUIT:
+                self._full_cells.discard(player * self.num_players + suit)
+            self._min_row_sums[player] += delta
+            self._min_col_sums[suit] += delta
+            self._mark_dirty(player, suit)
+
+    def _set_maximum(self, player, suit, n):
+        old = self.player_maximums[player][suit]
+        delta = n - old
+        if delta:
+            self.player_maximums[player][suit] = n
+            low = self.player_minimums[player][suit]
+            self._unconverged += (n != low) - (old != low)
+            self._max_row_sums[player] += delta
+            self._max_col_sums[suit] += delta
+            self._mark_dirty(player, suit)
+
+    # the "proof" of why a move is invalid comes from replaying the game's log; see GameLog.explain
     def has_at_least(self, player, suit, n):
-        self.player_minimums[player][suit] = max(self.player_minimums[player][suit], n)
+        # no deduction can ever require more than a whole suit; clamping keeps
+        # propagation finite even if the bounds have become contradictory
+        n = min(n, NUM_PER_SUIT)
+        if n > self.player_minimums[player][suit]:
+            self._set_minimum(player, suit, n)
 
     def has_at_most(self, player, suit, n):
-        self.player_maximums[player][suit] = min(self.player_maximums[player][suit], n)
+        n = max(n, 0)
+        if n < self.player_maximums[player][suit]:
+            self._set_maximum(player, suit, n)
 
     def has_exactly(self, player, suit, n):
-        self.player_maximums[player][suit] = 0
-        self.player_minimums[player][suit] = 0
+        self._set_maximum(player, suit, 0)
+        self._set_minimum(player, suit, 0)
 
     def has_hand_size(self, player, n):
         self.hand_sizes[player] = n
+        self.version += 1
+        self._bounds_changed = True
+        if not self._queued_rows[player]:
+            self._queued_rows[player] = 1
+            self._dirty_rows.append(player)
 
     def can_have(self, player, suit, n):
         """
@@ -42,80 +176,172 @@ class GameState:
         return n >= self.player_minimums[player][suit] and \
             n <= self.player_maximums[player][suit]
 
+    def legal_asks(self, player):
+        """
+        The suits 'player' may ask for, as a tuple: those they hold at least
+        one of in some consistent assignment, i.e. what asked_for would
+        accept. Read off CardFlow.free_cells rather than the exact extrema,
+        which would need deduce_extrema.
+        """
+        def compute():
+            cells = self._free_cells()
+            # contradictory bounds (only from_bounds can make them) have no
+            # consistent assignment to go by
+            if cells is None:
+                return tuple( suit for suit in range(self.num_players) if self.player_maximums[player][suit] > 0 )
+            free, flow = cells
+            row = player * self.num_players
+            return tuple( suit for suit in range(self.num_players) if flow[row + suit] > 0 or free[row + suit] )
+        return self._legal(("ask", player), compute)
+
+    def legal_responses(self, player, suit):
+        """
+        The numbers of cards of 'suit' that 'player' may say they have, as a
+        tuple; what gave_away would accept.
+        """
+        def compute():
+            bounds = self._flow.cell_bounds(self.player_minimums, self.player_maximums, self.hand_sizes,
+                player, suit)
+            if bounds is None:
+                return tuple( n for n in range(NUM_PER_SUIT + 1) if self.can_have(player, suit, n) )
+            return tuple(range(bounds[0], bounds[1] + 1))
+        return self._legal(("respond", player, suit), compute)
+
+    def _legal(self, key, compute):
+        # computed at most once per version, however often a keyboard asks
+        if self._legal_version != self.version:
+            self._legal_moves = {}
+            self._legal_version = self.version
+        moves = self._legal_moves.get(key)
+        if moves is None:
+            moves = self._legal_moves[key] = compute()
+        return moves
+
+    def _free_cells(self):
+        # (free cells, assignment) from CardFlow.free_cells, once per version
+        # and flattened to player * n + suit, since an idle chat keeps them;
+        # the assignment is copied since later flow checks move it
+        def compute():
+            free = self._flow.free_cells(self.player_minimums, self.player_maximums, self.hand_sizes)
+            if free is None:
+                return None
+            return b"".join(free), b"".join(self._flow.flow)
+        return self._legal(("free",), compute)
+
+    def is_consistent_with(self, player, suit, low, high):
+        """
+        Check if some assignment of every card, consistent with everything
+        known so far, gives 'player' between 'low' and 'high' cards of suit
+        'suit'. Unlike can_have, this accounts for all hands and suits at once.
+        """
+        return self._flow.is_feasible_with(self.player_minimums, self.player_maximums,
+            self.hand_sizes, player, suit, low, high)
+
     def deduce_extrema(self):
         """
         From all current extrema, deduce stricter extrema from the principles
         of the game: there are NUM_PER_SUIT cards of each suit and each players
         hand consists of cards from the suits.
+
+        Only the suits (columns) and players (rows) whose bounds changed since
+        the last deduction are re-examined; any bound tightened while doing so
+        queues its own row and column, until nothing changes. The result is
+        then tightened to the exact extrema over all consistent assignments.
+
+        That last step searches for a residual cycle through every cell, so
+        the move path (legal_asks, legal_responses, check_win_conditions)
+        doesn't need it; it runs when the exact bounds themselves are wanted.
         """
-        previous = None
-        current = self.player_minimums + self.player_maximums
-        while previous != current:
-            previous = current
-            self._deduce_extrema_step()
-            current = self.player_minimums + self.player_maximums
+        # every change to the worklist also sets _bounds_changed
+        if self._bounds_changed:
+            self._deduce_extrema()
 
-    def _deduce_extrema_step(self):
-        # there are exactly NUM_PER_SUIT cards in every suit
-        for suit in range(self.num_players):
+    @instrumentation.timed(instrumentation.DEDUCTION_SECONDS, "python")
+    def _deduce_extrema(self):
+        self._propagate()
+
+        # the interval rules above are cheap but incomplete; finish with the
+        # exact bounds over all consistent assignments
+        bounds = self._flow.tightest_bounds(self.player_minimums, self.player_maximums, self.hand_sizes)
+        if bounds is not None:
+            tight_mins, tight_maxs = bounds
             for player in range(self.num_players):
-                in_other_hands = 0
-                maybe_in_other_hands = 0
-                for other_player in range(self.num_players):
-                    if player == other_player:
-                        continue
-                    in_other_hands += self.player_minimums[other_player][suit]
-                    maybe_in_other_hands += self.player_maximums[other_player][suit]
-                self.has_at_most(player, suit, NUM_PER_SUIT - in_other_hands)
-                self.has_at_least(player, suit, NUM_PER_SUIT - maybe_in_other_hands)
+                for suit in range(self.num_players):
+                    self.has_at_least(player, suit, tight_mins[player][suit])
+                    self.has_at_most(player, suit, tight_maxs[player][suit])
+            self._propagate()
+        self._bounds_changed = False
 
-        # each player has the number of cards that they have
+    def _propagate(self):
+        # the queues hold at most n entries each, so popping from the front is cheap
+        steps = 0
+        while self._dirty_rows or self._dirty_cols:
+            while self._dirty_cols:
+                suit = self._dirty_cols.pop(0)
+                self._queued_cols[suit] = 0
+                self._deduce_suit(suit)
+                steps += 1
+            while self._dirty_rows:
+                player = self._dirty_rows.pop(0)
+                self._queued_rows[player] = 0
+                self._deduce_player(player)
+                steps += 1
+        if steps:
+            instrumentation.DEDUCTION_STEPS.inc(amount=steps)
+
+    def _deduce_suit(self, suit):
+        # there are exactly NUM_PER_SUIT cards in every suit
         for player in range(self.num_players):
-            for suit in range(self.num_players):
-                num_known_cards = 0
-                num_possible_cards = 0
-                for other_suit in range(self.num_players):
-                    if suit == other_suit:
-                        continue
-                    num_known_cards += self.player_minimums[player][other_suit]
-                    num_possible_cards += self.player_maximums[player][other_suit]
-                self.has_at_most(player, suit, self.hand_sizes[player] - num_known_cards)
-                self.has_at_least(player, suit, self.hand_sizes[player] - num_possible_cards)
+            in_other_hands = self._min_col_sums[suit] - self.player_minimums[player][suit]
+            maybe_in_other_hands = self._max_col_sums[suit] - self.player_maximums[player][suit]
+            self.has_at_most(player, suit, NUM_PER_SUIT - in_other_hands)
+            self.has_at_least(player, suit, NUM_PER_SUIT - maybe_in_other_hands)
 
+    def _deduce_player(self, player):
+        # each player has the number of cards that they have
+        hand_size = self.hand_sizes[player]
+        for suit in range(self.num_players):
+            num_known_cards = self._min_row_sums[player] - self.player_minimums[player][suit]
+            num_possible_cards = self._max_row_sums[player] - self.player_maximums[player][suit]
+            self.has_at_most(player, suit, hand_size - num_known_cards)
+            self.has_at_least(player, suit, hand_size - num_possible_cards)
+
+    @instrumentation.timed(instrumentation.ACTION_SECONDS, "asked_for")
     def asked_for(self, player, suit):
         """
         Note that some player 'player' has asked another for the suit 'suit'.
-        If this is impossible (it is known that 'player' has no 'suit's), returns
-        False and does nothing.
+        If this is impossible (no consistent assignment of cards gives 'player'
+        a 'suit'), returns False and does nothing.
 
         If it is possible, returns True and internally notes that the player
         has at least 1 card of suit 'suit'.
         """
-        logging.info("player action: {} asked for {}.\n{}".format(player, suit, self))
+        logging.debug("player action: %s asked for %s.\n%s", player, suit, self)
         self.last_actor = player
 
-        if not self.can_have(player, suit, 1):
+        if not self.is_consistent_with(player, suit, 1, NUM_PER_SUIT):
             return False
 
         self.has_at_least(player, suit, 1)
 
         return True
 
+    @instrumentation.timed(instrumentation.ACTION_SECONDS, "gave_away")
     def gave_away(self, player, suit, n):
         """
         Note that some player 'player' has given away exacly 'n' cards with suit
         'suit'.
 
-        If this is impossible (it is known that 'player' has more or less than n
-        'suit's), returns False and does nothing.
+        If this is impossible (no consistent assignment of cards gives 'player'
+        exactly n 'suit's), returns False and does nothing.
 
         If it is possible, returns True and internally notes that the player
         has given away 'n' 'suit's
         """
-        logging.info("player action: {} gave away {} {}.\n{}".format(player, n, suit, self))
+        logging.debug("player action: %s gave away %s %s.\n%s", player, n, suit, self)
         self.last_actor = player
 
-        if not self.can_have(player, suit, n):
+        if not self.is_consistent_with(player, suit, n, n):
             return False
 
         self.has_hand_size(player, self.hand_sizes[player] - n)
@@ -123,29 +349,54 @@ class GameState:
 
         return True
 
+    @instrumentation.timed(instrumentation.ACTION_SECONDS, "received")
     def received(self, player, suit, n):
         """
         Notes that 'player' has received 'n' cards of suit 'suit'. This action
         cannot fail. Returns True.
         """
-        logging.info("player action: {} received {} {}.\n{}".format(player, n, suit, self))
+        logging.debug("player action: %s received %s %s.\n%s", player, n, suit, self)
 
         self.has_hand_size(player, self.hand_sizes[player] + n)
-        self.player_minimums[player][suit] += n
-        self.player_maximums[player][suit] += n
+        self._set_minimum(player, suit, self.player_minimums[player][suit] + n)
+        self._set_maximum(player, suit, self.player_maximums[player][suit] + n)
         self.has_at_most(player, suit, NUM_PER_SUIT)
 
         return True
 
     def check_win_conditions(self):
-        self.deduce_extrema()
+        """
+        Returns (WinType.CONVERGED_STATE, last actor) once every bound is
+        exact, or else (WinType.ALL_SUIT, player, suit) for the first player
+        and suit (in that order) where the player is known to hold the whole
+        suit, or None.
+
+        The counts the bound changes keep settle a converged table; otherwise
+        CardFlow.free_cells says which cells are the same in every consistent
+        assignment, without the per-cell bounds of deduce_extrema. That only
+        runs once the game is won, so that the final bounds are exact.
+        """
+        self._propagate()
+        res = self._win()
+        if res:
+            self.deduce_extrema()
+        return res
 
-        if self.player_maximums == self.player_minimums:
+    def _win(self):
+        if not self._unconverged:
             return WinType.CONVERGED_STATE, self.last_actor
-        for player in range(self.num_players):
-            for suit in range(self.num_players):
-                if player_minimums[player][suit] == NUM_PER_SUIT:
-                    return WinType.ALL_SUIT, player, suit
+        cells = self._free_cells()
+        if cells is None:
+            if self._full_cells:
+                player, suit = divmod(min(self._full_cells), self.num_players)
+                return WinType.ALL_SUIT, player, suit
+            return None
+        free, flow = cells
+        if not any(free):
+            return WinType.CONVERGED_STATE, self.last_actor
+        for cell, cards in enumerate(flow):
+            if cards == NUM_PER_SUIT and not free[cell]:
+                return (WinType.ALL_SUIT,) + divmod(cell, self.num_players)
 
     def test_action(self, source, target, suit, n):
         print( self.asked_for(source, suit) and \
@@ -154,9 +405,24 @@ class GameState:
         print()
 
     def __str__(self):
-        return "Hand sizes[players]:  " + str(self.hand_sizes) + "\n" + \
-               "Mins[players][suits]: " + str(self.player_minimums) + "\n" + \
-               "Maxs[players][suits]: " + str(self.player_maximums)
+        return "Hand sizes[players]:  " + str(self.hand_sizes.tolist()) + "\n" + \
+               "Mins[players][suits]: " + str(list(map(list, self.player_minimums))) + "\n" + \
+               "Maxs[players][suits]: " + str(list(map(list, self.player_maximums)))
+
+def new_game_state(num_players):
+    """
+    Creates a game state for 'num_players' players using the backend named by
+    the GAME_STATE_BACKEND environment variable: "python" (GameState, the
+    default) or "numpy" (game_state_numpy.NumpyGameState, requires numpy).
+    """
+    backend = os.environ.get("GAME_STATE_BACKEND", "python")
+    if backend == "python":
+        return GameState(num_players)
+    elif backend == "numpy":
+        from game_state_numpy import NumpyGameState
+        return NumpyGameState(num_players)
+    else:
+        raise ValueError("unknown GAME_STATE_BACKEND: " + backend)
 
 if __name__ == "__main__":
     state = GameState(3)
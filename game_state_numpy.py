@@ -0,0 +1,270 @@
+import logging
+
+import numpy as np
+
+import instrumentation
+from feasibility import CardFlow
+from game_state import NUM_PER_SUIT, WinType
+
+class NumpyGameState:
+    """
+    GameState backed by small integer NumPy arrays instead of nested lists.
+    It has the same public interface as game_state.GameState, but the row and
+    column rules of deduce_extrema run as whole-array operations, which pays
+    off for large tables. Exact consistency checks still go through CardFlow.
+    """
+
+    __slots__ = ("num_players", "player_minimums", "player_maximums", "hand_sizes", "last_actor", "version",
+                 "_deduced_version", "_flow", "_legal_moves", "_legal_version", "__weakref__")
+
+    def __init__(self, num_players):
+        self.num_players = num_players
+        self.player_minimums = np.zeros((num_players, num_players), dtype=np.int8)
+        self.player_maximums = np.full((num_players, num_players), NUM_PER_SUIT, dtype=np.int8)
+        self.hand_sizes = np.full(num_players, NUM_PER_SUIT, dtype=np.int16)
+        self.last_actor = None
+        self.version = 0
+        self._deduced_version = None
+        self._flow = CardFlow(num_players, NUM_PER_SUIT)
+        self._legal_moves = {}
+        self._legal_version = None
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Copies the bounds of any GameState into a new NumpyGameState.
+        """
+        res = cls(state.num_players)
+        res.player_minimums[:] = np.asarray(state.player_minimums)
+        res.player_maximums[:] = np.asarray(state.player_maximums)
+        res.hand_sizes[:] = np.asarray(state.hand_sizes)
+        res.last_actor = state.last_actor
+        return res
+
+    def __getstate__(self):
+        return { "num_players": self.num_players, "player_minimums": self.player_minimums,
+                 "player_maximums": self.player_maximums, "hand_sizes": self.hand_sizes,
+                 "last_actor": self.last_actor, "version": self.version }
+
+    def __setstate__(self, state):
+        # states pickled before __slots__ also hold _deduced_version and _flow
+        if isinstance(state, tuple):
+            state = state[1]
+        for key in ("num_players", "player_minimums", "player_maximums", "hand_sizes", "last_actor"):
+            setattr(self, key, state[key])
+        self.version = state.get("version", 0)
+        self._deduced_version = None
+        self._flow = CardFlow(self.num_players, NUM_PER_SUIT)
+        self._legal_moves = {}
+        self._legal_version = None
+
+    def has_at_least(self, player, suit, n):
+        n = min(n, NUM_PER_SUIT)
+        if n > self.player_minimums[player, suit]:
+            self.player_minimums[player, suit] = n
+            self.version += 1
+
+    def has_at_most(self, player, suit, n):
+        n = max(n, 0)
+        if n < self.player_maximums[player, suit]:
+            self.player_maximums[player, suit] = n
+            self.version += 1
+
+    def has_exactly(self, player, suit, n):
+        self.player_maximums[player, suit] = 0
+        self.player_minimums[player, suit] = 0
+        self.version += 1
+
+    def has_hand_size(self, player, n):
+        self.hand_sizes[player] = n
+        self.version += 1
+
+    def can_have(self, player, suit, n):
+        """
+        Check if 'player' can have 'n' cards of suit 'suit'
+        """
+        return self.player_minimums[player, suit] <= n <= self.player_maximums[player, suit]
+
+    def legal_asks(self, player):
+        """
+        See GameState.legal_asks.
+        """
+        def compute():
+            cells = self._free_cells()
+            if cells is None:
+                return tuple( int(suit) for suit in np.flatnonzero(self.player_maximums[player] > 0) )
+            free, flow = cells
+            return tuple( int(suit) for suit in np.flatnonzero((flow[player] > 0) | free[player]) )
+        return self._legal(("ask", player), compute)
+
+    def legal_responses(self, player, suit):
+        """
+        See GameState.legal_responses.
+        """
+        def compute():
+            bounds = self._flow.cell_bounds(self.player_minimums.tolist(), self.player_maximums.tolist(),
+                self.hand_sizes.tolist(), player, suit)
+            if bounds is None:
+                return tuple( n for n in range(NUM_PER_SUIT + 1) if self.can_have(player, suit, n) )
+            return tuple(range(bounds[0], bounds[1] + 1))
+        return self._legal(("respond", player, suit), compute)
+
+    def _legal(self, key, compute):
+        if self._legal_version != self.version:
+            self._legal_moves = {}
+            self._legal_version = self.version
+        moves = self._legal_moves.get(key)
+        if moves is None:
+            moves = self._legal_moves[key] = compute()
+        return moves
+
+    def _free_cells(self):
+        # see GameState._free_cells
+        def compute():
+            free = self._flow.free_cells(self.player_minimums.tolist(),
+                self.player_maximums.tolist(), self.hand_sizes.tolist())
+            if free is None:
+                return None
+            return np.array(free, dtype=bool), np.array(self._flow.flow, dtype=np.int8)
+        return self._legal(("free",), compute)
+
+    def is_consistent_with(self, player, suit, low, high):
+        """
+        Check if some assignment of every card, consistent with everything
+        known so far, gives 'player' between 'low' and 'high' cards of suit
+        'suit'.
+        """
+        return self._flow.is_feasible_with(self.player_minimums.tolist(),
+            self.player_maximums.tolist(), self.hand_sizes.tolist(), player, suit, low, high)
+
+    def deduce_extrema(self):
+        """
+        Same deductions as GameState.deduce_extrema: the row and column rules
+        applied to the whole table at once until nothing changes, followed by
+        the exact bounds from CardFlow.
+        """
+        if self._deduced_version != self.version:
+            self._deduce_extrema()
+
+    @instrumentation.timed(instrumentation.DEDUCTION_SECONDS, "numpy")
+    def _deduce_extrema(self):
+        mins, maxs = deduce_extrema_batch(self.player_minimums[np.newaxis],
+            self.player_maximums[np.newaxis], self.hand_sizes[np.newaxis])
+
+        bounds = self._flow.tightest_bounds(mins[0].tolist(), maxs[0].tolist(), self.hand_sizes.tolist())
+        if bounds is not None:
+            mins, maxs = deduce_extrema_batch(
+                np.maximum(mins, np.asarray(bounds[0], dtype=np.int8)),
+                np.minimum(maxs, np.asarray(bounds[1], dtype=np.int8)),
+                self.hand_sizes[np.newaxis])
+
+        if not (np.array_equal(mins[0], self.player_minimums) and np.array_equal(maxs[0], self.player_maximums)):
+            self.player_minimums[:] = mins[0]
+            self.player_maximums[:] = maxs[0]
+            self.version += 1
+        self._deduced_version = self.version
+
+    @instrumentation.timed(instrumentation.ACTION_SECONDS, "asked_for")
+    def asked_for(self, player, suit):
+        """
+        See GameState.asked_for.
+        """
+        logging.debug("player action: %s asked for %s.\n%s", player, suit, self)
+        self.last_actor = player
+
+        if not self.is_consistent_with(player, suit, 1, NUM_PER_SUIT):
+            return False
+
+        self.has_at_least(player, suit, 1)
+
+        return True
+
+    @instrumentation.timed(instrumentation.ACTION_SECONDS, "gave_away")
+    def gave_away(self, player, suit, n):
+        """
+        See GameState.gave_away.
+        """
+        logging.debug("player action: %s gave away %s %s.\n%s", player, n, suit, self)
+        self.last_actor = player
+
+        if not self.is_consistent_with(player, suit, n, n):
+            return False
+
+        self.has_hand_size(player, self.hand_sizes[player] - n)
+        self.has_exactly(player, suit, 0)
+
+        return True
+
+    @instrumentation.timed(instrumentation.ACTION_SECONDS, "received")
+    def received(self, player, suit, n):
+        """
+        See GameState.received.
+        """
+        logging.debug("player action: %s received %s %s.\n%s", player, n, suit, self)
+
+        self.has_hand_size(player, self.hand_sizes[player] + n)
+        self.player_minimums[player, suit] += n
+        self.player_maximums[player, suit] = min(self.player_maximums[player, suit] + n, NUM_PER_SUIT)
+        self.version += 1
+
+        return True
+
+    def check_win_conditions(self):
+        """
+        See GameState.check_win_conditions.
+        """
+        res = self._win()
+        if res:
+            self.deduce_extrema()
+        return res
+
+    def _win(self):
+        cells = self._free_cells()
+        if cells is None:
+            self.deduce_extrema()
+            if np.array_equal(self.player_maximums, self.player_minimums):
+                return WinType.CONVERGED_STATE, self.last_actor
+            full = np.argwhere(self.player_minimums == NUM_PER_SUIT)
+        else:
+            free, flow = cells
+            if not free.any():
+                return WinType.CONVERGED_STATE, self.last_actor
+            full = np.argwhere(~free & (flow == NUM_PER_SUIT))
+        if len(full):
+            player, suit = full[0]
+            return WinType.ALL_SUIT, int(player), int(suit)
+
+    def __str__(self):
+        return "Hand sizes[players]:  " + str(self.hand_sizes.tolist()) + "\n" + \
+               "Mins[players][suits]: " + str(self.player_minimums.tolist()) + "\n" + \
+               "Maxs[players][suits]: " + str(self.player_maximums.tolist())
+
+def deduce_extrema_batch(minimums, maximums, hand_sizes):
+    """
+    Applies the interval rules of deduce_extrema to a stack of k states at
+    once, e.g. for analysis of archived games. 'minimums' and 'maximums' have
+    shape (k, n, n) and 'hand_sizes' has shape (k, n); all k tables must have
+    the same n. Returns the deduced (minimums, maximums) as new arrays.
+    """
+    mins = np.array(minimums, dtype=np.int16)
+    maxs = np.array(maximums, dtype=np.int16)
+    hands = np.asarray(hand_sizes, dtype=np.int16)[:, :, np.newaxis]
+
+    while True:
+        # there are exactly NUM_PER_SUIT cards in every suit
+        in_other_hands = mins.sum(axis=1, keepdims=True) - mins
+        maybe_in_other_hands = maxs.sum(axis=1, keepdims=True) - maxs
+        new_maxs = np.minimum(maxs, NUM_PER_SUIT - in_other_hands)
+        new_mins = np.maximum(mins, NUM_PER_SUIT - maybe_in_other_hands)
+
+        # each player has the number of cards that they have
+        num_known_cards = new_mins.sum(axis=2, keepdims=True) - new_mins
+        num_possible_cards = new_maxs.sum(axis=2, keepdims=True) - new_maxs
+        new_maxs = np.minimum(new_maxs, hands - num_known_cards)
+        new_mins = np.maximum(new_mins, hands - num_possible_cards)
+
+        np.clip(new_mins, 0, NUM_PER_SUIT, out=new_mins)
+        np.clip(new_maxs, 0, NUM_PER_SUIT, out=new_maxs)
+        if np.array_equal(new_mins, mins) and np.array_equal(new_maxs, maxs):
+            return mins.astype(np.int8), maxs.astype(np.int8)
+        mins, maxs = new_mins, new_maxs
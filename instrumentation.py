@@ -0,0 +1,313 @@
+"""
+Counters, latency histograms and structured events for the bot.
+
+Metrics live in this process only and cost a lock and a few additions per
+update. Structured events are logged through the "qgf.events" logger with
+their fields as %-style arguments and in the record's 'fields' attribute
+(for handlers that emit JSON), so nothing is formatted unless a handler is
+going to emit them; below INFO level an event costs one isEnabledFor call.
+
+Fields set with context() (the chat and user of the update being handled,
+by handler()) are added to every event logged inside it on the same thread.
+
+render() formats every metric in the Prometheus text format, and serve()
+answers GET /metrics with it from a background thread.
+"""
+
+import bisect
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+events_logger = logging.getLogger("qgf.events")
+
+# upper bounds in seconds, from a cheap move to a slow Telegram round trip
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# every metric created, in order of creation
+REGISTRY = []
+
+class Counter:
+    """
+    A count for every combination of label values, which are passed
+    positionally in the order of 'labelnames'.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        """
+        Returns a list of (label values, count).
+        """
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self, lines):
+        for labels, value in self.samples():
+            lines.append("{}{} {}".format(self.name, _labels(self.labelnames, labels), value))
+
+class Gauge:
+    """
+    Values kept elsewhere, read whenever the metrics are rendered: 'collect'
+    returns a list of (label values, value). Totals that only ever grow, such
+    as the counts PostgresPersistence keeps, are exposed with kind "counter".
+    """
+
+    def __init__(self, name, help, collect, labelnames=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+        REGISTRY.append(self)
+
+    def samples(self):
+        return self.collect()
+
+    def render(self, lines):
+        for labels, value in self.samples():
+            lines.append("{}{} {}".format(self.name, _labels(self.labelnames, labels), value))
+
+class Histogram:
+    """
+    Observed values (durations in seconds, by default) counted into fixed
+    buckets for every combination of label values, with their sum.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [ [ 0 ] * (len(self.buckets) + 1), 0.0 ]
+            entry[0][i] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        """
+        Returns a list of (label values, cumulative count per bucket and
+        +Inf, sum).
+        """
+        res = []
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                cumulative = []
+                running = 0
+                for count in counts:
+                    running += count
+                    cumulative.append(running)
+                res.append((labels, cumulative, total))
+        return res
+
+    def render(self, lines):
+        bounds = [ repr(float(bound)) for bound in self.buckets ] + [ "+Inf" ]
+        names = self.labelnames + ("le",)
+        for labels, cumulative, total in self.samples():
+            for bound, count in zip(bounds, cumulative):
+                lines.append("{}_bucket{} {}".format(self.name, _labels(names, labels + (bound,)), count))
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.labelnames, labels), total))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.labelnames, labels), cumulative[-1]))
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join( '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+        .replace("\n", "\\n").replace('"', '\\"')) for name, value in zip(names, values) ) + "}"
+
+def render():
+    """
+    Returns every metric in REGISTRY in the Prometheus text exposition format.
+    A Gauge whose collect() raises is left out (and the error logged).
+    """
+    lines = []
+    for metric in REGISTRY:
+        samples = []
+        try:
+            metric.render(samples)
+        except Exception:
+            logging.getLogger(__name__).exception("collecting %s failed", metric.name)
+            continue
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would drown out the bot's own log
+        pass
+
+def serve(port, host="0.0.0.0"):
+    """
+    Serves render() at http://host:port/metrics from a daemon thread, and
+    returns the server (call shutdown() on it to stop).
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics server", daemon=True).start()
+    return server
+
+def sizeof(obj):
+    """
+    Approximate memory held by 'obj' and everything it refers to through
+    containers, __dict__ and __slots__, counting shared objects once.
+    """
+    seen = set()
+    res = 0
+    stack = [ obj ]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        res += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if hasattr(obj, name):
+                    stack.append(getattr(obj, name))
+    return res
+
+def timed(histogram, *labels):
+    """
+    Decorator observing the duration of every call into 'histogram'.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labels)
+        return wrapper
+    return decorator
+
+ACTION_SECONDS = Histogram("qgf_game_state_action_seconds",
+    "Time spent applying a move to a GameState", ["action"])
+DEDUCTION_SECONDS = Histogram("qgf_deduction_seconds",
+    "Time spent deducing a GameState's bounds; the count is the number of deductions", ["backend"])
+DEDUCTION_STEPS = Counter("qgf_deduction_steps_total",
+    "Rows and columns examined by the pure Python GameState's deduction rules")
+REJECTED_MOVES = Counter("qgf_rejected_moves_total",
+    "Moves rejected because the game state rules them out", ["move"])
+HANDLER_SECONDS = Histogram("qgf_handler_seconds",
+    "Time spent handling an update, by handler", ["handler"])
+HANDLER_ERRORS = Counter("qgf_handler_errors_total",
+    "Updates whose handler raised an exception, by handler", ["handler"])
+GAMES_EVICTED = Counter("qgf_games_evicted_total",
+    "Games moved out of chat data into the archive, by reason", ["reason"])
+GAMES_RESTORED = Counter("qgf_games_restored_total",
+    "Archived games brought back into chat data")
+RENDERS = Counter("qgf_renders_total",
+    "Game messages rendered, by view and whether they were cached", ["view", "result"])
+
+_context = threading.local()
+
+@contextmanager
+def context(**fields):
+    """
+    Adds 'fields' to every event logged by this thread inside the block.
+    """
+    previous = getattr(_context, "fields", {})
+    _context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+class _Fields:
+    # formats as key=value pairs only if the record is actually emitted
+    __slots__ = ("fields",)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join( "{}={}".format(key, value) for key, value in self.fields.items() )
+
+def event(name, **fields):
+    """
+    Logs the structured event 'name' with 'fields' (and those of the
+    enclosing context()s) at INFO level.
+    """
+    if not events_logger.isEnabledFor(logging.INFO):
+        return
+    fields = dict(getattr(_context, "fields", {}), **fields)
+    events_logger.info("%s %s", name, _Fields(fields), extra={ "event": name, "fields": fields })
+
+def handler(fn, name=None):
+    """
+    Wraps the Telegram handler callback 'fn' to time it into HANDLER_SECONDS
+    and count its exceptions, with the chat and user of the update as context
+    for the events it logs.
+    """
+    name = name or fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(update, context_):
+        chat = getattr(update, "effective_chat", None)
+        user = getattr(update, "effective_user", None)
+        start = time.perf_counter()
+        try:
+            with context(chat=chat.id if chat else None, user=user.id if user else None):
+                return fn(update, context_)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+    return wrapper
@@ -1,27 +1,42 @@
 import telegram
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, \
-    InlineQueryHandler
+    InlineQueryHandler, TypeHandler, CallbackQueryHandler
 from telegram.error import TelegramError
+from telegram.utils.request import Request
 from postgrespersistence import PostgresPersistence
+from game_log import GameEvents
+from eviction import GameEviction
+from concurrency import ChatQueues
+from outbox import Outbox, QueuedBot
+import sharding
+import instrumentation
 
-import random
 import logging
 import datetime
-from enum import Enum
 import os
 
 from game_state import *
+# chat data pickled before the game classes moved to their own module refers
+# to them as __main__.Game etc., which this import keeps resolvable
+from game import *
 
 API_TOKEN = os.environ["BOT_TOKEN"]
 USERNAME = os.environ["BOT_USERNAME"]
 DM_URL = "https://t.me/{}".format(USERNAME[1:])
 
 PORT = os.environ.get("PORT", 80)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "https://telegram-quantum-go-fish.herokuapp.com/") + API_TOKEN
+# another Bot API server, such as benchmarks/fake_bot_api.py (https://api.telegram.org/bot by default)
+API_URL = os.environ.get("TELEGRAM_API_URL")
 
-def get_static_handler(command):
+# Telegram's limit on the text of a callback query's answer
+MAX_ANSWER_LENGTH = 200
+
+def get_static_handler(command, wrap=lambda callback: callback):
     """
     Given a string command, returns a CommandHandler for that string that
     responds to messages with the content of static_responses/[command].txt
+    (with its callback passed through 'wrap')
 
     Throws IOError if file does not exist or something
     """
@@ -29,223 +44,21 @@ def get_static_handler(command):
     f = open("static_responses/{}.txt".format(command), "r")
     response = f.read()
 
-    return CommandHandler(command, \
+    return CommandHandler(command, wrap(instrumentation.handler( \
         ( lambda update, context : \
-        context.bot.send_message(chat_id=update.message.chat.id, text=response) ) )
+        context.bot.send_message(chat_id=update.message.chat.id, text=response) ), name=command ) ))
 
 def handle_error(update, context):
     logging.getLogger(__name__).warning('Error %s caused by this update:\n%s', context.error, update)
 
-class Player:
-    """
-    Helper class for representing a Telegram user,
-    allowing them to set a nickname, and tag them in a Markdown-encoded message.
-    """
-    def __init__(self, id, nickname):
-        self.id = id
-        self.name = nickname
-
-    def set_nickname(self, name):
-        self.name = name
-
-    def get_markdown_tag(self):
-        return "[{}](tg://user?id={})".format(self.name, self.id)
-
-class GameStatus(Enum):
-    GAME_NOT_STARTED = 0
-    AWAITING_ASK = 1
-    AWAITING_RESPONSE = 2
-    GAME_OVER = 3
-
-class Game:
-    """
-    Represents a game of Quantum Go Fish. Maintains a GameState representing the
-    current state of the game, and a list of players and suit names with indices
-    corresponding to the GameState.
-    """
-    def __init__(self):
-        self.players = []
-        self.suit_names = []
-        self.started = False
-        self.status = GameStatus.GAME_NOT_STARTED
-
-        self.asking_player_idx = None
-        self.requested_suit_idx = None
-        self.target_player = None
-        self.target_player_idx = None
-
-    def player_join(self, player):
-        if self.started:
-            return "cannot join a game that has already started"
-        elif player in self.players:
-            return "You're already in this game!"
-        else:
-            self.players.append(player)
-
-    def player_leave(self, player):
-        if self.started:
-            return "cannot leave a game that has already started"
-        elif player not in self.players:
-            return "it's not like you were playing..."
-        else:
-            self.players.remove(player)
-
-    def game_start(self):
-        self.num_players = len(self.players)
-        self.state = GameState(self.num_players)
-        self.started = True
-
-        random.shuffle(self.players)
-        self.status = GameStatus.AWAITING_ASK
-        self.asking_player_idx = 0
-        self.asking_player = self.players[0]
-
-    def get_player(self, nickname_or_idx):
-        """
-        Get a Player object of a player in this game given 'nickname_or_idx', a
-        string that another user might use to refer to them
-        (their index in the turn order or their nickname).
-
-        Returns None if no player with that index/nickname exists.
-        """
-        if nickname_or_idx.isdigit() and int(nickname_or_idx) < len(self.players):
-            return self.players[int(nickname_or_idx)]
-        for player in self.players:
-            if player.name == nickname_or_idx:
-                return player
-
-    def get_player_md_tag(self, nickname_or_idx):
-        """
-        Wrapper for get_player that returns either the Markdown tag of the
-        player referred to by 'nickname_or_idx' or None if the player could not
-        be identified.
-        """
-
-        res = self.get_player(nickname_or_idx)
-        if res:
-            return res.get_markdown_tag()
-        else:
-            return None
-
-    def ask_for(self, player, target_str, suit):
-        if self.status != GameStatus.AWAITING_ASK:
-            return "/ask unexpected"
-
-        player_idx = self.players.index(player)
-        target = self.get_player(target_str)
-        if target:
-            target_idx = self.players.index(target)
-        else:
-            return "cannot parse target user: " + target_str
-
-        if player == target:
-            return "Players cannot ask themselves for cards. Please ask another player."
-
-        if suit in self.suit_names:
-            suit_idx = self.suit_names.index(suit)
-        else:
-            logging.info("new suit: " + suit)
-            if len(self.suit_names) == self.num_players:
-                return "could not parse suit name: " + suit
-            suit_idx = len(self.suit_names)
-            self.suit_names.append(suit)
-
-        if not self.state.asked_for(player_idx, suit_idx):
-            return "error: game state indicates that {} has at least one {} with probability zero".format(player.name, suit)
-
-        if not self.check_win_conditions():
-            self.status = GameStatus.AWAITING_RESPONSE
-            self.requested_suit = suit
-            self.requested_suit_idx = suit_idx
-            self.target_player = target
-            self.target_player_idx = target_idx
-
-    def respond_to_request(self, player, n_str):
-        if self.status != GameStatus.AWAITING_RESPONSE:
-            return "/ihave unexpected"
-
-        if n_str.isdigit():
-            n = int(n_str)
-        else:
-            return "cannot parse number of cards: " + n_str
-
-        if player == self.target_player:
-            player_idx = self.players.index(player)
-        else:
-            return "expected \"/ihave [n]\" from {}, not {}".format(self.target_player.name, player.name)
-
-        if self.state.gave_away(player_idx, self.requested_suit_idx, n):
-            self.state.received(self.asking_player_idx, self.requested_suit_idx, n)
-        else:
-            return "error: game state indicates that {} has {} \"{}\" with probability zero".format(player.name, n, self.requested_suit)
-
-        if not self.check_win_conditions():
-            self.status = GameStatus.AWAITING_ASK
-            while True:
-                self.asking_player_idx = (self.asking_player_idx + 1) % self.num_players
-                self.asking_player = self.players[self.asking_player_idx]
-
-                if self.state.hand_sizes[self.asking_player_idx] > 0:
-                    break # find the next player with a nonempty hand
-
-    def check_win_conditions(self):
-        res = self.state.check_win_conditions()
-        if res:
-            winner = self.players[ res[1] ]
-            if res[0] == WinType.CONVERGED_STATE:
-                self.win_info = "{} won by converging the game state".format(winner)
-            elif res[0] == WinType.ALL_SUIT:
-                suit = self.suit_names[ res[2] ]
-                self.win_info = "{} won by provably obtaining all {}".format(winner, suit)
-            self.status = GameStatus.GAME_OVER
-            return True
-        else:
-            return False
-
-    def player_list(self):
-        res = "List of players:\n"
-        for i, player in enumerate(self.players):
-            res += str(i) + ". "
-            res += player.name + " "
-
-            if self.status != GameStatus.GAME_NOT_STARTED:
-                res += "({} cards)".format(self.state.hand_sizes[i])
-
-            if i == self.asking_player_idx:
-                res += " (Q)"
-            elif i == self.target_player_idx and self.status == GameStatus.AWAITING_RESPONSE:
-                res += " (A)"
-
-            res += "\n"
-
-        return res
-
-    def send_blame(self, bot, chat_id):
-        if self.status == GameStatus.AWAITING_ASK:
-            msg = "It's {}'s turn!".format(self.asking_player.get_markdown_tag())
-        elif self.status == GameStatus.AWAITING_RESPONSE:
-            msg = '{}: "{}, do you have any {}?"'.format(
-                self.asking_player.name,
-                self.target_player.get_markdown_tag(),
-                self.requested_suit)
-        elif self.status == GameStatus.GAME_NOT_STARTED:
-            msg = "Waiting on anyone to start the game"
-        else:
-            msg = "Game is over! {}.\n\nFinal game state:\n".format(self.win_info)
-            for player_idx, player in enumerate(self.players):
-                msg += player.name + ": "
-                for suit_idx, suit in enumerate(self.suit_names):
-                    msg += "{} {} ".format(self.state.player_minimums[player_idx][suit_idx], suit)
-                msg += "\n"
-
-        bot.send_message(chat_id=chat_id, text=msg, parse_mode=telegram.ParseMode.MARKDOWN)
-
+@instrumentation.handler
 def newgame_handler(update, context):
     context.chat_data["game_obj"] = Game()
     update.message.reply_text("Started new Quantum Go Fish game! /joingame to join")
 
 # Telegram handlers for inquiries about players/nicknames
 
+@instrumentation.handler
 def i_am_handler(update, context):
     if context.args:
         nickname = context.args[0]
@@ -253,17 +66,24 @@ def i_am_handler(update, context):
             context.user_data["player_obj"].set_nickname(nickname)
         else:
             context.user_data["player_obj"] = Player(update.message.from_user.id, nickname)
+        # since a restart, the game's Player may be a copy of the user's
+        game = context.chat_data.get("game_obj")
+        idx = game.player_index(context.user_data["player_obj"]) if game is not None else None
+        if idx is not None and game.players[idx] is not context.user_data["player_obj"]:
+            game.players[idx].set_nickname(nickname)
 
         update.message.reply_text("Successfully changed nickname to: " + nickname)
     else:
         update.message.reply_text("Nickname required")
 
+@instrumentation.handler
 def list_player_handler(update, context):
     if "game_obj" in context.chat_data:
         update.message.reply_text(context.chat_data["game_obj"].player_list())
     else:
         update.message.reply_text("No game exists in this chat")
 
+@instrumentation.handler
 def whois_handler(update, context):
     if "game_obj" not in context.chat_data:
         update.message.reply_text("No game exists in this chat")
@@ -279,12 +99,12 @@ def whois_handler(update, context):
 
 # Telegram handlers for game management actions (joining/leaving the lobby, starting)
 # TODO shouldn't need... (see comment below)
+@instrumentation.handler
 def join_handler(update, context):
     if "game_obj" in context.chat_data:
-        if "player_obj" not in context.user_data:
-            context.user_data["player_obj"] = Player(update.message.from_user.id, update.message.from_user.first_name)
-
-        player = context.user_data["player_obj"]
+        # setdefault, since a handler in another chat may add it at the same time
+        player = context.user_data.setdefault("player_obj",
+            Player(update.message.from_user.id, update.message.from_user.first_name))
         game = context.chat_data["game_obj"]
         msg = game.player_join(player)
         if msg:
@@ -294,12 +114,12 @@ def join_handler(update, context):
     else:
         update.message.reply_text("No game exists in this chat")
 
+@instrumentation.handler
 def leave_handler(update, context):
     if "game_obj" in context.chat_data:
-        if "player_obj" not in context.user_data:
-            context.user_data["player_obj"] = Player(update.message.from_user.id, update.message.from_user.first_name)
-
-        player = context.user_data["player_obj"]
+        # setdefault, since a handler in another chat may add it at the same time
+        player = context.user_data.setdefault("player_obj",
+            Player(update.message.from_user.id, update.message.from_user.first_name))
         game = context.chat_data["game_obj"]
         msg = game.player_leave(player)
         if msg:
@@ -309,6 +129,7 @@ def leave_handler(update, context):
     else:
         update.message.reply_text("No game exists in this chat")
 
+@instrumentation.handler
 def start_game_handler(update, context):
     if "game_obj" in context.chat_data:
         context.chat_data["game_obj"].game_start()
@@ -319,12 +140,13 @@ def start_game_handler(update, context):
 # Telegram handlers for in-game actions: asking another user for something,
 # responding with how many you have, or /go fish (equivalent to "/ihave 0")
 
+@instrumentation.handler
 def ask_handler(update, context):
     if len(context.args) < 2:
         update.message.reply_text("syntax: /ask [user] [suit name]")
     elif "game_obj" not in context.chat_data:
         update.message.reply_text("No game exists in this chat")
-    elif "player_obj" not in context.user_data or context.user_data["player_obj"] not in context.chat_data["game_obj"].players:
+    elif "player_obj" not in context.user_data or context.chat_data["game_obj"].player_index(context.user_data["player_obj"]) is None:
         update.message.reply_text("It doesn't look like you're in this game")
     else:
         response = context.chat_data["game_obj"].ask_for(context.user_data["player_obj"], context.args[0], " ".join(context.args[1:]))
@@ -337,7 +159,7 @@ def ask_handler(update, context):
 def _claim(update, context, claim):
     if "game_obj" not in context.chat_data:
         update.message.reply_text("No game exists in this chat")
-    elif "player_obj" not in context.user_data or context.user_data["player_obj"] not in context.chat_data["game_obj"].players:
+    elif "player_obj" not in context.user_data or context.chat_data["game_obj"].player_index(context.user_data["player_obj"]) is None:
         update.message.reply_text("It doesn't look like you're in this game")
     else:
         response = context.chat_data["game_obj"].respond_to_request(context.user_data["player_obj"], claim)
@@ -346,54 +168,239 @@ def _claim(update, context, claim):
         else:
             context.chat_data["game_obj"].send_blame(context.bot, update.message.chat_id)
 
+@instrumentation.handler
 def have_handler(update, context):
     if len(context.args) != 1:
         update.message.reply_text("syntax: /ihave [number]")
     else:
         _claim(update, context, context.args[0])
 
+@instrumentation.handler
 def go_fish_handler(update, context):
-    _has(update, context, "0")
+    _claim(update, context, "0")
+
+@instrumentation.handler
+def undo_handler(update, context):
+    if "game_obj" not in context.chat_data:
+        update.message.reply_text("No game exists in this chat")
+    elif "player_obj" not in context.user_data or context.chat_data["game_obj"].player_index(context.user_data["player_obj"]) is None:
+        update.message.reply_text("It doesn't look like you're in this game")
+    else:
+        response = context.chat_data["game_obj"].undo(context.user_data["player_obj"])
+        if response:
+            update.message.reply_text(response)
+        else:
+            context.chat_data["game_obj"].send_blame(context.bot, update.message.chat_id)
+
+@instrumentation.handler
+def history_handler(update, context):
+    if "game_obj" in context.chat_data:
+        update.message.reply_text(context.chat_data["game_obj"].history())
+    else:
+        update.message.reply_text("No game exists in this chat")
+
+@instrumentation.handler
+def odds_handler(update, context):
+    if "game_obj" in context.chat_data:
+        update.message.reply_text(context.chat_data["game_obj"].odds())
+    else:
+        update.message.reply_text("No game exists in this chat")
 
+@instrumentation.handler
+def button_handler(update, context):
+    query = update.callback_query
+    if query.data is None:
+        # callback queries from games carry a game_short_name instead
+        query.answer()
+        return
+    game = context.chat_data.get("game_obj")
+    player = context.user_data.get("player_obj")
+    if game is None:
+        query.answer("No game exists in this chat")
+    elif player is None or game.player_index(player) is None:
+        query.answer("It doesn't look like you're in this game")
+    else:
+        response = game.press_button(player, query.data)
+        if not response:
+            query.answer()
+            game.send_blame(context.bot, query.message.chat_id)
+        elif len(response) <= MAX_ANSWER_LENGTH:
+            query.answer(response)
+        else:
+            # such as a rejected move with its proof
+            query.answer()
+            context.bot.send_message(chat_id=query.message.chat_id, text=response)
+
+@instrumentation.handler
 def blame_handler(update, context):
     if "game_obj" in context.chat_data:
         context.chat_data["game_obj"].send_blame(context.bot, update.message.chat_id)
     else:
         update.message.reply_text("No game exists in this chat")
 
-if __name__ == "__main__":
-    db_persistence = PostgresPersistence(postgres_url=os.environ["DATABASE_URL"])
-    updater = Updater(token=API_TOKEN, persistence=db_persistence)
-    dispatcher = updater.dispatcher
+def add_handlers(dispatcher, chats=None):
+    """
+    Registers the bot's commands with 'dispatcher'. With 'chats' (a
+    concurrency.ChatQueues), every handler runs in its chat's queue on the
+    dispatcher's worker pool instead of on the dispatcher thread.
+    """
+    wrap = chats.serialized if chats is not None else (lambda callback: callback)
 
-    dispatcher.add_handler(get_static_handler("help"))
-    dispatcher.add_handler(get_static_handler("feedback"))
+    dispatcher.add_handler(get_static_handler("help", wrap))
+    dispatcher.add_handler(get_static_handler("feedback", wrap))
 
-    dispatcher.add_handler(CommandHandler('newgame', newgame_handler))
-    dispatcher.add_handler(CommandHandler('listplayers', list_player_handler))
-    dispatcher.add_handler(CommandHandler('whois', whois_handler))
-    dispatcher.add_handler(CommandHandler('iam', i_am_handler))
+    dispatcher.add_handler(CommandHandler('newgame', wrap(newgame_handler)))
+    dispatcher.add_handler(CommandHandler('listplayers', wrap(list_player_handler)))
+    dispatcher.add_handler(CommandHandler('whois', wrap(whois_handler)))
+    dispatcher.add_handler(CommandHandler('iam', wrap(i_am_handler)))
 
     # TODO these 2 commands shouldn't be necessary: you should be able to just start a game, then whoever asks first
     # is in it, as well as whoever they ask. but GameState currently does not support this
-    dispatcher.add_handler(CommandHandler('joingame', join_handler))
-    dispatcher.add_handler(CommandHandler('leavegame', leave_handler))
-    dispatcher.add_handler(CommandHandler('startgame', start_game_handler))
+    dispatcher.add_handler(CommandHandler('joingame', wrap(join_handler)))
+    dispatcher.add_handler(CommandHandler('leavegame', wrap(leave_handler)))
+    dispatcher.add_handler(CommandHandler('startgame', wrap(start_game_handler)))
 
-    dispatcher.add_handler(CommandHandler('ask', ask_handler))
-    dispatcher.add_handler(CommandHandler('ihave', have_handler))
-    dispatcher.add_handler(CommandHandler('gofish', go_fish_handler))
+    dispatcher.add_handler(CommandHandler('ask', wrap(ask_handler)))
+    dispatcher.add_handler(CommandHandler('ihave', wrap(have_handler)))
+    dispatcher.add_handler(CommandHandler('gofish', wrap(go_fish_handler)))
+    dispatcher.add_handler(CommandHandler('undo', wrap(undo_handler)))
+    dispatcher.add_handler(CommandHandler('history', wrap(history_handler)))
+    dispatcher.add_handler(CommandHandler('odds', wrap(odds_handler)))
 
-    dispatcher.add_handler(CommandHandler('blame', blame_handler))
+    dispatcher.add_handler(CommandHandler('blame', wrap(blame_handler)))
+    # the buttons of Game.keyboard
+    dispatcher.add_handler(CallbackQueryHandler(wrap(button_handler), pattern=r"^[ar]:"))
 
     dispatcher.add_error_handler(handle_error)
 
+def register_metrics(dispatcher, persistence=None, chats=None, outbox=None):
+    """
+    Exposes the dispatcher's update queue, the chat queues of 'chats' (a
+    concurrency.ChatQueues, if used), the counts and times kept by
+    'persistence' (if any), the messages of 'outbox' (an outbox.Outbox, if
+    used) and the games held in memory as metrics, next to the ones in
+    instrumentation.py.
+    """
+    def games():
+        return [ chat_data["game_obj"] for chat_data in list(dispatcher.chat_data.values())
+                 if "game_obj" in chat_data ]
+
+    def games_by_status():
+        counts = { status: 0 for status in GameStatus }
+        for game in games():
+            counts[game.status] += 1
+        return [ ((status.name,), count) for status, count in counts.items() ]
+
+    def state_bytes():
+        sizes = [ instrumentation.sizeof(game.state) for game in games() if getattr(game, "state", None) is not None ]
+        return [ ((), sum(sizes) / len(sizes) if sizes else 0) ]
+
+    instrumentation.Gauge("qgf_update_queue_depth", "Updates waiting for the dispatcher",
+        lambda: [ ((), dispatcher.update_queue.qsize()) ])
+    if chats is not None:
+        instrumentation.Gauge("qgf_chat_queue_depth", "Updates waiting in the queues of busy chats",
+            lambda: [ ((), chats.depth()) ])
+        instrumentation.Gauge("qgf_busy_chats", "Chats with a handler queued or running",
+            lambda: [ ((), chats.busy_chats()) ])
+    if outbox is not None:
+        instrumentation.Gauge("qgf_outbox_depth", "Messages waiting to be sent",
+            lambda: [ ((), outbox.depth()) ])
+        instrumentation.Gauge("qgf_outbox_messages_total",
+            "Messages sent, merged into the one before, retried (after a 429 or network error) and dropped",
+            lambda: [ (("sent",), outbox.sent), (("merged",), outbox.merged), (("retried",), outbox.retries),
+                      (("dropped",), outbox.dropped) ], ["outcome"], kind="counter")
+    if persistence is not None:
+        instrumentation.Gauge("qgf_persistence_queue_depth", "Users, chats and global state waiting to be written",
+            lambda: [ ((), persistence.queue_depth) ])
+        instrumentation.Gauge("qgf_persistence_operations_total",
+            "Startup loads, lazy row fetches, user row refreshes and dumps done by the persistence",
+            lambda: [ (("load",), persistence.loads), (("fetch",), persistence.row_fetches),
+                      (("refresh",), persistence.user_refreshes), (("dump",), persistence.flushes) ],
+            ["operation"], kind="counter")
+        instrumentation.Gauge("qgf_persistence_seconds_total",
+            "Time spent in startup loads, lazy row fetches and dumps by the persistence",
+            lambda: [ (("load",), persistence.load_seconds), (("fetch",), persistence.row_fetch_seconds),
+                      (("dump",), persistence.flush_seconds) ], ["operation"], kind="counter")
+    instrumentation.Gauge("qgf_games", "Games held in memory, by status", games_by_status, ["status"])
+    instrumentation.Gauge("qgf_game_state_bytes", "Average memory held by the GameState of a started game",
+        state_bytes)
+
+def create_updater(shard=None):
+    """
+    Builds the bot's Updater from the environment, with its persistence,
+    periodic jobs and handlers, but doesn't start it. Without DATABASE_URL
+    nothing is persisted. With 'shard', an (index, count) pair, it is one of
+    the worker processes of sharding.py and its persistence only loads that
+    shard's chats.
+    """
+    db_persistence = None
+    if "DATABASE_URL" in os.environ:
+        game_events = GameEvents()
+        # bot data, callback data and conversations would be one snapshot
+        # shared by all shards; the bot keeps nothing there
+        db_persistence = PostgresPersistence(postgres_url=os.environ["DATABASE_URL"],
+            checkpoint_interval=float(os.environ.get("CHECKPOINT_INTERVAL", 10)), lazy_load=True,
+            encode_chat_data=game_events.encode_chat_data, decode_chat_data=game_events.decode_chat_data,
+            chat_events=game_events, shard=shard, store_bot_data=shard is None)
+    workers = int(os.environ.get("WORKERS", 8))
+    senders = int(os.environ.get("OUTBOX_SENDERS", 8))
+    # messages are sent by the outbox's threads, within Telegram's flood limits
+    bot = QueuedBot(API_TOKEN, base_url=API_URL, request=Request(con_pool_size=workers + 4 + senders))
+    # OUTBOX_RATE is the bot's limit; each shard sends its share of it
+    rate = float(os.environ.get("OUTBOX_RATE", 30)) / (shard[1] if shard is not None else 1)
+    bot.outbox = Outbox(bot.send_message_now, rate=rate,
+        chat_rate=float(os.environ.get("OUTBOX_CHAT_RATE", 1)),
+        group_rate=float(os.environ.get("OUTBOX_GROUP_RATE", 20 / 60)),
+        window=float(os.environ.get("OUTBOX_MERGE_WINDOW", 0.05)), senders=senders)
+    bot.outbox.start()
+    updater = Updater(bot=bot, persistence=db_persistence, workers=workers)
+    dispatcher = updater.dispatcher
+    # handlers of different chats run in parallel on the workers above
+    chats = ChatQueues(dispatcher)
+
+    if db_persistence is not None:
+        # keep telegram_persistence from growing without bound
+        if shard is None or shard[0] == 0:
+            updater.job_queue.run_repeating(lambda context: db_persistence.compact_snapshots(
+                keep=int(os.environ.get("SNAPSHOT_KEEP", 100)),
+                max_age=float(os.environ["SNAPSHOT_MAX_AGE"]) if "SNAPSHOT_MAX_AGE" in os.environ else None),
+                interval=3600, first=60)
+
+        # archive finished and idle games, and bring them back on the chat's next update
+        eviction = GameEviction(db_persistence,
+            finished_ttl=float(os.environ.get("GAME_FINISHED_TTL", 3600)),
+            idle_ttl=float(os.environ.get("GAME_IDLE_TTL", 7 * 86400)),
+            max_games=int(os.environ["MAX_GAMES_IN_MEMORY"]) if "MAX_GAMES_IN_MEMORY" in os.environ else None,
+            chats=chats)
+        dispatcher.add_handler(TypeHandler(telegram.Update, chats.serialized(eviction.touch)), group=-1)
+        updater.job_queue.run_repeating(eviction.evict, interval=600, first=600)
+
+    add_handlers(dispatcher, chats)
+
+    if "METRICS_PORT" in os.environ:
+        register_metrics(dispatcher, db_persistence, chats, bot.outbox)
+        # shard i serves its metrics on the port after shard i - 1's
+        instrumentation.serve(int(os.environ["METRICS_PORT"]) + (shard[0] if shard else 0))
+
+    return updater
+
+def configure_logging():
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         level=logging.INFO)
 
-    # updater.start_polling()
-    updater.start_webhook(listen="0.0.0.0", port=int(PORT), url_path=API_TOKEN,
-        webhook_url='https://telegram-quantum-go-fish.herokuapp.com/' + API_TOKEN)
+if __name__ == "__main__":
+    configure_logging()
+
+    if int(os.environ.get("SHARDS", 1)) > 1:
+        telegram.Bot(API_TOKEN, base_url=API_URL).set_webhook(WEBHOOK_URL)
+        sharding.serve(int(os.environ["SHARDS"]), listen="0.0.0.0", port=int(PORT), url_path=API_TOKEN,
+            database_url=os.environ.get("DATABASE_URL"))
+    else:
+        updater = create_updater()
+
+        # updater.start_polling()
+        updater.start_webhook(listen="0.0.0.0", port=int(PORT), url_path=API_TOKEN, webhook_url=WEBHOOK_URL)
 
-    updater.idle()
+        updater.idle()
+        updater.bot.outbox.stop()
@@ -0,0 +1,330 @@
+"""
+Sends the bot's messages from a queue, within Telegram's rate limits.
+
+Telegram allows a bot about 30 messages a second overall, one a second in a
+private chat and 20 a minute in a group, and answers anything beyond that
+with a 429 and how long to wait (retry_after). Handlers calling
+bot.send_message directly waited for every round trip, and under load for
+the flood limits too.
+
+With a QueuedBot, send_message (and so Message.reply_text and
+Game.send_blame) only appends the message to its chat's queue in an Outbox
+and returns None. The Outbox's sender threads send each chat's messages in
+order, at most one at a time, as a global token bucket and the chat's own
+allow. Messages to a chat that are queued within 'window' seconds of each
+other, or that piled up behind its rate limit, go out as one message. A 429
+puts the chat's messages back until retry_after has passed, and network
+errors are retried a few times before the message is dropped.
+"""
+
+import heapq
+import html
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram import ParseMode
+from telegram.error import NetworkError, RetryAfter, TelegramError
+from telegram.ext import ExtBot
+from telegram.utils.helpers import DefaultValue, escape_markdown
+
+# Telegram's limit on the length of a message's text
+MAX_MESSAGE_LENGTH = 4096
+
+def _escape(text, parse_mode):
+    """
+    Returns plain 'text' escaped to read the same when parsed as 'parse_mode'.
+    """
+    if parse_mode == ParseMode.MARKDOWN:
+        return escape_markdown(text, version=1)
+    if parse_mode == ParseMode.MARKDOWN_V2:
+        return escape_markdown(text, version=2)
+    if parse_mode == ParseMode.HTML:
+        return html.escape(text, quote=False)
+    return text
+
+# options that may differ between messages merged into one
+_REPLY_OPTIONS = ("reply_to_message_id", "allow_sending_without_reply", "reply_markup")
+
+def _options(kwargs):
+    return { key: value for key, value in kwargs.items() if key not in _REPLY_OPTIONS and value is not None }
+
+class _Bucket:
+    """
+    A token bucket of 'rate' tokens a second, holding at most 'burst'. A rate
+    of 0 means no limit.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """
+        Returns how long until a token is available.
+        """
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+class _Message:
+    __slots__ = ("text", "parse_mode", "kwargs", "count", "attempts")
+
+    def __init__(self, text, parse_mode, kwargs):
+        self.text = text
+        self.parse_mode = parse_mode
+        self.kwargs = kwargs
+        # messages merged into this one
+        self.count = 1
+        self.attempts = 0
+
+    def merge(self, other):
+        """
+        Appends 'other' to this message and returns True, or returns False if
+        they can't be one message: other options differ, this one has a
+        keyboard (which would end up in the middle) or it would be too long.
+        The merged message replies to what this one replied to.
+        """
+        if self.kwargs.get("reply_markup") is not None or _options(self.kwargs) != _options(other.kwargs):
+            return False
+        if self.parse_mode == other.parse_mode:
+            mine, theirs, parse_mode = self.text, other.text, self.parse_mode
+        elif other.parse_mode is None:
+            mine, theirs, parse_mode = self.text, _escape(other.text, self.parse_mode), self.parse_mode
+        elif self.parse_mode is None:
+            mine, theirs, parse_mode = _escape(self.text, other.parse_mode), other.text, other.parse_mode
+        else:
+            return False
+        text = mine + "\n\n" + theirs
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        self.text, self.parse_mode = text, parse_mode
+        if other.kwargs.get("reply_markup") is not None:
+            self.kwargs["reply_markup"] = other.kwargs["reply_markup"]
+        self.count += other.count
+        return True
+
+class _Chat:
+    __slots__ = ("pending", "bucket", "scheduled", "sending")
+
+    # the bucket outlives the chat's entry, which only exists while it has
+    # messages, so that a chat sending one at a time is still limited
+
+    def __init__(self, bucket):
+        # _Messages waiting to be sent, oldest first
+        self.pending = deque()
+        self.bucket = bucket
+        # whether the chat is in the Outbox's heap, or a sender has its messages
+        self.scheduled = False
+        self.sending = False
+
+class Outbox:
+    """
+    Queued messages of every chat and the threads sending them with 'send'
+    (a function taking send_message's arguments). 'rate' limits the
+    messages a second overall, 'chat_rate' and 'group_rate' those to a
+    private chat and to a group (up to 'chat_burst' at once); any rate can
+    be 0 for none.
+    """
+
+    def __init__(self, send, rate=30.0, chat_rate=1.0, group_rate=20 / 60, chat_burst=3, window=0.05,
+                 senders=4, max_attempts=5):
+        self.send = send
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.window = window
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+        self.dropped = 0
+        self._bucket = _Bucket(rate, max(1.0, rate), time.monotonic())
+        # only chats with something pending or being sent have an entry
+        self._chats = {}
+        # chat id -> _Bucket, of every chat that sent lately
+        self._buckets = {}
+        self._puts = 0
+        # (time, sequence number, chat id) of every chat waiting for a sender
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = [ threading.Thread(target=self._send_loop, name="outbox {}".format(i), daemon=True)
+                          for i in range(senders) ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Sends everything queued, then stops the sender threads.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join()
+
+    def depth(self):
+        """
+        Returns the number of messages waiting to be sent.
+        """
+        with self._cond:
+            return sum( len(chat.pending) for chat in self._chats.values() )
+
+    def _schedule(self, chat_id, chat, when):
+        chat.scheduled = True
+        heapq.heappush(self._heap, (when, next(self._sequence), chat_id))
+        self._cond.notify()
+
+    def _bucket_of(self, chat_id):
+        now = time.monotonic()
+        self._puts += 1
+        if self._puts % 1000 == 0:
+            # forget the chats whose buckets have filled up again
+            self._buckets = { other: bucket for other, bucket in self._buckets.items()
+                              if other in self._chats or bucket.delay(now) > 0 or bucket.tokens < bucket.burst }
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = _Bucket(rate, self.chat_burst, now)
+        return bucket
+
+    def put(self, chat_id, text, parse_mode=None, **kwargs):
+        """
+        Queues a message to chat 'chat_id'; the arguments are send_message's.
+        """
+        # Message.reply_text passes DefaultValue(None) for what it leaves to
+        # the bot's defaults; as None, or left out, it compares (and merges)
+        # the same as a send_message that doesn't set it
+        parse_mode = DefaultValue.get_value(parse_mode)
+        kwargs = { key: DefaultValue.get_value(value) for key, value in kwargs.items()
+                   if DefaultValue.get_value(value) is not None }
+        if kwargs.get("reply_to_message_id") is not None:
+            # by the time it's sent, the command may have been deleted
+            kwargs.setdefault("allow_sending_without_reply", True)
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat(self._bucket_of(chat_id))
+            chat.pending.append(_Message(text, parse_mode, kwargs))
+            if not chat.scheduled and not chat.sending:
+                self._schedule(chat_id, chat, time.monotonic() + self.window)
+
+    def _next(self):
+        """
+        Waits for a chat whose messages can be sent now and returns its id,
+        the chat and its pending messages merged as far as possible, or None
+        once stopping with nothing left.
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._heap)
+                    chat = self._chats[chat_id]
+                    wait = max(chat.bucket.delay(now), self._bucket.delay(now))
+                    if wait > 0:
+                        heapq.heappush(self._heap, (now + wait, next(self._sequence), chat_id))
+                        continue
+                    chat.bucket.take(now)
+                    self._bucket.take(now)
+                    chat.scheduled = False
+                    chat.sending = True
+                    message = chat.pending.popleft()
+                    while chat.pending and message.merge(chat.pending[0]):
+                        chat.pending.popleft()
+                    return chat_id, chat, message
+                if self._stopping and not self._chats:
+                    return None
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _send_loop(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            chat_id, chat, message = item
+            when = time.monotonic()
+            message.attempts += 1
+            try:
+                self.send(chat_id, message.text, parse_mode=message.parse_mode, **message.kwargs)
+                outcome = "sent"
+            except RetryAfter as error:
+                # not counted as an attempt: Telegram said when to try again
+                message.attempts -= 1
+                outcome = "retry"
+                when += error.retry_after
+            except NetworkError as error:
+                if message.attempts < self.max_attempts:
+                    outcome = "retry"
+                    when += min(0.5 * 2 ** message.attempts, 30)
+                else:
+                    outcome = "dropped"
+                    logging.getLogger(__name__).warning("dropped a message to %s after %d attempts: %s",
+                        chat_id, message.attempts, error)
+            except TelegramError as error:
+                # BadRequest, Unauthorized (the bot was removed) and the like
+                outcome = "dropped"
+                logging.getLogger(__name__).warning("dropped a message to %s: %s", chat_id, error)
+
+            with self._cond:
+                if outcome == "retry":
+                    self.retries += 1
+                    chat.pending.appendleft(message)
+                elif outcome == "dropped":
+                    self.dropped += message.count
+                else:
+                    self.sent += 1
+                    self.merged += message.count - 1
+                chat.sending = False
+                if chat.pending:
+                    self._schedule(chat_id, chat, when)
+                else:
+                    del self._chats[chat_id]
+                    # stop() may be waiting for this
+                    self._cond.notify_all()
+
+class QueuedBot(ExtBot):
+    """
+    A Bot whose send_message queues the message in 'outbox' (once set) and
+    returns None instead of the Message sent.
+    """
+
+    __slots__ = ("outbox",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = None
+
+    def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        if self.outbox is None:
+            return super().send_message(chat_id, text, parse_mode=parse_mode, **kwargs)
+        self.outbox.put(chat_id, text, parse_mode=parse_mode, **kwargs)
+        return None
+
+    def send_message_now(self, chat_id, text, **kwargs):
+        """
+        Sends a message right away, as Bot.send_message does.
+        """
+        return super().send_message(chat_id, text, **kwargs)
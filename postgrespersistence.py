@@ -15,14 +15,22 @@
 #
 # SEE: https://github.com/ncurrault/python-telegram-bot-postgres-persistence/
 
+import hashlib
+import logging
 import pickle
+import threading
+import time
 from collections import defaultdict
 from urllib.parse import urlparse
 import psycopg2
+import psycopg2.extensions
 from typing import (
     Any,
+    Callable,
     Dict,
+    List,
     Optional,
+    Set,
     Tuple,
     overload,
     cast,
@@ -33,7 +41,333 @@ from telegram.ext import BasePersistence
 from telegram.ext.utils.types import UD, CD, BD, ConversationDict, CDCData
 from telegram.ext.contexttypes import ContextTypes
 
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS telegram_user_data (
+    user_id BIGINT PRIMARY KEY,
+    data BYTEA NOT NULL,
+    updated TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS telegram_chat_data (
+    chat_id BIGINT PRIMARY KEY,
+    data BYTEA NOT NULL,
+    updated TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS telegram_persistence (
+    data BYTEA NOT NULL,
+    updated TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS telegram_persistence_updated_idx ON telegram_persistence (updated DESC);
+CREATE TABLE IF NOT EXISTS telegram_chat_events (
+    chat_id BIGINT NOT NULL,
+    stream BIGINT NOT NULL,
+    seq INTEGER NOT NULL,
+    data BYTEA NOT NULL,
+    PRIMARY KEY (chat_id, stream, seq)
+);
+CREATE TABLE IF NOT EXISTS telegram_chat_archive (
+    chat_id BIGINT NOT NULL,
+    key TEXT NOT NULL,
+    data BYTEA NOT NULL,
+    archived TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (chat_id, key)
+);
+"""
+
+# Statements prepared once per pooled connection and run with EXECUTE.
+_STATEMENTS = {
+    'qgf_load_users': "SELECT user_id, data, updated FROM telegram_user_data",
+    'qgf_load_chats': "SELECT chat_id, data FROM telegram_chat_data",
+    'qgf_load_user_ids': "SELECT user_id FROM telegram_user_data",
+    'qgf_load_chat_ids': "SELECT chat_id FROM telegram_chat_data",
+    # the chats of shard $2 out of $1, i.e. those with chat_id mod $1 = $2 (as
+    # Python computes it, non-negative for negative ids too)
+    'qgf_load_shard_chats': "SELECT chat_id, data FROM telegram_chat_data WHERE ((chat_id % $1) + $1) % $1 = $2",
+    'qgf_load_shard_chat_ids': "SELECT chat_id FROM telegram_chat_data WHERE ((chat_id % $1) + $1) % $1 = $2",
+    'qgf_load_user': "SELECT data, updated FROM telegram_user_data WHERE user_id = $1",
+    'qgf_user_updated': "SELECT updated FROM telegram_user_data WHERE user_id = $1",
+    'qgf_load_chat': "SELECT data FROM telegram_chat_data WHERE chat_id = $1",
+    'qgf_load_snapshot': "SELECT data FROM telegram_persistence ORDER BY updated DESC LIMIT 1",
+    'qgf_upsert_user': "INSERT INTO telegram_user_data (user_id, data) VALUES ($1, $2) "
+                       "ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated = now() "
+                       "RETURNING updated",
+    'qgf_upsert_chat': "INSERT INTO telegram_chat_data (chat_id, data) VALUES ($1, $2) "
+                       "ON CONFLICT (chat_id) DO UPDATE SET data = EXCLUDED.data, updated = now()",
+    'qgf_insert_snapshot': "INSERT INTO telegram_persistence (data) VALUES ($1)",
+    'qgf_load_events': "SELECT data FROM telegram_chat_events WHERE chat_id = $1 AND stream = $2 ORDER BY seq",
+    'qgf_upsert_event': "INSERT INTO telegram_chat_events (chat_id, stream, seq, data) VALUES ($1, $2, $3, $4) "
+                        "ON CONFLICT (chat_id, stream, seq) DO UPDATE SET data = EXCLUDED.data",
+    'qgf_truncate_events': "DELETE FROM telegram_chat_events WHERE chat_id = $1 AND stream = $2 AND seq >= $3",
+    'qgf_archive': "INSERT INTO telegram_chat_archive (chat_id, key, data) VALUES ($1, $2, $3) "
+                   "ON CONFLICT (chat_id, key) DO UPDATE SET data = EXCLUDED.data, archived = now()",
+    'qgf_load_archived': "SELECT data FROM telegram_chat_archive WHERE chat_id = $1 AND key = $2",
+    'qgf_archived_ids': "SELECT chat_id FROM telegram_chat_archive WHERE key = $1",
+    'qgf_snapshot_cutoff_keep': "SELECT updated FROM telegram_persistence ORDER BY updated DESC OFFSET $1 LIMIT 1",
+    'qgf_snapshot_cutoff_age': "SELECT now()::timestamp - $1 * interval '1 second'",
+    # ctid rather than a key, since tables created by older versions have none
+    'qgf_delete_snapshots': "DELETE FROM telegram_persistence WHERE ctid = ANY(ARRAY("
+                            "SELECT ctid FROM telegram_persistence WHERE updated < $1 LIMIT $2))",
+    'qgf_snapshots_size': "SELECT pg_total_relation_size('telegram_persistence')",
+}
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection that remembers whether _STATEMENTS have been prepared
+    in its session.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements_prepared = False
+        self.last_used = time.monotonic()
+
+    def prepare_statements(self) -> None:
+        """
+        Prepares _STATEMENTS in this session if that hasn't happened yet. Must
+        be called at the start of a transaction, since it commits.
+        """
+        if self.statements_prepared:
+            return
+        with self.cursor() as cur:
+            for name, statement in _STATEMENTS.items():
+                cur.execute(f"PREPARE {name} AS {statement};")
+        self.commit()
+        self.statements_prepared = True
+
+class PostgresConnectionPool:
+    """
+    Thread-safe pool of at most 'size' connections, opened on demand and kept
+    open between uses. A connection idle for more than
+    'health_check_interval' seconds is checked with a trivial query before
+    it is handed out, and one that fails during use is discarded and the work
+    retried once on a fresh connection.
+
+    Time spent opening connections and time spent running work are counted
+    separately (see stats()).
+    """
+
+    def __init__(self, psycopg2_kwargs: Dict[str, Any], size: int = 2, health_check_interval: float = 30.0):
+        self.psycopg2_kwargs = psycopg2_kwargs
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self._idle: List[_PooledConnection] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+        self.connects = 0
+        self.connect_seconds = 0.0
+        self.reconnects = 0
+        self.runs = 0
+        self.run_seconds = 0.0
+
+    def _connect(self) -> _PooledConnection:
+        start = time.perf_counter()
+        conn = psycopg2.connect(connection_factory=_PooledConnection, **self.psycopg2_kwargs)
+        self.connect_seconds += time.perf_counter() - start
+        self.connects += 1
+        return conn
+
+    def _is_healthy(self, conn: _PooledConnection) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self) -> _PooledConnection:
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return self._connect()
+                if self._is_healthy(conn):
+                    return conn
+                self._close(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _checkin(self, conn: _PooledConnection, discard: bool = False) -> None:
+        try:
+            if discard or conn.closed:
+                self._close(conn)
+            else:
+                conn.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _close(conn: _PooledConnection) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def run(self, work: Callable[[_PooledConnection], Any]) -> Any:
+        """
+        Calls work(conn) with a pooled connection and returns its result. 'work'
+        is responsible for committing; anything left uncommitted is rolled
+        back.
+        """
+        for attempt in range(2):
+            conn = self._checkout()
+            start = time.perf_counter()
+            try:
+                result = work(conn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # the connection itself failed (server restart, dropped TCP
+                # connection, ...): nothing was committed, so try again once
+                self._checkin(conn, discard=True)
+                if attempt:
+                    raise
+                self.reconnects += 1
+                continue
+            except BaseException:
+                try:
+                    conn.rollback()
+                    self._checkin(conn)
+                except psycopg2.Error:
+                    self._checkin(conn, discard=True)
+                raise
+            self.run_seconds += time.perf_counter() - start
+            self.runs += 1
+            self._checkin(conn)
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'connects': self.connects,
+            'connect_seconds': self.connect_seconds,
+            'reconnects': self.reconnects,
+            'runs': self.runs,
+            'run_seconds': self.run_seconds,
+            'idle_connections': len(self._idle),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+class _LazyRows(defaultdict):
+    """
+    defaultdict of user or chat data that only holds what has been used so
+    far: the first access to a key in 'known_ids' fetches its row with
+    'fetch', and any other missing key gets a fresh default value.
+    Membership tests, get() and iteration only see loaded entries.
+
+    Fetches run outside the dict-wide lock, under a lock of their own key,
+    so that cold loads of different chats overlap and only accesses to the
+    key being fetched wait for it.
+    """
+
+    def __init__(self, default_factory: Callable[[], Any], fetch: Callable[[int], Any], known_ids: Set[int]):
+        super().__init__(default_factory)
+        self.fetch = fetch
+        self.known_ids = known_ids
+        self.lock = threading.Lock()
+        # the locks of the keys being fetched
+        self.fetching: Dict[int, threading.Lock] = {}
+
+    def __missing__(self, key: int) -> Any:
+        with self.lock:
+            if key in self:
+                return self[key]
+            if key not in self.known_ids:
+                return super().__missing__(key)
+            key_lock = self.fetching.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                # fetched (or found missing) while this thread waited
+                if key in self:
+                    return self[key]
+                if key not in self.known_ids:
+                    return super().__missing__(key)
+            try:
+                # if the fetch fails, the key stays known, so that the next
+                # access tries again instead of getting (and later writing
+                # over the row with) a fresh default
+                value = self.fetch(key)
+            except BaseException:
+                with self.lock:
+                    self.fetching.pop(key, None)
+                raise
+            with self.lock:
+                self.fetching.pop(key, None)
+                self.known_ids.discard(key)
+                if value is not None:
+                    self[key] = value
+                    return value
+                return super().__missing__(key)
+
 class PostgresPersistence(BasePersistence[UD, CD, BD]):
+    """
+    Persistence in PostgreSQL. User data and chat data are stored as one row
+    per user/chat (telegram_user_data, telegram_chat_data); bot data,
+    callback data and conversations are stored together as snapshots in
+    telegram_persistence.
+
+    update_* only marks entries dirty. Dirty entries are written when
+    flush() is called or, if on_flush is False, on every update; entries
+    whose serialized form did not change since they were last written are
+    skipped, so a write costs what changed rather than the whole bot's state.
+    update_* may be called from several threads at once (handlers run on the
+    dispatcher's worker pool, see concurrency.py); writes happen one at a
+    time.
+
+    Connections come from a PostgresConnectionPool of 'pool_size'
+    connections, and the load and dump queries are prepared once per
+    connection.
+
+    If 'checkpoint_interval' (seconds) is given, on_flush is ignored and
+    writes happen behind the handlers' backs: update_* only marks entries
+    dirty (repeated updates to the same chat or user coalesce into one row),
+    and a background thread writes everything dirty once the oldest pending
+    change is 'checkpoint_interval' seconds old or 'checkpoint_size' entries
+    are pending. A crash loses at most one interval of changes.
+
+    With 'lazy_load', startup only reads which users and chats exist; each
+    one's row is fetched the first time an update for it arrives, so startup
+    time does not grow with the number of chats ever seen.
+
+    Chat data rows are serialized with 'encode_chat_data' and read back with
+    'decode_chat_data' (pickle by default); the decoder also has to accept
+    rows written by whatever encoder was used before.
+
+    'chat_events' moves append-only parts of chat data into rows of their
+    own (telegram_chat_events), so that they don't rewrite the chat's row
+    (see game_log.GameEvents). It needs two methods:
+    events(chat_data) returns a dict of lists of bytes, the event streams in
+    the chat data keyed by an integer stream id; and
+    replay(chat_data, stream, events) applies the stored 'events' of 'stream'
+    to freshly decoded chat data and keeps that very list as the stream. A
+    dump writes the events that aren't the same objects as the ones last
+    written, and deletes stored events past the end of a stream that got
+    shorter, or of a stream that is gone.
+
+    With 'shard', an (index, count) pair, only the chats with chat_id mod
+    count == index are loaded, for one of the worker processes of
+    sharding.py; user rows are shared by all shards and fetched by whichever
+    needs them. Since another shard may write a user's row too, each shard
+    remembers the row's 'updated' time as it last read or wrote it, and
+    before a handler sees a user's data (refresh_user_data) re-fetches the
+    row if it has been written since. Changes of its own that this shard
+    hasn't written yet are kept instead; the later write wins.
+
+    archive() and load_archived() keep values taken out of the chat data
+    (see eviction.GameEviction) in telegram_chat_archive.
+    """
+
     __slots__ = (
         'postgres_url',
         'on_flush',
@@ -43,6 +377,37 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         'callback_data',
         'conversations',
         'context_types',
+        'psycopg2_kwargs',
+        'pool',
+        '_schema_ready',
+        '_dirty_users',
+        '_dirty_chats',
+        '_dirty_global',
+        '_dirty_since',
+        '_written',
+        'checkpoint_interval',
+        'checkpoint_size',
+        '_lock',
+        '_dump_lock',
+        '_wakeup',
+        '_writer',
+        '_stopping',
+        'flushes',
+        'flush_seconds',
+        'last_flush_seconds',
+        'loads',
+        'load_seconds',
+        'row_fetches',
+        'row_fetch_seconds',
+        'user_refreshes',
+        '_user_updated',
+        'lazy_load',
+        'shard',
+        '_loaded',
+        'encode_chat_data',
+        'decode_chat_data',
+        'chat_events',
+        '_written_events',
     )
 
     @overload
@@ -54,6 +419,15 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         store_bot_data: bool = True,
         on_flush: bool = True,
         store_callback_data: bool = False,
+        pool_size: int = 2,
+        health_check_interval: float = 30.0,
+        checkpoint_interval: Optional[float] = None,
+        checkpoint_size: int = 100,
+        lazy_load: bool = False,
+        encode_chat_data: Callable[[CD], bytes] = pickle.dumps,
+        decode_chat_data: Callable[[bytes], CD] = pickle.loads,
+        chat_events: Any = None,
+        shard: Optional[Tuple[int, int]] = None,
     ):
         ...
 
@@ -67,6 +441,15 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         on_flush: bool = True,
         store_callback_data: bool = False,
         context_types: ContextTypes[Any, UD, CD, BD] = None,
+        pool_size: int = 2,
+        health_check_interval: float = 30.0,
+        checkpoint_interval: Optional[float] = None,
+        checkpoint_size: int = 100,
+        lazy_load: bool = False,
+        encode_chat_data: Callable[[CD], bytes] = pickle.dumps,
+        decode_chat_data: Callable[[bytes], CD] = pickle.loads,
+        chat_events: Any = None,
+        shard: Optional[Tuple[int, int]] = None,
     ):
         ...
 
@@ -79,6 +462,15 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         on_flush: bool = True,
         store_callback_data: bool = False,
         context_types: ContextTypes[Any, UD, CD, BD] = None,
+        pool_size: int = 2,
+        health_check_interval: float = 30.0,
+        checkpoint_interval: Optional[float] = None,
+        checkpoint_size: int = 100,
+        lazy_load: bool = False,
+        encode_chat_data: Callable[[CD], bytes] = pickle.dumps,
+        decode_chat_data: Callable[[bytes], CD] = pickle.loads,
+        chat_events: Any = None,
+        shard: Optional[Tuple[int, int]] = None,
     ):
         super().__init__(
             store_user_data=store_user_data,
@@ -95,8 +487,16 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
             "host": parsed_url.hostname,
             "port": parsed_url.port,
         }
+        self.pool = PostgresConnectionPool(self.psycopg2_kwargs, pool_size, health_check_interval)
+        self._schema_ready = False
 
         self.on_flush = on_flush
+        self.lazy_load = lazy_load
+        self.shard = shard
+        self.encode_chat_data = encode_chat_data
+        self.decode_chat_data = decode_chat_data
+        self.chat_events = chat_events
+        self._loaded = False
         self.user_data: Optional[DefaultDict[int, UD]] = None
         self.chat_data: Optional[DefaultDict[int, CD]] = None
         self.bot_data: Optional[BD] = None
@@ -104,84 +504,553 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         self.conversations: Optional[Dict[str, Dict[Tuple, object]]] = None
         self.context_types = cast(ContextTypes[Any, UD, CD, BD], context_types or ContextTypes())
 
+        self._dirty_users: Set[int] = set()
+        self._dirty_chats: Set[int] = set()
+        self._dirty_global = False
+        # monotonic time of the oldest change not yet written
+        self._dirty_since: Optional[float] = None
+        # digest of the last serialized form written for every row, keyed by
+        # ('user', id), ('chat', id) or 'global'
+        self._written: Dict[object, bytes] = {}
+        # the event lists last written for every chat, keyed by stream
+        self._written_events: Dict[int, Dict[int, List[bytes]]] = {}
+        # with 'shard', the 'updated' time of every user row as last read or
+        # written here
+        self._user_updated: Dict[int, Any] = {}
+
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_size = checkpoint_size
+        self._lock = threading.RLock()
+        self._dump_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._writer: Optional[threading.Thread] = None
+        self._stopping = False
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.row_fetches = 0
+        self.row_fetch_seconds = 0.0
+        self.user_refreshes = 0
+
+    def _create_schema(self, conn: _PooledConnection) -> None:
+        with conn.cursor() as cur:
+            cur.execute(_SCHEMA)
+        conn.commit()
+        self._schema_ready = True
+
     def _load(self) -> None:
-        conn = psycopg2.connect(**self.psycopg2_kwargs)
-        try:
+        start = time.perf_counter()
+
+        def load(conn: _PooledConnection) -> Tuple[list, list, Any]:
+            if not self._schema_ready:
+                self._create_schema(conn)
+            conn.prepare_statements()
             with conn.cursor() as cur:
-                cur.execute("SELECT data FROM telegram_persistence ORDER BY updated DESC LIMIT 1;")
-                row = cur.fetchone()
-                if row is None:
-                    self.conversations = {}
-                    self.user_data = defaultdict(self.context_types.user_data)
-                    self.chat_data = defaultdict(self.context_types.chat_data)
-                    self.bot_data = self.context_types.bot_data()
-                    self.callback_data = None
+                if self.lazy_load:
+                    cur.execute("EXECUTE qgf_load_user_ids;")
+                    user_rows = cur.fetchall()
+                    if self.shard is None:
+                        cur.execute("EXECUTE qgf_load_chat_ids;")
+                    else:
+                        cur.execute("EXECUTE qgf_load_shard_chat_ids (%s, %s);", (self.shard[1], self.shard[0]))
+                    chat_rows = cur.fetchall()
                 else:
-                    data = pickle.loads(row[0])
-                    self.user_data = defaultdict(self.context_types.user_data, data['user_data'])
-                    self.chat_data = defaultdict(self.context_types.chat_data, data['chat_data'])
-                    # For backwards compatibility with dumps not containing bot data
-                    self.bot_data = data.get('bot_data', self.context_types.bot_data())
-                    self.callback_data = data.get('callback_data', {})
-                    self.conversations = data['conversations']
+                    cur.execute("EXECUTE qgf_load_users;")
+                    user_rows = cur.fetchall()
+                    if self.shard is None:
+                        cur.execute("EXECUTE qgf_load_chats;")
+                    else:
+                        cur.execute("EXECUTE qgf_load_shard_chats (%s, %s);", (self.shard[1], self.shard[0]))
+                    chat_rows = cur.fetchall()
+                cur.execute("EXECUTE qgf_load_snapshot;")
+                row = cur.fetchone()
+            conn.rollback()
+            return user_rows, chat_rows, row
+
+        try:
+            user_rows, chat_rows, row = self.pool.run(load)
+
+            if self.lazy_load:
+                self.user_data = _LazyRows(self.context_types.user_data,
+                    lambda user_id: self._fetch_row('user', user_id), { user_id for user_id, in user_rows })
+                self.chat_data = _LazyRows(self.context_types.chat_data,
+                    lambda chat_id: self._fetch_row('chat', chat_id), { chat_id for chat_id, in chat_rows })
+            else:
+                self.user_data = defaultdict(self.context_types.user_data)
+                self.chat_data = defaultdict(self.context_types.chat_data)
+                for user_id, data, updated in user_rows:
+                    self.user_data[user_id] = pickle.loads(data)
+                    self._written[('user', user_id)] = self._digest(data)
+                    self._saw_user(user_id, updated)
+                for chat_id, data in chat_rows:
+                    self.chat_data[chat_id] = self.decode_chat_data(data)
+                    self._written[('chat', chat_id)] = self._digest(data)
+                    self._load_events(chat_id, self.chat_data[chat_id])
+
+            if row is None:
+                self.conversations = {}
+                self.bot_data = self.context_types.bot_data()
+                self.callback_data = None
+            else:
+                data = pickle.loads(row[0])
+                # For backwards compatibility with dumps not containing bot data
+                self.bot_data = data.get('bot_data', self.context_types.bot_data())
+                self.callback_data = data.get('callback_data', {})
+                self.conversations = data['conversations']
+
+                # Snapshots written before per-row storage also hold all user
+                # and chat data; carry it over into the row tables. (A shard
+                # can't tell whether the tables are empty, so it leaves this
+                # to an unsharded start.)
+                if self.shard is None and not user_rows and data.get('user_data'):
+                    self.user_data.update(data['user_data'])
+                    for user_id in data['user_data']:
+                        self._mark('user', user_id)
+                if self.shard is None and not chat_rows and data.get('chat_data'):
+                    self.chat_data.update(data['chat_data'])
+                    for chat_id in data['chat_data']:
+                        self._mark('chat', chat_id)
+            self._written['global'] = self._digest(self._global_snapshot())
+            self._loaded = True
+            self.load_seconds += time.perf_counter() - start
+            self.loads += 1
         except pickle.UnpicklingError as exc:
             raise TypeError(f"Database does not contain valid pickle data") from exc
         except Exception as exc:
             raise TypeError(f"Something went wrong loading from database/unpickling") from exc
+
+    def _fetch_row(self, kind: str, key: int) -> Any:
+        """
+        Fetches and decodes a single user ('user') or chat ('chat') row, or
+        returns None if it doesn't exist.
+        """
+        def fetch(conn: _PooledConnection) -> Optional[Tuple[bytes]]:
+            conn.prepare_statements()
+            with conn.cursor() as cur:
+                cur.execute(f"EXECUTE qgf_load_{kind} (%s);", (key,))
+                row = cur.fetchone()
+            conn.rollback()
+            return row
+
+        start = time.perf_counter()
+        try:
+            row = self.pool.run(fetch)
+            if row is None:
+                return None
+            self._written[(kind, key)] = self._digest(row[0])
+            if kind == 'user':
+                self._saw_user(key, row[1])
+                return pickle.loads(row[0])
+            data = self.decode_chat_data(row[0])
+            self._load_events(key, data)
+            return data
         finally:
-            conn.close()
+            self.row_fetch_seconds += time.perf_counter() - start
+            self.row_fetches += 1
+
+    def _load_events(self, chat_id: int, chat_data: Any) -> None:
+        """
+        Fetches and replays the stored event streams of freshly decoded chat
+        data, if chat_events is used.
+        """
+        if self.chat_events is None:
+            return
+        streams = list(self.chat_events.events(chat_data))
+        if not streams:
+            return
+
+        def fetch(conn: _PooledConnection) -> Dict[int, List[bytes]]:
+            conn.prepare_statements()
+            res = {}
+            with conn.cursor() as cur:
+                for stream in streams:
+                    cur.execute("EXECUTE qgf_load_events (%s, %s);", (chat_id, stream))
+                    res[stream] = [ bytes(data) for data, in cur.fetchall() ]
+            conn.rollback()
+            return res
+
+        written = {}
+        for stream, events in self.pool.run(fetch).items():
+            self.chat_events.replay(chat_data, stream, events)
+            written[stream] = list(events)
+        self._written_events[chat_id] = written
+
+    def _changed_events(self, ids: Set[int], source: Dict[int, Any]) -> Tuple[list, list, Dict[int, Dict[int, list]]]:
+        """
+        Compares the event streams of the dirty chats 'ids' of 'source' with
+        what was last written. Returns the (chat_id, stream, seq, data) rows to
+        write, the (chat_id, stream, length) streams to cut back to 'length'
+        events first, and the streams to remember as written afterwards.
+        """
+        rows: list = []
+        truncated: list = []
+        written: Dict[int, Dict[int, list]] = {}
+        for chat_id in ids:
+            if chat_id not in source:
+                continue
+            try:
+                streams = self.chat_events.events(source[chat_id])
+            except RuntimeError:
+                # changed by a handler while being read; catch it next time
+                self._mark('chat', chat_id)
+                continue
+            written[chat_id] = {}
+            # a stream that left the chat data (e.g. its game was archived) is deleted
+            for stream in self._written_events.get(chat_id, {}):
+                if stream not in streams:
+                    truncated.append((chat_id, stream, 0))
+            for stream, events in streams.items():
+                events = list(events)
+                old = self._written_events.get(chat_id, {}).get(stream, [])
+                same = 0
+                while same < len(old) and same < len(events) and old[same] is events[same]:
+                    same += 1
+                if same < len(old):
+                    truncated.append((chat_id, stream, same))
+                rows.extend( (chat_id, stream, seq, events[seq]) for seq in range(same, len(events)) )
+                written[chat_id][stream] = events
+        return rows, truncated, written
+
+    @staticmethod
+    def _digest(data: bytes) -> bytes:
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def _global_snapshot(self) -> bytes:
+        return pickle.dumps({
+            'conversations': self.conversations,
+            'bot_data': self.bot_data,
+            'callback_data': self.callback_data,
+        })
+
+    def _changed_rows(self, kind: str, ids: Set[int], source: Dict[int, Any]) -> list:
+        """
+        Serializes the dirty entries 'ids' of 'source' and returns the
+        (id, data) pairs that differ from what was last written.
+        """
+        encode = self.encode_chat_data if kind == 'chat' else pickle.dumps
+        rows = []
+        for key in ids:
+            if key not in source:
+                continue
+            try:
+                data = encode(source[key])
+            except RuntimeError:
+                # changed by a handler while being pickled; catch it next time
+                self._mark(kind, key)
+                continue
+            if self._written.get((kind, key)) != self._digest(data):
+                rows.append((key, data))
+        return rows
 
     def _dump(self) -> None:
-        conn = psycopg2.connect(**self.psycopg2_kwargs)
+        # handlers on several threads may dump at once (without write-behind
+        # and flush mode); one at a time, so that a row serialized earlier is
+        # never written over one serialized later
+        with self._dump_lock:
+            self._dump_dirty()
+
+    def _dump_dirty(self) -> None:
+        start = time.perf_counter()
+        with self._lock:
+            dirty_users, self._dirty_users = self._dirty_users, set()
+            dirty_chats, self._dirty_chats = self._dirty_chats, set()
+            dirty_global, self._dirty_global = self._dirty_global, False
+            self._dirty_since = None
+
+        user_rows = self._changed_rows('user', dirty_users, self.user_data or {})
+        chat_rows = self._changed_rows('chat', dirty_chats, self.chat_data or {})
+        event_rows: list = []
+        truncated: list = []
+        events_written: Dict[int, Dict[int, list]] = {}
+        if self.chat_events is not None:
+            event_rows, truncated, events_written = self._changed_events(dirty_chats, self.chat_data or {})
+        global_data = None
+        if dirty_global:
+            global_data = self._global_snapshot()
+            if self._written.get('global') == self._digest(global_data):
+                global_data = None
+
+        if not user_rows and not chat_rows and not event_rows and not truncated and global_data is None:
+            self._written_events.update(events_written)
+            return
+
+        user_updated: list = []
+
+        def dump(conn: _PooledConnection) -> None:
+            del user_updated[:]
+            if not self._schema_ready:
+                self._create_schema(conn)
+            conn.prepare_statements()
+            with conn.cursor() as cur:
+                for user_row in user_rows:
+                    cur.execute("EXECUTE qgf_upsert_user (%s, %s);", user_row)
+                    user_updated.append(cur.fetchone()[0])
+                if chat_rows:
+                    cur.executemany("EXECUTE qgf_upsert_chat (%s, %s);", chat_rows)
+                if truncated:
+                    cur.executemany("EXECUTE qgf_truncate_events (%s, %s, %s);", truncated)
+                if event_rows:
+                    cur.executemany("EXECUTE qgf_upsert_event (%s, %s, %s, %s);", event_rows)
+                if global_data is not None:
+                    cur.execute("EXECUTE qgf_insert_snapshot (%s);", (global_data,))
+            conn.commit()
+
         try:
+            self.pool.run(dump)
+        except Exception:
+            # nothing was written, so everything is still dirty
+            for key, _ in user_rows:
+                self._mark('user', key)
+            for key, _ in chat_rows:
+                self._mark('chat', key)
+            for key in events_written:
+                self._mark('chat', key)
+            if global_data is not None:
+                self._mark('global')
+            raise
+
+        for (key, data), updated in zip(user_rows, user_updated):
+            self._written[('user', key)] = self._digest(data)
+            self._saw_user(key, updated)
+        for key, data in chat_rows:
+            self._written[('chat', key)] = self._digest(data)
+        self._written_events.update(events_written)
+        if global_data is not None:
+            self._written['global'] = self._digest(global_data)
+
+        self.last_flush_seconds = time.perf_counter() - start
+        self.flush_seconds += self.last_flush_seconds
+        self.flushes += 1
+
+    def _mark(self, kind: str, key: Optional[int] = None) -> None:
+        with self._lock:
+            if kind == 'user':
+                self._dirty_users.add(key)
+            elif kind == 'chat':
+                self._dirty_chats.add(key)
+            else:
+                self._dirty_global = True
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+
+    def _changed(self) -> None:
+        """
+        Called after entries were marked dirty by an update_* method: either
+        write them now, leave them for flush(), or wake the writer thread.
+        """
+        if self.checkpoint_interval is None:
+            if not self.on_flush:
+                self._dump()
+            return
+        with self._wakeup:
+            if self._writer is None:
+                self._stopping = False
+                self._writer = threading.Thread(target=self._write_behind, name="PostgresPersistence writer",
+                    daemon=True)
+                self._writer.start()
+            if self.queue_depth >= self.checkpoint_size:
+                self._wakeup.notify()
+
+    def _write_behind(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._stopping:
+                    if self._dirty_since is None:
+                        timeout = None
+                    else:
+                        timeout = self._dirty_since + self.checkpoint_interval - time.monotonic()
+                        if timeout <= 0 or self.queue_depth >= self.checkpoint_size:
+                            break
+                    self._wakeup.wait(timeout)
+                if self._stopping:
+                    return
+            try:
+                self._dump()
+            except Exception:
+                logging.getLogger(__name__).exception("write-behind checkpoint failed; retrying next interval")
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of users, chats and global state entries waiting to be written.
+        """
+        return len(self._dirty_users) + len(self._dirty_chats) + int(self._dirty_global)
+
+    def writer_stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self.queue_depth,
+            'flushes': self.flushes,
+            'flush_seconds': self.flush_seconds,
+            'last_flush_seconds': self.last_flush_seconds,
+        }
+
+    def archive(self, chat_id: int, key: str, data: bytes) -> None:
+        """
+        Stores 'data' as the archived value 'key' of chat 'chat_id' in
+        telegram_chat_archive, replacing any earlier one. Unlike update_*,
+        this is written before it returns, so the value can be dropped from
+        the chat data right after.
+        """
+        def write(conn: _PooledConnection) -> None:
+            if not self._schema_ready:
+                self._create_schema(conn)
+            conn.prepare_statements()
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE qgf_archive (%s, %s, %s);", (chat_id, key, data))
+            conn.commit()
+
+        self.pool.run(write)
+
+    def load_archived(self, chat_id: int, key: str) -> Optional[bytes]:
+        """
+        Returns the archived value 'key' of chat 'chat_id', or None. The
+        archived row is kept until the next archive() of the same key.
+        """
+        def fetch(conn: _PooledConnection) -> Optional[Tuple[bytes]]:
+            conn.prepare_statements()
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE qgf_load_archived (%s, %s);", (chat_id, key))
+                row = cur.fetchone()
+            conn.rollback()
+            return row
+
+        row = self.pool.run(fetch)
+        return None if row is None else bytes(row[0])
+
+    def archived_chat_ids(self, key: str) -> Set[int]:
+        """
+        Returns the ids of the chats with an archived value 'key'.
+        """
+        def fetch(conn: _PooledConnection) -> list:
+            if not self._schema_ready:
+                self._create_schema(conn)
+            conn.prepare_statements()
             with conn.cursor() as cur:
-                data = {
-                    'conversations': self.conversations,
-                    'user_data': self.user_data,
-                    'chat_data': self.chat_data,
-                    'bot_data': self.bot_data,
-                    'callback_data': self.callback_data,
-                }
-                data_serialized = pickle.dumps(data)
-                cur.execute("INSERT INTO telegram_persistence (data) VALUES (%s);", (data_serialized,))
+                cur.execute("EXECUTE qgf_archived_ids (%s);", (key,))
+                rows = cur.fetchall()
+            conn.rollback()
+            return rows
+
+        return { chat_id for chat_id, in self.pool.run(fetch) }
+
+    def load_stats(self) -> Dict[str, Any]:
+        return {
+            'loads': self.loads,
+            'load_seconds': self.load_seconds,
+            'row_fetches': self.row_fetches,
+            'row_fetch_seconds': self.row_fetch_seconds,
+            'user_refreshes': self.user_refreshes,
+        }
+
+    def compact_snapshots(
+        self,
+        keep: Optional[int] = None,
+        max_age: Optional[float] = None,
+        batch_size: int = 1000,
+        pause: float = 0.0,
+        vacuum: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Deletes old rows of telegram_persistence. A snapshot is kept if it is
+        one of the 'keep' newest or younger than 'max_age' seconds; the newest
+        one is always kept. Rows are deleted 'batch_size' at a time, each
+        batch in its own transaction, sleeping 'pause' seconds in between, so
+        no lock is held for long. With 'vacuum', a plain (non-blocking) VACUUM
+        runs afterwards so the freed space is reused right away.
+
+        Returns the number of rows deleted and the table's total size (with
+        indexes and TOAST) in bytes before and after.
+        """
+        if keep is None and max_age is None:
+            raise ValueError("compact_snapshots needs 'keep' or 'max_age'")
+
+        def query(statement: str, args: tuple = ()) -> Any:
+            def run(conn: _PooledConnection) -> Any:
+                if not self._schema_ready:
+                    self._create_schema(conn)
+                conn.prepare_statements()
+                with conn.cursor() as cur:
+                    cur.execute(statement, args)
+                    res = cur.fetchone() if cur.description else cur.rowcount
                 conn.commit()
-        finally:
-            conn.close()
+                return res
+            return self.pool.run(run)
+
+        size_before, = query("EXECUTE qgf_snapshots_size;")
+        cutoffs = []
+        if keep is not None:
+            row = query("EXECUTE qgf_snapshot_cutoff_keep (%s);", (max(keep, 1) - 1,))
+            # fewer than 'keep' snapshots: nothing to delete
+            cutoffs.append(row[0] if row else None)
+        if max_age is not None:
+            cutoffs.append(query("EXECUTE qgf_snapshot_cutoff_age (%s);", (max_age,))[0])
+        newest = query("EXECUTE qgf_snapshot_cutoff_keep (0);")
+
+        deleted = 0
+        if None not in cutoffs and newest is not None:
+            cutoff = min(cutoffs + [ newest[0] ])
+            while True:
+                count = query("EXECUTE qgf_delete_snapshots (%s, %s);", (cutoff, batch_size))
+                deleted += count
+                if count < batch_size:
+                    break
+                time.sleep(pause)
+
+        if vacuum:
+            def run_vacuum(conn: _PooledConnection) -> None:
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("VACUUM telegram_persistence;")
+                finally:
+                    conn.autocommit = False
+            self.pool.run(run_vacuum)
+
+        size_after, = query("EXECUTE qgf_snapshots_size;")
+        logging.getLogger(__name__).info("compacted telegram_persistence: deleted %d rows, %d -> %d bytes",
+            deleted, size_before, size_after)
+        return {
+            'deleted': deleted,
+            'bytes_before': size_before,
+            'bytes_after': size_after,
+        }
+
+    # Nothing this persistence stores can hold a Bot, and the copying walk of
+    # BasePersistence.insert_bot/replace_bot would hand the dispatcher copies
+    # of the rows (or fail on slotted objects), so the data is passed as is.
+    def insert_bot(self, obj: object) -> object:
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        return obj
 
     def get_user_data(self) -> DefaultDict[int, UD]:
-        if self.user_data:
-            pass
-        else:
+        if not self._loaded:
             self._load()
         return self.user_data  # type: ignore[return-value]
 
     def get_chat_data(self) -> DefaultDict[int, CD]:
-        if self.chat_data:
-            pass
-        else:
+        if not self._loaded:
             self._load()
         return self.chat_data  # type: ignore[return-value]
 
     def get_bot_data(self) -> BD:
-        if self.bot_data:
-            pass
-        else:
+        if not self._loaded:
             self._load()
         return self.bot_data  # type: ignore[return-value]
 
     def get_callback_data(self) -> Optional[CDCData]:
-        if self.callback_data:
-            pass
-        else:
+        if not self._loaded:
             self._load()
         if self.callback_data is None:
             return None
         return self.callback_data[0], self.callback_data[1].copy()
 
     def get_conversations(self, name: str) -> ConversationDict:
-        if self.conversations:
-            pass
-        else:
+        if not self._loaded:
             self._load()
         return self.conversations.get(name, {}).copy()  # type: ignore[union-attr]
 
@@ -193,43 +1062,71 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         if self.conversations.setdefault(name, {}).get(key) == new_state:
             return
         self.conversations[name][key] = new_state
-        if not self.on_flush:
-            self._dump()
+        self._mark('global')
+        self._changed()
+
+    # The dispatcher hands back the same objects it got from get_*_data, so
+    # comparing against the stored value can't detect changes; every update
+    # marks the entry dirty and _dump skips those whose serialization did not
+    # change.
 
     def update_user_data(self, user_id: int, data: UD) -> None:
-        if self.user_data is None:
-            self.user_data = defaultdict(self.context_types.user_data)
-        if self.user_data.get(user_id) == data:
-            return
-        self.user_data[user_id] = data
-        if not self.on_flush:
-            self._dump()
+        with self._lock:
+            if self.user_data is None:
+                self.user_data = defaultdict(self.context_types.user_data)
+            self.user_data[user_id] = data
+        self._mark('user', user_id)
+        self._changed()
 
     def update_chat_data(self, chat_id: int, data: CD) -> None:
-        if self.chat_data is None:
-            self.chat_data = defaultdict(self.context_types.chat_data)
-        if self.chat_data.get(chat_id) == data:
-            return
-        self.chat_data[chat_id] = data
-        if not self.on_flush:
-            self._dump()
+        with self._lock:
+            if self.chat_data is None:
+                self.chat_data = defaultdict(self.context_types.chat_data)
+            self.chat_data[chat_id] = data
+        self._mark('chat', chat_id)
+        self._changed()
 
     def update_bot_data(self, data: BD) -> None:
-        if self.bot_data == data:
-            return
         self.bot_data = data
-        if not self.on_flush:
-            self._dump()
+        self._mark('global')
+        self._changed()
 
     def update_callback_data(self, data: CDCData) -> None:
         if self.callback_data == data:
             return
         self.callback_data = (data[0], data[1].copy())
-        if not self.on_flush:
-            self._dump()
+        self._mark('global')
+        self._changed()
+
+    def _saw_user(self, user_id: int, updated: Any) -> None:
+        if self.shard is not None:
+            self._user_updated[user_id] = updated
 
     def refresh_user_data(self, user_id: int, user_data: UD) -> None:
-        pass # do nothing
+        # only shards share rows with other processes
+        if self.shard is None:
+            return
+
+        def check(conn: _PooledConnection) -> Any:
+            conn.prepare_statements()
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE qgf_user_updated (%s);", (user_id,))
+                row = cur.fetchone()
+            conn.rollback()
+            return row and row[0]
+
+        updated = self.pool.run(check)
+        with self._lock:
+            if updated is None or updated == self._user_updated.get(user_id) or user_id in self._dirty_users:
+                return
+        fresh = self._fetch_row('user', user_id)
+        if fresh is not None:
+            # the dispatcher keeps this very object for the user, and a
+            # handler on another thread may be reading it
+            user_data.update(fresh)
+            for key in [ key for key in user_data if key not in fresh ]:
+                del user_data[key]
+            self.user_refreshes += 1
 
     def refresh_chat_data(self, chat_id: int, chat_data: CD) -> None:
         pass # do nothing
@@ -238,11 +1135,34 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         pass # do nothing
 
     def flush(self) -> None:
-        if (
-            self.user_data
-            or self.chat_data
-            or self.bot_data
-            or self.callback_data
-            or self.conversations
-        ):
+        with self._wakeup:
+            writer, self._writer = self._writer, None
+            self._stopping = True
+            self._wakeup.notify()
+        if writer is not None:
+            writer.join()
+        if self.queue_depth:
             self._dump()
+        self.pool.close()
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description="Delete old snapshots from telegram_persistence.")
+    parser.add_argument("--keep", type=int, help="keep this many of the newest snapshots")
+    parser.add_argument("--max-age", type=float, help="keep snapshots younger than this many seconds")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    parser.add_argument("--vacuum", action="store_true")
+    args = parser.parse_args()
+    if args.keep is None and args.max_age is None:
+        parser.error("one of --keep and --max-age is required")
+
+    persistence = PostgresPersistence(postgres_url=os.environ["DATABASE_URL"])
+    try:
+        res = persistence.compact_snapshots(args.keep, args.max_age, args.batch_size, args.pause, args.vacuum)
+    finally:
+        persistence.pool.close()
+    print("deleted {} snapshots; telegram_persistence {} -> {} bytes".format(
+        res['deleted'], res['bytes_before'], res['bytes_after']))
@@ -0,0 +1,220 @@
+import random
+import time
+import weakref
+
+from game_state import NUM_PER_SUIT
+
+class WorldCounter:
+    """
+    Counts the worlds consistent with a GameState, i.e. the matrices
+    x[player][suit] with player_minimums <= x <= player_maximums, every row
+    summing to that player's hand size and every column to NUM_PER_SUIT. All
+    such worlds are considered equally likely.
+
+    Counting is a dynamic program over suits: a suit's column is chosen, its
+    cards are removed from the hands, and the rest of the suits are counted
+    recursively. Results are memoized on the remaining suits and the
+    remaining hand sizes, so the subproblems are shared between the per-suit
+    marginals.
+    """
+
+    def __init__(self, state):
+        self.num_players = state.num_players
+        self.minimums = [ row[:] for row in state.player_minimums ]
+        self.maximums = [ row[:] for row in state.player_maximums ]
+        self.hand_sizes = tuple(state.hand_sizes)
+        self.memo = {}
+
+    def count(self):
+        return self._count(tuple(range(self.num_players)), self.hand_sizes)
+
+    def probabilities(self):
+        """
+        Returns probs, where probs[player][suit][k] is the probability that
+        'player' holds exactly k cards of suit 'suit', or None if no world is
+        consistent with the state.
+        """
+        n = self.num_players
+        weights = [ [ [ 0 ] * (NUM_PER_SUIT + 1) for _ in range(n) ] for _ in range(n) ]
+        total = 0
+        for suit in range(n):
+            rest = tuple(other for other in range(n) if other != suit)
+            total = 0
+            for column in self._columns(suit, self.hand_sizes, rest):
+                count = self._count(rest, self._subtract(self.hand_sizes, column))
+                if not count:
+                    continue
+                total += count
+                for player in range(n):
+                    weights[player][suit][column[player]] += count
+        if not total:
+            return None
+        return [ [ [ w / total for w in cell ] for cell in row ] for row in weights ]
+
+    def _subtract(self, hands, column):
+        return tuple(hand - cards for hand, cards in zip(hands, column))
+
+    def _count(self, suits, hands):
+        key = (suits, hands)
+        if key in self.memo:
+            return self.memo[key]
+
+        if len(suits) == 1:
+            # the last suit has to fill every hand exactly
+            suit = suits[0]
+            result = int(sum(hands) == NUM_PER_SUIT and all(
+                self.minimums[player][suit] <= hands[player] <= self.maximums[player][suit]
+                for player in range(self.num_players)))
+        else:
+            rest = suits[1:]
+            result = 0
+            for column in self._columns(suits[0], hands, rest):
+                result += self._count(rest, self._subtract(hands, column))
+
+        self.memo[key] = result
+        return result
+
+    def _columns(self, suit, hands, rest):
+        """
+        Generates every way of dealing the NUM_PER_SUIT cards of 'suit' to the
+        players within their bounds, leaving each hand fillable by the suits
+        in 'rest'.
+        """
+        n = self.num_players
+        lows = []
+        highs = []
+        for player in range(n):
+            rest_min = sum(self.minimums[player][other] for other in rest)
+            rest_max = sum(self.maximums[player][other] for other in rest)
+            low = max(self.minimums[player][suit], hands[player] - rest_max)
+            high = min(self.maximums[player][suit], hands[player] - rest_min)
+            if low > high:
+                return
+            lows.append(low)
+            highs.append(high)
+
+        # suffix sums let the recursion stop as soon as the remaining players
+        # can no longer absorb (or must exceed) the cards left to deal
+        low_after = [ 0 ] * (n + 1)
+        high_after = [ 0 ] * (n + 1)
+        for player in reversed(range(n)):
+            low_after[player] = low_after[player + 1] + lows[player]
+            high_after[player] = high_after[player + 1] + highs[player]
+
+        column = [ 0 ] * n
+        def deal(player, left):
+            if player == n:
+                if left == 0:
+                    yield tuple(column)
+                return
+            start = max(lows[player], left - high_after[player + 1])
+            stop = min(highs[player], left - low_after[player + 1])
+            for cards in range(start, stop + 1):
+                column[player] = cards
+                yield from deal(player + 1, left - cards)
+            column[player] = 0
+
+        yield from deal(0, NUM_PER_SUIT)
+
+    def estimate_probabilities(self, time_limit, rng=None):
+        """
+        Approximates probabilities() by sequential importance sampling for at
+        most 'time_limit' seconds: each sample deals the suits one player at a
+        time, choosing uniformly from the values still possible, and is
+        weighted by the number of choices it had (Knuth's estimator), which
+        makes the weighted frequencies unbiased estimates of the world counts.
+        Returns None if no sample found a consistent world.
+        """
+        rng = rng or random.Random()
+        n = self.num_players
+        weights = [ [ [ 0.0 ] * (NUM_PER_SUIT + 1) for _ in range(n) ] for _ in range(n) ]
+        total = 0.0
+        deadline = time.monotonic() + time_limit
+        while True:
+            sample = self._sample(rng)
+            if sample is not None:
+                weight, world = sample
+                total += weight
+                for player in range(n):
+                    for suit in range(n):
+                        weights[player][suit][world[player][suit]] += weight
+            if time.monotonic() >= deadline:
+                break
+        if not total:
+            return None
+        return [ [ [ w / total for w in cell ] for cell in row ] for row in weights ]
+
+    def _sample(self, rng):
+        n = self.num_players
+        hands = list(self.hand_sizes)
+        world = [ [ 0 ] * n for _ in range(n) ]
+        weight = 1
+        for suit in range(n):
+            rest = range(suit + 1, n)
+            if not rest:
+                for player in range(n):
+                    if not self.minimums[player][suit] <= hands[player] <= self.maximums[player][suit]:
+                        return None
+                    world[player][suit] = hands[player]
+                if sum(hands) != NUM_PER_SUIT:
+                    return None
+                break
+
+            lows = []
+            highs = []
+            for player in range(n):
+                rest_min = sum(self.minimums[player][other] for other in rest)
+                rest_max = sum(self.maximums[player][other] for other in rest)
+                lows.append(max(self.minimums[player][suit], hands[player] - rest_max))
+                highs.append(min(self.maximums[player][suit], hands[player] - rest_min))
+            low_after = sum(lows)
+            high_after = sum(highs)
+
+            left = NUM_PER_SUIT
+            for player in range(n):
+                low_after -= lows[player]
+                high_after -= highs[player]
+                start = max(lows[player], left - high_after)
+                stop = min(highs[player], left - low_after)
+                if start > stop:
+                    return None
+                weight *= stop - start + 1
+                cards = rng.randint(start, stop)
+                world[player][suit] = cards
+                hands[player] -= cards
+                left -= cards
+        return weight, world
+
+_cache = weakref.WeakKeyDictionary()
+
+def card_probabilities(state, approximate=False, time_limit=0.5, rng=None):
+    """
+    Returns probs[player][suit][k], the probability that 'player' holds
+    exactly k cards of suit 'suit' given everything known in 'state' (a
+    GameState), or None if the state is contradictory.
+
+    With 'approximate', the probabilities are estimated by sampling for at
+    most 'time_limit' seconds instead of counted exactly, which is only
+    needed for large tables.
+
+    Results are cached until the state changes (per GameState.version).
+    """
+    key = (state.version, approximate)
+    cached = _cache.get(state)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    counter = WorldCounter(state)
+    if approximate:
+        result = counter.estimate_probabilities(time_limit, rng)
+    else:
+        result = counter.probabilities()
+    _cache[state] = (key, result)
+    return result
+
+def world_count(state):
+    """
+    Returns the number of worlds (card counts per player and suit) consistent
+    with 'state'.
+    """
+    return WorldCounter(state).count()
@@ -0,0 +1,186 @@
+"""
+Self-play simulator for Quantum Go Fish.
+
+Usage (from the repository root):
+
+    python selfplay.py --games 100000 --players 4 --output games.csv.gz
+    python selfplay.py --players 4 --replay 1234
+
+Games are played by move policies (see POLICIES) directly against a
+GameState, following the same turn order and win checks as main.Game. They
+are spread over a process pool, and one CSV row per game is written as soon
+as it finishes. Every game's randomness derives from (--seed, game id), so any
+row can be replayed exactly with --replay.
+"""
+
+import argparse
+import csv
+import gzip
+import multiprocessing
+import random
+import sys
+import time
+
+from game_state import NUM_PER_SUIT, new_game_state
+
+class RandomPolicy:
+    """
+    Asks a random other player for a random suit it could hold, and answers
+    with a random consistent number of cards.
+    """
+
+    def ask(self, state, asker, rng):
+        return self._target(state, asker, rng), rng.choice(self._askable(state, asker))
+
+    def respond(self, state, target, suit, rng):
+        return rng.choice(self._answers(state, target, suit))
+
+    def _target(self, state, asker, rng):
+        return rng.choice([ p for p in range(state.num_players) if p != asker ])
+
+    def _askable(self, state, asker):
+        return [ suit for suit in range(state.num_players)
+                 if state.is_consistent_with(asker, suit, 1, NUM_PER_SUIT) ]
+
+    def _answers(self, state, target, suit):
+        return [ n for n in range(state.player_minimums[target][suit], state.player_maximums[target][suit] + 1)
+                 if state.is_consistent_with(target, suit, n, n) ]
+
+class GreedyPolicy(RandomPolicy):
+    """
+    Asks for the suit it is known to hold the most of, and answers with as few
+    cards as it can get away with.
+    """
+
+    def ask(self, state, asker, rng):
+        target = self._target(state, asker, rng)
+        suits = self._askable(state, asker)
+        best = max(state.player_minimums[asker][suit] for suit in suits)
+        return target, rng.choice([ suit for suit in suits if state.player_minimums[asker][suit] == best ])
+
+    def respond(self, state, target, suit, rng):
+        return self._answers(state, target, suit)[0]
+
+POLICIES = {
+    "random": RandomPolicy,
+    "greedy": GreedyPolicy,
+}
+
+FIELDS = ["game_id", "players", "policies", "winner", "win_type", "turns", "deduce_seconds"]
+
+def play_game(num_players, policy_names, seed, game_id, moves=None):
+    """
+    Plays one game between 'num_players' players, where player i uses policy
+    policy_names[i % len(policy_names)]. Returns a dict with the FIELDS. If
+    'moves' is a list, every (asker, target, suit, n) is appended to it.
+    """
+    rng = random.Random("{}-{}".format(seed, game_id))
+    policies = [ POLICIES[policy_names[i % len(policy_names)]]() for i in range(num_players) ]
+    state = new_game_state(num_players)
+    deduce_seconds = 0.0
+    result = None
+    asker = 0
+    turns = 0
+    max_turns = 50 * num_players * NUM_PER_SUIT
+
+    def check():
+        nonlocal deduce_seconds
+        start = time.perf_counter()
+        res = state.check_win_conditions()
+        deduce_seconds += time.perf_counter() - start
+        return res
+
+    while result is None and turns < max_turns:
+        turns += 1
+        target, suit = policies[asker].ask(state, asker, rng)
+        if not state.asked_for(asker, suit):
+            raise RuntimeError("policy made an illegal ask: {}".format((asker, target, suit)))
+        result = check()
+        if result is not None:
+            if moves is not None:
+                moves.append((asker, target, suit, None))
+            break
+
+        n = policies[target].respond(state, target, suit, rng)
+        if not (state.gave_away(target, suit, n) and state.received(asker, suit, n)):
+            raise RuntimeError("policy made an illegal response: {}".format((target, suit, n)))
+        if moves is not None:
+            moves.append((asker, target, suit, n))
+        result = check()
+
+        # same turn order as main.Game: the next player with a nonempty hand
+        while True:
+            asker = (asker + 1) % num_players
+            if state.hand_sizes[asker] > 0:
+                break
+
+    return {
+        "game_id": game_id,
+        "players": num_players,
+        "policies": "+".join(policy_names),
+        "winner": result[1] if result else "",
+        "win_type": result[0].name if result else "",
+        "turns": turns,
+        "deduce_seconds": round(deduce_seconds, 6),
+    }
+
+def _play_task(task):
+    return play_game(*task)
+
+def simulate(num_games, num_players, policy_names, seed, processes, out, chunksize=16):
+    """
+    Plays 'num_games' games over a pool of 'processes' workers and writes
+    each result to the csv file object 'out' as it arrives. Returns the
+    number of games written.
+    """
+    writer = csv.DictWriter(out, FIELDS)
+    writer.writeheader()
+    tasks = ( (num_players, policy_names, seed, game_id) for game_id in range(num_games) )
+    written = 0
+    with multiprocessing.Pool(processes) as pool:
+        for row in pool.imap_unordered(_play_task, tasks, chunksize):
+            writer.writerow(row)
+            written += 1
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--policies", nargs="+", default=["random"], choices=sorted(POLICIES),
+        help="policies assigned to players in turn order, cycling")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None, help="defaults to the number of cores")
+    parser.add_argument("--output", default="-", help="CSV file, gzipped if it ends in .gz")
+    parser.add_argument("--replay", type=int, metavar="GAME_ID", help="replay a single game and print its moves")
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        moves = []
+        result = play_game(args.players, args.policies, args.seed, args.replay, moves)
+        for asker, target, suit, n in moves:
+            if n is None:
+                print("{} asked {} for suit {}".format(asker, target, suit))
+            else:
+                print("{} asked {} for suit {}: {}".format(asker, target, suit, n))
+        print(result)
+        return
+
+    if args.output == "-":
+        out = sys.stdout
+    elif args.output.endswith(".gz"):
+        out = gzip.open(args.output, "wt", newline="")
+    else:
+        out = open(args.output, "w", newline="")
+
+    start = time.perf_counter()
+    try:
+        written = simulate(args.games, args.players, args.policies, args.seed, args.processes, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    print("{} games in {:.1f}s ({:.1f} games/s)".format(written, elapsed, written / elapsed), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
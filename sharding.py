@@ -0,0 +1,233 @@
+"""
+Runs the bot as several worker processes, each serving a share of the chats.
+
+A single process uses at most one core however busy the bot is. With
+SHARDS=n, main.py instead starts a front process that answers the webhook
+and passes every update on to the worker process of its chat, number
+shard_of(chat_id, n). Every worker is a whole bot (main.create_updater)
+whose PostgresPersistence only loads the chats of its shard, so a chat's
+Game lives in exactly one process and its updates are handled there in the
+order they arrived, without any locking between processes. Users' data is
+shared: whichever worker needs a user's row fetches it, fetches it again
+before a handler if another worker has written it since (say, a /iam in a
+chat of another shard), and only writes it back if it changed it.
+
+Changing n moves chats between workers, which takes a restart. The front
+holds a Postgres advisory lock from before its workers load anything until
+they have all written their last changes, so the workers of a new front
+(say, a deployment with another n overlapping the old one) only load rows
+after the old workers are done with them. A worker that dies is started
+again with its queue, and the updates waiting in it, intact.
+"""
+
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+
+# pg_advisory_lock key held by a running front
+_LOCK_KEY = 0x716766
+
+# the kinds of update that belong to a chat
+_CHAT_UPDATES = ("message", "edited_message", "channel_post", "edited_channel_post",
+                 "my_chat_member", "chat_member", "chat_join_request")
+
+def shard_of(chat_id, count):
+    """
+    Returns the shard, out of 'count', that serves chat 'chat_id'. It has to
+    agree with the qgf_load_shard_* statements of PostgresPersistence.
+    """
+    return chat_id % count
+
+def routing_id(update):
+    """
+    Returns the id an update (as decoded JSON) is routed by: its chat's, or
+    for updates outside any chat (inline queries and the like) its user's,
+    which is also the id of their private chat with the bot.
+    """
+    for kind in _CHAT_UPDATES:
+        if kind in update:
+            return update[kind]["chat"]["id"]
+    query = update.get("callback_query")
+    if query is not None and "message" in query:
+        return query["message"]["chat"]["id"]
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if user is not None:
+                return user["id"]
+    return 0
+
+def _worker(index, count, updates):
+    # spawned from scratch, so main (which imports this module) is only
+    # imported here
+    import __main__
+    import telegram
+    import main
+
+    # chat data pickled by the single-process bot refers to __main__.Game etc.
+    for name, value in vars(main).items():
+        if isinstance(value, type) and not hasattr(__main__, name):
+            setattr(__main__, name, value)
+    # the front stops the workers, once it has stopped taking updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    main.configure_logging()
+
+    updater = main.create_updater(shard=(index, count))
+    dispatcher = updater.dispatcher
+    thread = threading.Thread(target=dispatcher.start, name="dispatcher")
+    thread.start()
+    updater.job_queue.start()
+    logging.getLogger(__name__).info("shard %d of %d started", index, count)
+
+    while True:
+        body = updates.get()
+        if body is None:
+            break
+        dispatcher.update_queue.put(telegram.Update.de_json(json.loads(body), dispatcher.bot))
+
+    # handles everything still queued before stopping
+    updater.job_queue.stop()
+    dispatcher.stop()
+    thread.join()
+    dispatcher.bot.outbox.stop()
+    if dispatcher.persistence is not None:
+        dispatcher.update_persistence()
+        dispatcher.persistence.flush()
+    logging.getLogger(__name__).info("shard %d of %d stopped", index, count)
+
+class Front:
+    """
+    Starts 'count' workers and routes updates to them. 'worker' is the
+    function a worker process runs, given its index, 'count' and the queue
+    of its updates' bodies (None for stop).
+    """
+
+    def __init__(self, count, database_url=None, worker=_worker):
+        self.count = count
+        self.database_url = database_url
+        self.worker = worker
+        # spawned rather than forked, since the front has threads of its own
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [ self._context.Queue() for _ in range(count) ]
+        self.processes = [ None ] * count
+        self.routed = [ 0 ] * count
+        self.restarts = 0
+        self._lock_conn = None
+        self._stopping = threading.Event()
+        self._watcher = None
+
+    def _spawn(self, index):
+        process = self._context.Process(target=self.worker, args=(index, self.count, self.queues[index]),
+            name="shard {}".format(index), daemon=False)
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        if self.database_url is not None:
+            self._lock_conn = psycopg2.connect(self.database_url)
+            self._lock_conn.autocommit = True
+            with self._lock_conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s);", (_LOCK_KEY,))
+                if not cur.fetchone()[0]:
+                    logging.getLogger(__name__).info("waiting for the previous front's workers to finish")
+                    cur.execute("SELECT pg_advisory_lock(%s);", (_LOCK_KEY,))
+        for index in range(self.count):
+            self._spawn(index)
+        self._watcher = threading.Thread(target=self._watch, name="shard watcher", daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        while not self._stopping.wait(1.0):
+            for index, process in enumerate(self.processes):
+                if process.exitcode is not None and not self._stopping.is_set():
+                    logging.getLogger(__name__).error("shard %d exited with %d; restarting it",
+                        index, process.exitcode)
+                    self.restarts += 1
+                    self._spawn(index)
+
+    def route(self, body):
+        """
+        Passes the update 'body' (JSON bytes) on to its shard's worker.
+        """
+        index = shard_of(routing_id(json.loads(body)), self.count)
+        self.routed[index] += 1
+        self.queues[index].put(body)
+
+    def stop(self):
+        """
+        Lets every worker handle what was routed to it and write its changes,
+        then releases the lock.
+        """
+        self._stopping.set()
+        if self._watcher is not None:
+            self._watcher.join()
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            if process is not None:
+                process.join()
+        if self._lock_conn is not None:
+            self._lock_conn.close()
+
+class _WebhookServer(ThreadingHTTPServer):
+    # Telegram opens up to 40 connections at once (setWebhook's max_connections)
+    request_queue_size = 128
+    daemon_threads = True
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    # keeps Telegram's connections open between updates
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    # set on the subclass serve() makes
+    front = None
+    url_path = None
+
+    def do_POST(self):
+        # read either way, so the connection can take the next request
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.split("?")[0].strip("/") != self.url_path:
+            self.send_error(404)
+            return
+        try:
+            self.front.route(body)
+        except (ValueError, KeyError, TypeError):
+            logging.getLogger(__name__).warning("unroutable update: %r", body[:200])
+        # answered right away; Telegram would resend an update it got no 200 for
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(count, listen, port, url_path, database_url=None):
+    """
+    Runs a front with 'count' workers behind a webhook at
+    http://listen:port/url_path until SIGINT or SIGTERM, then stops the
+    workers as Front.stop() does.
+    """
+    front = Front(count, database_url)
+    front.start()
+    handler = type("WebhookHandler", (_WebhookHandler,), { "front": front, "url_path": url_path.strip("/") })
+    server = _WebhookServer((listen, port), handler)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), which runs on this thread
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    logging.getLogger(__name__).info("routing updates to %d shards", count)
+    server.serve_forever()
+    server.server_close()
+    start = time.perf_counter()
+    front.stop()
+    logging.getLogger(__name__).info("all shards stopped in %.1f s (%s updates routed)",
+        time.perf_counter() - start, front.routed)